@@ -1,14 +1,16 @@
-import json as js
+import array
+import collections
 import os
 import random
 import time
 from datetime import datetime
 
+import numpy
 import requests
 
-import cli
 from cli import IllegalArgumentException
-from cli.libs import multithread, shell, fileutils
+from cli.libs import multithread, fileutils
+from cli.libs.scoring import BLEU, post_editing_efforts
 from cli.mmt import BilingualCorpus
 from cli.mmt.cluster import ClusterNode
 from cli.mmt.processing import XMLEncoder
@@ -21,11 +23,49 @@ class TranslateError(Exception):
         super(TranslateError, self).__init__(*args, **kwargs)
 
 
+class _OrderedOutput:
+    """
+    Writes the translations of the corpora in the order they are given, switching file when the corpus changes, and
+    collects the timing of the requests.
+    """
+
+    def __init__(self):
+        self._path = None
+        self._stream = None
+
+        self.count = 0
+        self.elapsed_time = 0
+        self.latencies = array.array('d')
+
+    def write(self, output_path, translation, elapsed, latency):
+        if output_path != self._path:
+            self.close()
+
+            self._stream = open(output_path, 'wb')
+            self._path = output_path
+
+        self._stream.write(translation.encode('utf-8'))
+        self._stream.write('\n')
+
+        self.count += 1
+        self.elapsed_time += elapsed
+        self.latencies.append(latency)
+
+    def close(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+
+
 class Translator:
+    LATENCY_PERCENTILES = [50, 90, 99]
+
     def __init__(self, source_lang, target_lang, threads=1):
         self.source_lang = source_lang
         self.target_lang = target_lang
         self._threads = threads
+        self._window_size = 2 * threads  # max requests submitted and not written yet, it bounds the memory used
+        self.latency_percentiles = None  # request latency (in seconds) percentiles of the last translate()
 
     def name(self):
         return None
@@ -39,17 +79,25 @@ class Translator:
     def _after_translate(self, corpus):
         pass
 
+    def _timed_translation(self, line, corpus):
+        begin = time.time()
+        translation, elapsed = self._get_translation(line, corpus)
+        return translation, elapsed, time.time() - begin
+
     def translate(self, corpora, output):
         """
-        Translate the given corpora in parallel processing fashion.
+        Translate the given corpora in parallel processing fashion. Requests are submitted in a sliding window:
+        translations are written in order as soon as the oldest request completes, and a new request is submitted
+        only when there is room in the window.
         :param corpora: list of ParallelCorpus
         :param output:  path to output directory
         :return: ([ParallelCorpus, ...], time_per_sentence, parallelism)
         """
         pool = multithread.Pool(self._threads)
+        window = collections.deque()
+        translations = _OrderedOutput()
 
         try:
-            translations = []
             start_time = datetime.now()
 
             for corpus in corpora:
@@ -59,42 +107,30 @@ class Translator:
                     output_path = os.path.join(output, corpus.name + '.' + self.target_lang)
 
                     for line in source:
-                        translation = pool.apply_async(self._get_translation, (line, corpus))
-                        translations.append((translation, output_path))
+                        if len(window) >= self._window_size:
+                            translation_job, path = window.popleft()
+                            translations.write(path, *translation_job.get())
 
-                self._after_translate(corpus)
-
-            elapsed_time = 0
-            translation_count = 0
-
-            path = None
-            stream = None
-
-            for translation_job, output_path in translations:
-                translation, elapsed = translation_job.get()
-
-                if output_path != path:
-                    if stream is not None:
-                        stream.close()
-
-                    stream = open(output_path, 'wb')
-                    path = output_path
+                        window.append((pool.apply_async(self._timed_translation, (line, corpus)), output_path))
 
-                stream.write(translation.encode('utf-8'))
-                stream.write('\n')
+                self._after_translate(corpus)
 
-                elapsed_time += elapsed
-                translation_count += 1
+            while len(window) > 0:
+                translation_job, path = window.popleft()
+                translations.write(path, *translation_job.get())
 
-            if stream is not None:
-                stream.close()
+            translations.close()
 
             end_time = datetime.now()
             total_time = end_time - start_time
 
-            return BilingualCorpus.list(output), (elapsed_time / translation_count), (
-                elapsed_time / total_time.total_seconds())
+            self.latency_percentiles = zip(self.LATENCY_PERCENTILES,
+                                           numpy.percentile(translations.latencies, self.LATENCY_PERCENTILES))
+
+            return BilingualCorpus.list(output), (translations.elapsed_time / translations.count), (
+                translations.elapsed_time / total_time.total_seconds())
         finally:
+            translations.close()
             pool.terminate()
 
 
@@ -125,6 +161,12 @@ class Score:
     def calculate(self, corpora, references):
         pass
 
+    def calculate_with_interval(self, corpora, references):
+        """
+        :return: the score and its confidence interval, or None if the score does not provide one
+        """
+        return self.calculate(corpora, references), None
+
 
 class BingTranslator(Translator):
     def __init__(self, source_lang, target_lang, key=None):
@@ -141,6 +183,10 @@ class MMTTranslator(Translator):
     def __init__(self, node):
         Translator.__init__(self, node.engine.source_lang, node.engine.target_lang, threads=100)
         self._api = node.api
+
+        if self._api is not None:
+            self._api.ensure_pool_size(self._threads)
+            self._coalescer = ClusterNode.TranslationCoalescer(self._api)
         self._contexts = {}
 
     def name(self):
@@ -168,8 +214,8 @@ class MMTTranslator(Translator):
             if len(line) > 4096:
                 line = line[:4096]
 
-            translation = self._api.translate(self.source_lang, self.target_lang, line,
-                                              context=context_vector, priority=ClusterNode.Api.PRIORITY_BACKGROUND)
+            translation = self._coalescer.translate(self.source_lang, self.target_lang, line, context=context_vector,
+                                                    priority=ClusterNode.Api.PRIORITY_BACKGROUND)
         except requests.exceptions.ConnectionError:
             raise TranslateError('Unable to connect to MMT. '
                                  'Please check if engine is running on port %d.' % self._api.port)
@@ -287,6 +333,11 @@ class GoogleTranslate(Translator):
         return text, elapsed
 
 
+def _read_lines(path):
+    with open(path) as stream:
+        return [line[:-1] if line.endswith('\n') else line for line in stream]
+
+
 class BLEUScore(Score):
     def __init__(self):
         Score.__init__(self)
@@ -295,73 +346,30 @@ class BLEUScore(Score):
         return 'BLEU Score'
 
     def calculate(self, document, reference):
-        script = os.path.join(cli.PYOPT_DIR, 'mmt-bleu.perl')
-        command = ['perl', script, reference]
+        return self.calculate_with_interval(document, reference)[0]
 
-        with open(document) as input_stream:
-            stdout, _ = shell.execute(command, stdin=input_stream)
+    def calculate_with_interval(self, document, reference):
+        bleu = BLEU(_read_lines(reference))
+        statistics = bleu.statistics(_read_lines(document))
 
-        return float(stdout)
+        return bleu.compute(statistics.sum(axis=0)), bleu.confidence_interval(statistics)
 
 
-class MatecatScore(Score):
-    DEFAULT_TIMEOUT = 60  # secs
+class PostEditingScore(Score):
+    """
+    One minus the average word edit distance between translation and reference, normalized by sentence length.
+    It replaces the Matecat Post-Editing Score of the remote MyMemory service: the two are not comparable.
+    """
 
     def __init__(self):
         Score.__init__(self)
 
     def name(self):
-        return 'Matecat Post-Editing Score'
-
-    @staticmethod
-    def _get_score(sentences, references):
-        url = 'http://api.mymemory.translated.net/computeMatch.php'
-
-        data = {
-            'sentences': sentences,
-            'reference_sentences': references
-        }
-
-        r = requests.post(url, data=js.dumps(data), headers={'Content-type': 'application/json'},
-                          timeout=MatecatScore.DEFAULT_TIMEOUT)
-        body = r.json()
-
-        if r.status_code != requests.codes.ok:
-            raise TranslateError('Matecat Score service not available (' + str(r.status_code) + '): ' + body['error'])
-
-        return body
-
-    @staticmethod
-    def _read_lines(document, reference, limit=30):
-        reference_lines = []
-        document_lines = []
-
-        for i in range(0, limit):
-            reference_line = reference.readline()
-            document_line = document.readline()
-
-            if (not reference_line) or (not document_line):
-                break
-
-            reference_lines.append(reference_line)
-            document_lines.append(document_line)
-
-        return (document_lines, reference_lines) if len(reference_lines) > 0 else (None, None)
+        return 'Post-Editing Score (word edit distance)'
 
     def calculate(self, document, reference):
-        scores = []
-
-        with open(reference) as reference_input:
-            with open(document) as document_input:
-                while True:
-                    document_lines, reference_lines = self._read_lines(document_input, reference_input)
-
-                    if document_lines is None:
-                        break
-
-                    scores += self._get_score(document_lines, reference_lines)
-
-        return reduce(lambda x, y: x + y, scores) / len(scores)
+        efforts = post_editing_efforts(_read_lines(document), _read_lines(reference))
+        return 1. - float(efforts.mean()) if len(efforts) > 0 else 0.
 
 
 class _evaluate_logger:
@@ -404,6 +412,9 @@ class _evaluate_logger:
 
                 if result.error is None:
                     text = '%.2f' % (getattr(result, field) * 100)
+                    interval = getattr(result, field + '_interval')
+                    if interval is not None:
+                        text += ' [%.2f, %.2f]' % (interval[0] * 100, interval[1] * 100)
                     if i == 0:
                         text += ' (Winner)'
                 else:
@@ -420,6 +431,9 @@ class _evaluate_logger:
 
             if result.error is None:
                 text = '%.2fs per sentence (parallelism %.1fx)' % (result.mtt, result.parallelism)
+                if result.latency_percentiles is not None:
+                    text += ', latency ' + ', '.join('p%d %.2fs' % (percentile, latency)
+                                                     for percentile, latency in result.latency_percentiles)
             else:
                 text = str(result.error)
 
@@ -436,9 +450,12 @@ class _EvaluationResult:
         self.translated_corpora = None
         self.mtt = None
         self.parallelism = None
+        self.latency_percentiles = None
         self.error = None
         self.bleu = None
+        self.bleu_interval = None
         self.pes = None
+        self.pes_interval = None
 
 
 class Evaluator:
@@ -507,6 +524,7 @@ class Evaluator:
 
                         result.mtt = mtt
                         result.parallelism = parallelism
+                        result.latency_percentiles = translator.latency_percentiles
                         result.translated_corpora = self._xmlencoder.encode(translated, xmltranslations_path)
                         result.merge = os.path.join(working_dir, filename)
 
@@ -534,14 +552,16 @@ class Evaluator:
                                          % (result.translator.name(), reference_lines, lines))
 
             # Scoring
-            scorers = [(MatecatScore(), 'pes'), (BLEUScore(), 'bleu')]
+            scorers = [(PostEditingScore(), 'pes'), (BLEUScore(), 'bleu')]
 
             for scorer, field in scorers:
                 with logger.step('Calculating %s' % scorer.name()) as _:
                     for result in results:
                         if result.error is not None:
                             continue
-                        setattr(result, field, scorer.calculate(result.merge, reference))
+                        score, interval = scorer.calculate_with_interval(result.merge, reference)
+                        setattr(result, field, score)
+                        setattr(result, field + '_interval', interval)
 
             logger.completed(results, scorers)
 
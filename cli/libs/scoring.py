@@ -0,0 +1,337 @@
+import re
+import sys
+import unicodedata
+
+import numpy
+
+_TAG_NAME = ur'(?:[^\W\d_]|_|:)(?:[^\W\d_]|\d|\.|-|_|:|)*'
+_TAG_REGEX = re.compile(ur'(<(%s)[^>]*/?>)|(<!(%s)[^>]*[^/]>)|(</(%s)[^>]*>)|(<!--)|(-->)' %
+                        (_TAG_NAME, _TAG_NAME, _TAG_NAME), re.UNICODE)
+_TAG_PLACEHOLDER = u'MTEVALXMLTAG%d'
+_ENTITIES = [(u'&quot;', u'"'), (u'&amp;', u'&'), (u'&lt;', u'<'), (u'&gt;', u'>'), (u'&apos;', u'\'')]
+
+_substitutions = None  # the regular expressions of the tokenization, built at the first use
+
+
+def _character_class(codes, negated=False):
+    ranges = []
+    for code in codes:
+        if ranges and ranges[-1][1] == code - 1:
+            ranges[-1][1] = code
+        else:
+            ranges.append([code, code])
+
+    def _escape(code):
+        return u'\\' + unichr(code) if unichr(code) in u'\\]^-' else unichr(code)
+
+    return (u'[^' if negated else u'[') + u''.join(_escape(a) if a == b else _escape(a) + u'-' + _escape(b) for a, b in ranges) + u']'
+
+
+def _get_substitutions():
+    global _substitutions
+
+    if _substitutions is None:
+        # characters of planes 0 and 1 only: the other planes have no punctuation, numbers or symbols, hence
+        # the classes of the characters that are not numbers must be negated ones, covering the other planes too
+        codes = xrange(min(sys.maxunicode, 0x1ffff) + 1)
+        categories = [unicodedata.category(unichr(i))[0] for i in codes]
+
+        punctuation = _character_class([i for i in codes if categories[i] == 'P'])
+        not_number = _character_class([i for i in codes if categories[i] == 'N'], negated=True)
+        isolated = _character_class([i for i in codes if categories[i] == 'S' or 0x4e00 <= i <= 0x9fff])
+
+        # the substitutions of mmt-bleu.perl: a punctuation is split from its neighbours unless they are digits,
+        # CJK characters and symbols are split in any case
+        _substitutions = [
+            (re.compile(u'(%s)(%s)' % (not_number, punctuation), re.UNICODE), ur'\1 \2 '),
+            (re.compile(u'(%s)(%s)' % (punctuation, not_number), re.UNICODE), ur' \1 \2'),
+            (re.compile(u'(%s)' % isolated, re.UNICODE), ur' \1 '),
+        ]
+
+    return _substitutions
+
+
+def tokenize(text):
+    """
+    The international tokenization of mmt-bleu.perl (and mteval-v13a): XML tags are kept as they are, punctuation
+    is split unless it is between two digits, CJK characters and symbols are split from their neighbours.
+    """
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8')
+
+    tags = []
+    match = _TAG_REGEX.search(text) if u'<' in text or u'-->' in text else None
+    while match is not None:
+        text = text[:match.start()] + u' ' + (_TAG_PLACEHOLDER % len(tags)) + u' ' + text[match.end():]
+        tags.append(match.group(0))
+        match = _TAG_REGEX.search(text, match.start())
+
+    for entity, value in _ENTITIES:
+        text = text.replace(entity, value)
+
+    for regex, replacement in _get_substitutions():
+        text = regex.sub(replacement, text)
+
+    for i in reversed(xrange(len(tags))):
+        text = text.replace(_TAG_PLACEHOLDER % i, tags[i], 1)
+
+    return u' '.join(text.split())
+
+
+class Tokens(object):
+    """
+    Tokenized sentences as integer arrays: the ids of all the tokens, concatenated, and the offset of each sentence.
+    The same vocabulary must be used for the sentences that are compared with each other.
+    """
+
+    def __init__(self, sentences, vocabulary, lowercase=False, tokenization=True):
+        ids, offsets = [], [0]
+
+        for sentence in sentences:
+            if not isinstance(sentence, unicode):
+                sentence = sentence.decode('utf-8')
+            if tokenization:
+                sentence = tokenize(sentence)
+            if lowercase:
+                sentence = sentence.lower()
+
+            words = sentence.split()
+            ids.extend([vocabulary.setdefault(word, len(vocabulary)) for word in words])
+            offsets.append(offsets[-1] + len(words))
+
+        self.ids = numpy.array(ids, dtype=numpy.int64)
+        self.offsets = numpy.array(offsets, dtype=numpy.int64)
+        self.lengths = numpy.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def sentence(self, i):
+        return self.ids[self.offsets[i]:self.offsets[i + 1]]
+
+    def ngrams(self, order, first_sentence=0):
+        """
+        Count the n-grams of every sentence: a n-gram is identified by a hash of its order, its token ids and the
+        index of its sentence (counting from first_sentence).
+
+        :return: the distinct n-gram keys, sorted, and for each one of them its count, its order and its sentence
+        """
+        sentences = numpy.repeat(numpy.arange(len(self), dtype=numpy.int64), self.lengths)
+        positions = numpy.arange(len(self.ids), dtype=numpy.int64) - numpy.repeat(self.offsets[:-1], self.lengths)
+        lengths = numpy.repeat(self.lengths, self.lengths)
+
+        keys, orders, indexes = [], [], []
+
+        with numpy.errstate(over='ignore'):
+            for n in xrange(1, order + 1):
+                valid = numpy.flatnonzero(positions + n <= lengths)
+                ngram = numpy.zeros(len(valid), dtype=numpy.uint64)
+                for k in xrange(n):
+                    ngram = ngram * numpy.uint64(0x100000001b3) + self.ids[valid + k].astype(numpy.uint64)
+
+                key = ngram * numpy.uint64(0x9e3779b97f4a7c15) + numpy.uint64(n)
+                key = key * numpy.uint64(0xbf58476d1ce4e5b9) + \
+                    (sentences[valid] + first_sentence).astype(numpy.uint64)
+
+                keys.append(key)
+                orders.append(numpy.full(len(valid), n - 1, dtype=numpy.int64))
+                indexes.append(sentences[valid])
+
+        keys = numpy.concatenate(keys)
+        unique, first, counts = numpy.unique(keys, return_index=True, return_counts=True)
+
+        return unique, counts, numpy.concatenate(orders)[first], numpy.concatenate(indexes)[first]
+
+
+class BLEU(object):
+    """
+    In-process implementation of the BLEU score computed by mmt-bleu.perl (single reference, n-grams up to 4).
+    References are tokenized and counted once, so that the same instance can score any number of runs of the same
+    test set; the n-gram statistics of the hypotheses are computed for the whole set at once, one row per sentence.
+    """
+
+    ORDER = 4
+
+    # columns of the statistics: matching n-grams and hypothesis n-grams per order, hypothesis and reference length
+    CORRECT = slice(0, ORDER)
+    TOTAL = slice(ORDER, 2 * ORDER)
+    HYPOTHESIS_LENGTH = 2 * ORDER
+    REFERENCE_LENGTH = 2 * ORDER + 1
+
+    @staticmethod
+    def compute(statistics):
+        """
+        The corpus score of the statistics of a set of sentences, summed together; statistics of shape
+        (k, columns) return the k scores of the rows.
+        """
+        statistics = numpy.asarray(statistics, dtype=numpy.float64)
+        correct, total = statistics[..., BLEU.CORRECT], statistics[..., BLEU.TOTAL]
+        hypothesis_length = statistics[..., BLEU.HYPOTHESIS_LENGTH]
+        reference_length = statistics[..., BLEU.REFERENCE_LENGTH]
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            log_precision = numpy.log(correct / total).sum(axis=-1) / BLEU.ORDER
+            brevity_penalty = numpy.minimum(0., 1. - reference_length / hypothesis_length)
+            score = numpy.exp(brevity_penalty + log_precision)
+
+        valid = (correct > 0).all(axis=-1) & (hypothesis_length > 0) & (reference_length > 0)
+        score = numpy.where(valid, score, 0.)
+
+        return float(score) if score.ndim == 0 else score
+
+    def __init__(self, references, lowercase=False, tokenization=True):
+        self._lowercase = lowercase
+        self._tokenization = tokenization
+        self._vocabulary = {}
+
+        self.references = Tokens(references, self._vocabulary, lowercase=lowercase, tokenization=tokenization)
+        self._reference_keys, self._reference_counts, _, _ = self.references.ngrams(self.ORDER)
+
+        # remaining_ngrams[i] is the count of the reference n-grams, per order, from the i-th sentence to the end
+        ngrams = numpy.maximum(0, self.references.lengths[:, None] - numpy.arange(self.ORDER)[None, :])
+        self.remaining_ngrams = numpy.zeros((len(self.references) + 1, self.ORDER), dtype=numpy.int64)
+        self.remaining_ngrams[:-1] = numpy.cumsum(ngrams[::-1], axis=0)[::-1]
+
+    def __len__(self):
+        return len(self.references)
+
+    def tokens(self, hypotheses):
+        # hypotheses are lowercased before the tokenization, references after it, as mmt-bleu.perl does
+        if self._lowercase:
+            hypotheses = [(h if isinstance(h, unicode) else h.decode('utf-8')).lower() for h in hypotheses]
+        return Tokens(hypotheses, self._vocabulary, tokenization=self._tokenization)
+
+    def statistics(self, hypotheses, offset=0):
+        """
+        :param hypotheses: translations of the references from the offset-th on, as strings or Tokens
+        :return: an array with a row of statistics for every hypothesis
+        """
+        tokens = hypotheses if isinstance(hypotheses, Tokens) else self.tokens(hypotheses)
+        size = len(tokens)
+
+        statistics = numpy.zeros((size, 2 * self.ORDER + 2), dtype=numpy.int64)
+        statistics[:, self.HYPOTHESIS_LENGTH] = tokens.lengths
+        statistics[:, self.REFERENCE_LENGTH] = self.references.lengths[offset:offset + size]
+
+        if len(tokens.ids) > 0 and len(self._reference_keys) > 0:
+            keys, counts, orders, sentences = tokens.ngrams(self.ORDER, first_sentence=offset)
+
+            positions = numpy.minimum(numpy.searchsorted(self._reference_keys, keys), len(self._reference_keys) - 1)
+            matches = numpy.where(self._reference_keys[positions] == keys,
+                                  numpy.minimum(counts, self._reference_counts[positions]), 0)
+
+            cells = sentences * self.ORDER + orders
+            statistics[:, self.CORRECT] = numpy.bincount(cells, weights=matches,
+                                                         minlength=size * self.ORDER).reshape(size, self.ORDER)
+            statistics[:, self.TOTAL] = numpy.bincount(cells, weights=counts,
+                                                       minlength=size * self.ORDER).reshape(size, self.ORDER)
+
+        return statistics
+
+    def score(self, hypotheses):
+        return self.compute(self.statistics(hypotheses).sum(axis=0))
+
+    def sentence_scores(self, hypotheses):
+        """
+        Sentence level BLEU, with add-one smoothing of the counts of the n-grams of order higher than 1.
+        """
+        statistics = self.statistics(hypotheses).astype(numpy.float64)
+        statistics[:, 1:self.ORDER] += 1
+        statistics[:, self.ORDER + 1:2 * self.ORDER] += 1
+        return self.compute(statistics)
+
+    def upper_bound(self, statistics):
+        """
+        The best score that a run can reach once complete, given the statistics of its first sentences: every
+        remaining reference n-gram may still be matched by the remaining hypotheses, and the brevity penalty cannot
+        exceed 1.
+        """
+        remaining = self.remaining_ngrams[len(statistics)]
+        totals = numpy.asarray(statistics).reshape(-1, 2 * self.ORDER + 2).sum(axis=0)
+
+        bound = numpy.zeros(2 * self.ORDER + 2, dtype=numpy.int64)
+        bound[self.CORRECT] = totals[self.CORRECT] + remaining
+        bound[self.TOTAL] = totals[self.TOTAL] + remaining
+        bound[self.HYPOTHESIS_LENGTH] = bound[self.REFERENCE_LENGTH] = 1
+
+        return self.compute(bound)
+
+    def confidence_interval(self, statistics, samples=1000, confidence=0.95, seed=1234):
+        """
+        Bootstrap confidence interval of the corpus score: the test set is resampled with replacement, and the
+        scores of the samples are computed together from the statistics of the sentences.
+
+        :return: the (lower, upper) bounds of the interval
+        """
+        statistics = numpy.asarray(statistics, dtype=numpy.float64)
+        size = len(statistics)
+        random = numpy.random.RandomState(seed)
+
+        scores = []
+        chunk = max(1, 10000000 // max(1, size))  # samples resampled together, it bounds the size of the weights
+
+        for start in xrange(0, samples, chunk):
+            count = min(chunk, samples - start)
+            resampled = random.randint(0, size, size=(count, size)) + \
+                numpy.arange(count, dtype=numpy.int64)[:, None] * size
+            weights = numpy.bincount(resampled.ravel(), minlength=count * size).reshape(count, size)
+            scores.append(self.compute(weights.dot(statistics)))
+
+        scores = numpy.concatenate(scores)
+        alpha = (1. - confidence) / 2.
+
+        return float(numpy.percentile(scores, 100 * alpha)), float(numpy.percentile(scores, 100 * (1. - alpha)))
+
+
+def edit_distances(hypotheses, references, batch_size=256):
+    """
+    Word level Levenshtein distance of each hypothesis from its reference, both given as Tokens with the same
+    vocabulary. Pairs are sorted by length and processed in batches: each row of the dynamic programming matrix is
+    computed for the whole batch with a few array operations, the insertions with a cumulative minimum.
+    """
+    size = len(hypotheses)
+    distances = numpy.zeros(size, dtype=numpy.int64)
+    order = numpy.argsort(numpy.maximum(hypotheses.lengths, references.lengths), kind='mergesort')
+
+    for start in xrange(0, size, batch_size):
+        batch = order[start:start + batch_size]
+        hypothesis_lengths, reference_lengths = hypotheses.lengths[batch], references.lengths[batch]
+        rows, columns = int(hypothesis_lengths.max()), int(reference_lengths.max())
+
+        hypothesis_ids = numpy.full((len(batch), rows), -1, dtype=numpy.int64)
+        reference_ids = numpy.full((len(batch), columns), -2, dtype=numpy.int64)
+        for i, sentence in enumerate(batch):
+            hypothesis_ids[i, :hypothesis_lengths[i]] = hypotheses.sentence(sentence)
+            reference_ids[i, :reference_lengths[i]] = references.sentence(sentence)
+
+        steps = numpy.arange(columns + 1, dtype=numpy.int64)
+        previous = numpy.tile(steps, (len(batch), 1))
+
+        for i in xrange(rows):
+            substitution = previous[:, :-1] + (hypothesis_ids[:, i:i + 1] != reference_ids)
+
+            current = previous + 1
+            current[:, 1:] = numpy.minimum(current[:, 1:], substitution)
+            current = numpy.minimum.accumulate(current - steps, axis=1) + steps
+
+            # the pairs whose hypothesis is over keep their last row
+            previous = numpy.where((i < hypothesis_lengths)[:, None], current, previous)
+
+        distances[batch] = previous[numpy.arange(len(batch)), reference_lengths]
+
+    return distances
+
+
+def post_editing_efforts(hypotheses, references, lowercase=False, tokenization=True):
+    """
+    The post-editing effort of each hypothesis: its word edit distance from the reference, normalized by the length
+    of the longest of the two (0 for a perfect translation, 1 for a translation to be rewritten from scratch).
+    """
+    vocabulary = {}
+    hypotheses = Tokens(hypotheses, vocabulary, lowercase=lowercase, tokenization=tokenization)
+    references = Tokens(references, vocabulary, lowercase=lowercase, tokenization=tokenization)
+
+    lengths = numpy.maximum(hypotheses.lengths, references.lengths)
+    distances = edit_distances(hypotheses, references)
+
+    return distances / numpy.maximum(lengths, 1).astype(numpy.float64)
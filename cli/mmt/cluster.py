@@ -5,6 +5,7 @@ import os
 import random
 import subprocess
 import tempfile
+import threading
 import time
 
 import requests
@@ -53,12 +54,18 @@ class ClusterNode(object):
 
     class Api(object):
         DEFAULT_TIMEOUT = 60 * 60  # sec
+        DEFAULT_POOL_SIZE = 10  # connections kept alive, clients raise it to their concurrency with ensure_pool_size()
+        MAX_RETRIES = 3  # retries of an idempotent request failed with a transient error
+        RETRY_BACKOFF = 0.5  # sec, doubled at every retry
 
         PRIORITY_HIGH = 'high'
         PRIORITY_NORMAL = 'normal'
         PRIORITY_BACKGROUND = 'background'
 
-        def __init__(self, host=None, port=None, root=None):
+        _IDEMPOTENT_METHODS = ('GET', 'PUT', 'DELETE')
+        _TRANSIENT_STATUS_CODES = (502, 503, 504)
+
+        def __init__(self, host=None, port=None, root=None, pool_size=None):
             self.port = port
             self.host = host if host is not None else "localhost"
             self.root = self._normalize_root(root)
@@ -70,9 +77,25 @@ class ClusterNode(object):
 
             self._url_template = self.base_path + "/{endpoint}"
 
+            # the session is shared by all the threads using this Api: its connections are pooled and kept alive
+            self._session = requests.Session()
+            self._pool_size = 0
+            self._pool_lock = threading.Lock()
+            self.ensure_pool_size(pool_size if pool_size is not None else self.DEFAULT_POOL_SIZE)
+
             logging.getLogger('requests').setLevel(1000)
             logging.getLogger('urllib3').setLevel(1000)
 
+        def ensure_pool_size(self, size):
+            """
+            Grow the connection pool to at least the given size, the number of threads sending concurrent requests:
+            connections in excess would be closed after every request.
+            """
+            with self._pool_lock:
+                if size > self._pool_size:
+                    self._session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=size))
+                    self._pool_size = size
+
         @staticmethod
         def _normalize_root(root):
             if root is None or len(root.strip()) == 0:
@@ -94,19 +117,31 @@ class ClusterNode(object):
 
             return content['data'] if 'data' in content else None
 
-        def _get(self, endpoint, params=None):
+        def _request(self, method, endpoint, **kwargs):
             url = self._url_template.format(endpoint=endpoint)
-            r = requests.get(url, params=params, timeout=self.DEFAULT_TIMEOUT)
-            return self._unpack(r)
+
+            # a POST is never retried: it could have been executed by the server even if the response is lost
+            retries = self.MAX_RETRIES if method in self._IDEMPOTENT_METHODS else 0
+
+            for attempt in range(retries + 1):
+                try:
+                    r = self._session.request(method, url, timeout=self.DEFAULT_TIMEOUT, **kwargs)
+                except requests.exceptions.ConnectionError:
+                    if attempt == retries:
+                        raise
+                else:
+                    if attempt == retries or r.status_code not in self._TRANSIENT_STATUS_CODES:
+                        return self._unpack(r)
+
+                time.sleep(self.RETRY_BACKOFF * (2 ** attempt))
+
+        def _get(self, endpoint, params=None):
+            return self._request('GET', endpoint, params=params)
 
         def _delete(self, endpoint):
-            url = self._url_template.format(endpoint=endpoint)
-            r = requests.delete(url, timeout=self.DEFAULT_TIMEOUT)
-            return self._unpack(r)
+            return self._request('DELETE', endpoint)
 
         def _put(self, endpoint, json=None, params=None):
-            url = self._url_template.format(endpoint=endpoint)
-
             data = headers = None
             if json is not None:
                 data = js.dumps(json)
@@ -114,12 +149,9 @@ class ClusterNode(object):
             elif params is not None:
                 data = params
 
-            r = requests.put(url, data=data, headers=headers, timeout=self.DEFAULT_TIMEOUT)
-            return self._unpack(r)
+            return self._request('PUT', endpoint, data=data, headers=headers)
 
         def _post(self, endpoint, json=None, params=None):
-            url = self._url_template.format(endpoint=endpoint)
-
             data = headers = None
             if json is not None:
                 data = js.dumps(json)
@@ -127,8 +159,7 @@ class ClusterNode(object):
             elif params is not None:
                 data = params
 
-            r = requests.post(url, data=data, headers=headers, timeout=self.DEFAULT_TIMEOUT)
-            return self._unpack(r)
+            return self._request('POST', endpoint, data=data, headers=headers)
 
         @staticmethod
         def _encode_context(context):
@@ -175,6 +206,22 @@ class ClusterNode(object):
 
             return self._get('translate', params=p)
 
+        def translate_batch(self, source, target, texts, context=None, nbest=None, verbose=False, priority=None):
+            p = {'source': source, 'target': target}
+            if nbest is not None:
+                p['nbest'] = nbest
+            if context is not None and len(context) > 0:
+                p['context_vector'] = self._encode_context(context)
+            if verbose:
+                p['verbose'] = 'true'
+            if priority is not None:
+                p['priority'] = priority
+
+            data = js.dumps({'q': texts})
+            headers = {'Content-type': 'application/json; charset=utf-8'}
+
+            return self._request('POST', 'translate/batch', params=p, data=data, headers=headers)
+
         def create_memory(self, name):
             params = {'name': name}
             return self._post('memories', params=params)
@@ -210,6 +257,91 @@ class ClusterNode(object):
         def rename_memory(self, id, name):
             return self._put('memories/' + str(id), params={'name': name})
 
+    class TranslationCoalescer(object):
+        """
+        Drop-in replacement of Api.translate() for clients translating from many threads: concurrent calls sharing
+        language pair, context and options are grouped and sent as a single "translate/batch" request.
+
+        The first call of a group waits at most 'max_delay' seconds for other calls to join it, a group is sent as
+        soon as it reaches 'max_batch_size' sentences.
+        """
+
+        DEFAULT_MAX_BATCH_SIZE = 32
+        DEFAULT_MAX_DELAY = 0.005  # sec
+
+        class _Batch(object):
+            def __init__(self, source, target, context, nbest, verbose, priority):
+                self.args = (source, target)
+                self.kwargs = {'context': context, 'nbest': nbest, 'verbose': verbose, 'priority': priority}
+                self.texts = []
+                self.results = None
+                self.error = None
+                self.done = threading.Event()
+
+        def __init__(self, api, max_batch_size=None, max_delay=None):
+            self._api = api
+            self.max_batch_size = max_batch_size if max_batch_size is not None else self.DEFAULT_MAX_BATCH_SIZE
+            self.max_delay = max_delay if max_delay is not None else self.DEFAULT_MAX_DELAY
+
+            self._pending = {}
+            self._lock = threading.Lock()
+
+            self.requests = 0  # number of batch requests sent to the server
+            self.sentences = 0  # number of sentences translated
+
+        @property
+        def port(self):
+            return self._api.port
+
+        def translate(self, source, target, text, context=None, nbest=None, verbose=False, priority=None):
+            encoded_context = ClusterNode.Api._encode_context(context) if context is not None else ''
+            key = (source, target, encoded_context, nbest, bool(verbose), priority)
+
+            with self._lock:
+                batch = self._pending.get(key)
+                leader = batch is None
+
+                if leader:
+                    batch = self._Batch(source, target, context, nbest, verbose, priority)
+                    self._pending[key] = batch
+
+                index = len(batch.texts)
+                batch.texts.append(text)
+
+                full = len(batch.texts) >= self.max_batch_size
+                if full:
+                    del self._pending[key]
+
+            if full:
+                self._send(batch)
+            elif leader:
+                time.sleep(self.max_delay)
+
+                with self._lock:
+                    expired = self._pending.get(key) is batch
+                    if expired:
+                        del self._pending[key]
+
+                if expired:
+                    self._send(batch)
+
+            batch.done.wait()
+
+            if batch.error is not None:
+                raise batch.error
+            return batch.results[index]
+
+        def _send(self, batch):
+            try:
+                batch.results = self._api.translate_batch(*batch.args, texts=batch.texts, **batch.kwargs)
+            except Exception as e:
+                batch.error = e
+            finally:
+                with self._lock:
+                    self.requests += 1
+                    self.sentences += len(batch.texts)
+                batch.done.set()
+
     __SIGTERM_TIMEOUT = 10  # after this amount of seconds, there is no excuse for a process to still be there.
     __LOG_FILENAME = 'node'
 
@@ -525,7 +657,8 @@ class ClusterNode(object):
             if not debug:
                 self.engine.clear_tempdir("tuning")
 
-    def nmt_tune(self, corpora, debug=False, listener=None, max_lines=None, lr_delta=0.1, max_epochs=10, gpus=None):
+    def nmt_tune(self, corpora, debug=False, listener=None, max_lines=None, lr_delta=0.1, max_epochs=10, gpus=None,
+                 tuning_modes=None, workers=None):
         target_lang = self.engine.target_lang
         source_lang = self.engine.source_lang
 
@@ -559,7 +692,8 @@ class ClusterNode(object):
 
             with listener.step('Tuning'):
                 bleu_score = self.engine.tune(content, working_dir, lr_delta=lr_delta,
-                                              max_epochs=max_epochs, log_file=log_file, gpus=gpus)
+                                              max_epochs=max_epochs, log_file=log_file, gpus=gpus,
+                                              tuning_modes=tuning_modes, workers=workers)
 
             listener.on_tuning_end(self, bleu_score)
         finally:
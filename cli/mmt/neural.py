@@ -1,22 +1,28 @@
 import glob
 import logging
+import multiprocessing
 import os
+import Queue
 import shutil
 import sys
+import threading
 import time
+import traceback
 
-from cli import mmt_javamain, LIB_DIR, PYOPT_DIR
+from cli import mmt_javamain, LIB_DIR
 from cli.libs import fileutils
 from cli.libs import shell
+from cli.libs.scoring import BLEU
 from cli.mmt import BilingualCorpus
 from cli.mmt.engine import Engine, EngineBuilder
 from cli.mmt.processing import TrainingPreprocessor
 
 sys.path.insert(0, os.path.abspath(os.path.join(LIB_DIR, 'pynmt')))
 
+import numpy
 import onmt
 import nmmt
-from nmmt import NMTEngineTrainer, NMTEngine, SubwordTextProcessor, MMapDataset, Suggestion
+from nmmt import NMTEngineTrainer, NMTEngine, SubwordTextProcessor, MMapDataset, LexicalTable, Suggestion
 from nmmt import torch_setup
 from nmmt import torch_utils
 import torch
@@ -71,6 +77,8 @@ class TranslationMemory:
 
 
 class NMTPreprocessor:
+    _POLL_INTERVAL = 1.  # seconds between two checks of the workers, while waiting for them
+
     def __init__(self, source_lang, target_lang, bpe_symbols, max_vocab_size, vocab_pruning_threshold):
         self._source_lang = source_lang
         self._target_lang = target_lang
@@ -80,6 +88,8 @@ class NMTPreprocessor:
 
         self._logger = logging.getLogger('mmt.neural.NMTPreprocessor')
         self._ram_limit_mb = 1024
+        self._workers = multiprocessing.cpu_count()
+        self._chunk_size = 10000  # sentences sent to a worker at a time
 
     def process(self, corpora, valid_corpora, output_path, checkpoint=None):
         bpe_output_path = os.path.join(output_path, 'vocab.bpe')
@@ -131,36 +141,157 @@ class NMTPreprocessor:
             self._prepare_corpora(valid_corpora, bpe_encoder, src_vocab, trg_vocab, valid_output_path)
 
     def _prepare_corpora(self, corpora, bpe_encoder, src_vocab, trg_vocab, output_path):
-        count, added, ignored = 0, 0, 0
+        # The current process reads the corpora and splits them in chunks, while a pool of worker processes
+        # (each one with its own copy of the encoder and vocabularies) encodes them in separate dataset shards
+        shards_path = output_path + '.shards'
+        shutil.rmtree(shards_path, ignore_errors=True)
 
-        builder = MMapDataset.Builder(output_path)
+        chunks = multiprocessing.Queue(maxsize=2 * self._workers)
+        results = multiprocessing.Queue()
 
-        for corpus in corpora:
-            with corpus.reader([self._source_lang, self._target_lang]) as reader:
-                for source, target in reader:
+        workers = []
+        for i in range(self._workers):
+            shard_path = os.path.join(shards_path, 'shard.%d' % i)
+            worker = multiprocessing.Process(target=self._prepare_shard,
+                                             args=(chunks, results, bpe_encoder, src_vocab, trg_vocab, shard_path))
+            worker.start()
+            workers.append(worker)
+
+        added, ignored, errors, shards = 0, 0, [], []
+
+        # a worker can die without reporting (e.g. killed by the OOM killer): queues are accessed with a timeout
+        # and the workers are checked, so that the preparation fails instead of waiting forever
+        try:
+            count, chunk = 0, []
+
+            for corpus in corpora:
+                with corpus.reader([self._source_lang, self._target_lang]) as reader:
+                    for source, target in reader:
+                        chunk.append((source, target))
+
+                        if len(chunk) >= self._chunk_size:
+                            self._put_chunk(chunks, chunk, workers)
+                            chunk = []
+
+                        count += 1
+                        if count % 100000 == 0:
+                            self._logger.info(' %d sentences read' % count)
+
+            if len(chunk) > 0:
+                self._put_chunk(chunks, chunk, workers)
+
+            for _ in workers:
+                self._put_chunk(chunks, None, workers, running=False)
+
+            for _ in workers:
+                shard_path, shard_added, shard_ignored, cache_stats, error = self._get_result(results, workers)
+
+                if error is not None:
+                    errors.append(error)
+                else:
+                    added += shard_added
+                    ignored += shard_ignored
+                    shards.append(shard_path)
+                    self._logger.info('BPE cache stats (%s): %s' % (os.path.basename(shard_path), str(cache_stats)))
+        except BaseException:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+            shutil.rmtree(shards_path, ignore_errors=True)
+            raise
+        finally:
+            for worker in workers:
+                worker.join()
+
+        if len(errors) > 0:
+            shutil.rmtree(shards_path, ignore_errors=True)
+            raise Exception('Failed to prepare corpora: ' + errors[0])
+
+        self._logger.info('Prepared %d sentences (%d ignored due to length == 0)' % (added, ignored))
+
+        with _log_timed_action(self._logger, 'Merging %d dataset shards' % len(shards)):
+            builder = MMapDataset.Builder(output_path, ram_limit_mb=self._ram_limit_mb)
+            for shard_path in sorted(shards):
+                builder.add_dataset(MMapDataset.load(shard_path))
+            dataset = builder.build()
+
+        shutil.rmtree(shards_path, ignore_errors=True)
+
+        return dataset
+
+    @staticmethod
+    def _check_workers(workers, running):
+        # if 'running', the workers must be all alive, otherwise they can also have completed successfully
+        for worker in workers:
+            if worker.exitcode is not None and (running or worker.exitcode != 0):
+                raise Exception('Corpora preparation worker %s died unexpectedly (exit code %d)' %
+                                (worker.name, worker.exitcode))
+
+    def _put_chunk(self, chunks, chunk, workers, running=True):
+        # a worker exits only after its end-of-chunks mark, any worker dead before could have lost a chunk:
+        # while the marks are sent ('running' is False), the workers that took theirs can have completed
+        while True:
+            self._check_workers(workers, running=running)
+
+            try:
+                chunks.put(chunk, timeout=self._POLL_INTERVAL)
+                return
+            except Queue.Full:
+                pass
+
+    def _get_result(self, results, workers):
+        while True:
+            try:
+                return results.get(timeout=self._POLL_INTERVAL)
+            except Queue.Empty:
+                self._check_workers(workers, running=False)
+
+                if all([worker.exitcode == 0 for worker in workers]):
+                    # every worker put its result before exiting: the last ones are still in the queue pipe
+                    try:
+                        return results.get(timeout=self._POLL_INTERVAL)
+                    except Queue.Empty:
+                        raise Exception('Corpora preparation workers completed without reporting their results')
+
+    def _prepare_shard(self, chunks, results, bpe_encoder, src_vocab, trg_vocab, shard_path):
+        added, ignored, error = 0, 0, None
+        builder = MMapDataset.Builder(shard_path, ram_limit_mb=self._ram_limit_mb)
+
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+
+            if error is not None:
+                continue  # keep consuming chunks, so that the reader is never blocked on a full queue
+
+            try:
+                sources, targets = [], []
+
+                for source, target in chunk:
                     src_words = bpe_encoder.encode_line(source, is_source=True)
                     trg_words = bpe_encoder.encode_line(target, is_source=False)
 
                     if len(src_words) > 0 and len(trg_words) > 0:
-                        source = src_vocab.convertToIdxList(src_words,
-                                                            onmt.Constants.UNK_WORD)
-                        target = trg_vocab.convertToIdxList(trg_words,
-                                                            onmt.Constants.UNK_WORD,
-                                                            onmt.Constants.BOS_WORD,
-                                                            onmt.Constants.EOS_WORD)
-                        builder.add([source], [target])
+                        sources.append(src_vocab.convertToIdxList(src_words,
+                                                                  onmt.Constants.UNK_WORD))
+                        targets.append(trg_vocab.convertToIdxList(trg_words,
+                                                                  onmt.Constants.UNK_WORD,
+                                                                  onmt.Constants.BOS_WORD,
+                                                                  onmt.Constants.EOS_WORD))
                         added += 1
-
                     else:
                         ignored += 1
 
-                    count += 1
-                    if count % 100000 == 0:
-                        self._logger.info(' %d sentences prepared' % count)
+                builder.add(sources, targets)
+            except BaseException as e:
+                self._logger.exception('Failed to prepare chunk of corpora')
+                error = repr(e)
 
-        self._logger.info('Prepared %d sentences (%d ignored due to length == 0)' % (added, ignored))
+        if error is None:
+            builder.build()
 
-        return builder.build(self._ram_limit_mb)
+        results.put((shard_path, added, ignored, bpe_encoder.cache_stats(), error))
 
 
 class NMTDecoder:
@@ -218,6 +349,11 @@ class NMTDecoder:
                 with _log_timed_action(self._logger, 'Creating engine from scratch'):
                     engine = NMTEngine.new_instance(src_dict, tgt_dict, bpe_encoder, metadata=metadata)
 
+        # the lexical table is saved with every checkpoint, it enables vocabulary shortlisting at inference
+        if engine.lexicon is None:
+            with _log_timed_action(self._logger, 'Building lexical table'):
+                engine.lexicon = LexicalTable.build(train_dataset, src_dict.size(), tgt_dict.size())
+
         engine.running_state = NMTEngine.HOT
 
         trainer = NMTEngineTrainer(engine, state=state, optimizer=optimizer, options=training_opts)
@@ -242,11 +378,11 @@ class NMTDecoder:
         if not os.path.isdir(model_folder):
             os.mkdir(model_folder)
 
-        # Copy checkpoints files excluding .dat
+        # Copy checkpoints files excluding weights
         for f in glob.glob(state.checkpoint['file'] + '.*'):
             _, extension = os.path.splitext(f)
 
-            if extension != '.dat':
+            if extension not in ('.dat', '.mdat'):
                 shutil.copy(f, self.model + extension)
 
         # Merging checkpoints
@@ -267,7 +403,7 @@ class NeuralEngine(Engine):
     def __init__(self, name, source_lang, target_lang, bpe_symbols, max_vocab_size=None, vocab_pruning_threshold=None):
         Engine.__init__(self, name, source_lang, target_lang)
 
-        self._bleu_script = os.path.join(PYOPT_DIR, 'mmt-bleu.perl')
+        self._tune_check_interval = 50  # sentences between two checks of the early stopping of a tuning run
 
         decoder_path = os.path.join(self.models_path, 'decoder')
 
@@ -286,9 +422,8 @@ class NeuralEngine(Engine):
     def type(self):
         return 'neural'
 
-    def tune(self, validation_set, working_dir, lr_delta=0.1, max_epochs=10, gpus=None, log_file=None):
-        torch_setup(gpus=gpus, random_seed=3435)
-
+    def tune(self, validation_set, working_dir, lr_delta=0.1, max_epochs=10, gpus=None, log_file=None,
+             tuning_modes=None, workers=None):
         logger = logging.getLogger('NeuralEngine.Tuning')
 
         if log_file is not None:
@@ -298,10 +433,10 @@ class NeuralEngine(Engine):
             logger.addHandler(fh)
             logger.setLevel(logging.DEBUG)
 
-        with _log_timed_action(logger, 'Loading decoder'):
-            model_folder = os.path.abspath(os.path.join(self.decoder.model, os.path.pardir))
-            decoder = nmmt.NMTDecoder(model_folder, gpus[0])
-            logging.getLogger('nmmt.NMTEngine').disabled = True  # prevent translation log
+        # one probe worker per GPU by default; CUDA is initialized by the workers only, so that they can be forked
+        if workers is None:
+            workers = len(gpus) if gpus is not None and len(gpus) > 1 else 1
+        devices = [gpus[i % len(gpus)] if gpus else None for i in range(workers)]
 
         with _log_timed_action(logger, 'Creating reference file'):
             reference_file = os.path.join(working_dir, 'reference.out')
@@ -311,48 +446,170 @@ class NeuralEngine(Engine):
                     stream.write('\n')
 
         # Tuning -------------------------------------------------------------------------------------------------------
-        probes = []
+        metadata = NMTEngine.Metadata()
+        metadata.load_from_file(self.decoder.model + '.meta')
+
+        if tuning_modes is None:
+            tuning_modes = [metadata.tuning_mode]
+
         runs = int(1. / lr_delta)
 
-        for run in range(1, runs + 1):
-            learning_rate = round(run * lr_delta, 5)
+        # the baseline run is not a candidate, the others are sorted by mode first, as the probes of the sequential
+        # tuning were: ties in bleu are resolved in favour of the first probe in this order
+        probes = [(None, 0, 0.)] + [(tuning_mode, run, round(run * lr_delta, 5))
+                                    for tuning_mode in tuning_modes for run in range(1, runs + 1)]
 
-            with _log_timed_action(logger, 'Tuning run %d/%d' % (run, runs)):
-                output_file = os.path.join(working_dir, 'run%d.out' % run)
-                bleu_score = self._tune_run(decoder, validation_set, learning_rate, max_epochs,
-                                            output_file, reference_file)
+        tasks = multiprocessing.Queue()
+        results = multiprocessing.Queue()
+        best_bleu = multiprocessing.Value('d', -1.)
 
-            logger.info('Run %d completed: lr=%f, bleu=%f' % (run, learning_rate, bleu_score))
-            probes.append((learning_rate, bleu_score))
+        for i, probe in enumerate(probes):
+            tasks.put((i,) + probe)
+        for _ in devices:
+            tasks.put(None)
 
-        best_lr, best_bleu = sorted(probes, key=lambda x: x[1], reverse=True)[0]
+        model_folder = os.path.abspath(os.path.join(self.decoder.model, os.path.pardir))
 
-        with _log_timed_action(logger, 'Updating engine with learning_rate %f (bleu=%f)' % (best_lr, best_bleu)):
-            engine = decoder.get_engine(self.source_lang, self.target_lang)
-            engine.metadata.tuning_max_learning_rate = best_lr
-            engine.metadata.tuning_max_epochs = max_epochs
-            engine.save(self.decoder.model, store_data=False, store_processor=False)
+        logger.info('Tuning with %d probes on %d workers (devices: %s)' % (
+            len(probes), len(devices), ', '.join(str(d) if d is not None else 'cpu' for d in devices)))
+
+        if len(devices) > 1:
+            workers = [multiprocessing.Process(target=self._tune_worker,
+                                               args=(model_folder, device, validation_set, max_epochs, working_dir,
+                                                     tasks, results, best_bleu))
+                       for device in devices]
+        else:
+            workers = [threading.Thread(target=self._tune_worker,
+                                        args=(model_folder, devices[0], validation_set, max_epochs, working_dir,
+                                              tasks, results, best_bleu))]
+
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        scores = {}
+
+        try:
+            while len(scores) < len(probes):
+                try:
+                    i, bleu_score, elapsed_time, error = results.get(timeout=10)
+                except Queue.Empty:
+                    if not any(worker.is_alive() for worker in workers):
+                        raise Exception('tuning workers terminated before completing the probes')
+                    continue
+
+                if error is not None:
+                    raise Exception('tuning worker failed: %s' % error)
+
+                tuning_mode, run, learning_rate = probes[i]
+                scores[i] = bleu_score
+
+                if run == 0:
+                    logger.info('Baseline run completed: bleu=%f, time=%.1fms/sentence' % (
+                        bleu_score, 1000 * elapsed_time / len(validation_set)))
+                elif bleu_score is None:
+                    logger.info('Run %d stopped early: mode=%s, lr=%f, time=%.1fs' % (
+                        run, tuning_mode, learning_rate, elapsed_time))
+                else:
+                    # time per sentence lets compare the latency of the tuning modes
+                    logger.info('Run %d completed: mode=%s, lr=%f, bleu=%f, time=%.1fms/sentence' % (
+                        run, tuning_mode, learning_rate, bleu_score, 1000 * elapsed_time / len(validation_set)))
+        finally:
+            for worker in workers:
+                if isinstance(worker, multiprocessing.Process) and worker.is_alive():
+                    worker.terminate()
+
+        candidates = [i for i in range(1, len(probes)) if scores[i] is not None]
+        best = max(candidates, key=lambda i: (scores[i], -i))
+        best_mode, _, best_lr = probes[best]
+        best_bleu = scores[best]
+
+        with _log_timed_action(logger, 'Updating engine with tuning_mode %s and learning_rate %f (bleu=%f)' % (
+                best_mode, best_lr, best_bleu)):
+            metadata.tuning_mode = best_mode
+            metadata.tuning_max_learning_rate = best_lr
+            metadata.tuning_max_epochs = max_epochs
+            metadata.save_to_file(self.decoder.model + '.meta')
 
         return best_bleu / 100.
 
-    def _tune_run(self, decoder, corpora, lr, epochs, output_file, reference_file):
-        with open(output_file, 'wb') as output:
-            for source, target in corpora:
-                if lr == 0.:
-                    suggestions = None
+    def _tune_worker(self, model_folder, device, corpora, epochs, working_dir, tasks, results, best_bleu):
+        try:
+            decoder = nmmt.NMTDecoder(model_folder, device, random_seed=3435)
+            logging.getLogger('nmmt.NMTEngine').disabled = True  # prevent translation log
+
+            # tuning runs use the reference as suggestion: it must never be returned as the translation
+            decoder.tm_exact_match = False
+            decoder.tm_score_threshold = None
+            # the runs of different tuning modes translate the same sentences: none can be served from the cache
+            decoder._cache = None
+
+            engine = decoder.get_engine(self.source_lang, self.target_lang)
+            default_mode = engine.metadata.tuning_mode
+            bleu = BLEU([target for _, target in corpora])
+
+            while True:
+                task = tasks.get()
+                if task is None:
+                    break
+
+                i, tuning_mode, run, learning_rate = task
+                engine.metadata.tuning_mode = tuning_mode if tuning_mode is not None else default_mode
+
+                if run == 0:
+                    output_file = os.path.join(working_dir, 'run0.out')
                 else:
-                    suggestions = [Suggestion(source, target, 1.)]
-                translation = decoder.translate(self.source_lang, self.target_lang, source,
-                                                suggestions=suggestions, tuning_epochs=epochs, tuning_learning_rate=lr)
+                    output_file = os.path.join(working_dir, 'run%d.%s.out' % (run, tuning_mode))
+
+                begin = time.time()
+                bleu_score = self._tune_run(decoder, corpora, learning_rate, epochs, output_file, bleu,
+                                            best_bleu if run > 0 else None)
+                elapsed_time = time.time() - begin
+
+                if bleu_score is not None and run > 0:
+                    with best_bleu.get_lock():
+                        best_bleu.value = max(best_bleu.value, bleu_score)
+
+                results.put((i, bleu_score, elapsed_time, None))
+        except:
+            results.put((None, None, None, traceback.format_exc()))
+
+    def _tune_run(self, decoder, corpora, lr, epochs, output_file, bleu, best_bleu=None):
+        """
+        Translate the corpora and return its bleu score; if best_bleu is given, the run is abandoned (and None is
+        returned) as soon as its score cannot reach the best one any more.
+        """
+        if lr == 0.:
+            # without tuning the sentences are independent, hence they are translated in length-sorted batches
+            translations = decoder.translate_batch(self.source_lang, self.target_lang, [s for s, _ in corpora])
+        else:
+            translations = (decoder.translate(self.source_lang, self.target_lang, source,
+                                              suggestions=[Suggestion(source, target, 1.)],
+                                              tuning_epochs=epochs, tuning_learning_rate=lr)
+                            for source, target in corpora)
 
-                output.write(translation.text.encode('utf-8'))
+        # the statistics are computed in blocks of sentences, that are also the steps of the early stopping checks
+        statistics, block = [], []
+
+        with open(output_file, 'wb') as output:
+            for nbest in translations:
+                text = nbest[0].text
+                output.write(text.encode('utf-8'))
                 output.write('\n')
 
-        command = ['perl', self._bleu_script, reference_file]
-        with open(output_file) as input_stream:
-            stdout, _ = shell.execute(command, stdin=input_stream)
+                block.append(text)
+
+                if len(block) == self._tune_check_interval:
+                    statistics.append(bleu.statistics(block, offset=self._tune_check_interval * len(statistics)))
+                    block = []
+
+                    if best_bleu is not None and \
+                            bleu.upper_bound(numpy.concatenate(statistics)) * 100 < best_bleu.value:
+                        return None
+
+        statistics.append(bleu.statistics(block, offset=self._tune_check_interval * len(statistics)))
 
-        return float(stdout) * 100
+        return BLEU.compute(numpy.concatenate(statistics).sum(axis=0)) * 100
 
 
 class NeuralEngineBuilder(EngineBuilder):
@@ -35,7 +35,10 @@ class _DocumentTranslator:
         self.skip_context = False
         self._line_id = 0
 
+        Api.ensure_pool_size(workers)
         self._pool = multithread.Pool(workers)
+        # concurrent translations of the workers are sent to the engine in batches
+        self._coalescer = ClusterNode.TranslationCoalescer(Api)
         self._features = None
 
     def set_skipcontext(self, skip_context):
@@ -61,9 +64,9 @@ class _DocumentTranslator:
         if len(line) > 4096:
             line = line[:4096]
 
-        translation = Api.translate(self.source_lang, self.target_lang, line,
-                                    context=context_vector, nbest=nbest, verbose=True,
-                                    priority=ClusterNode.Api.PRIORITY_BACKGROUND)
+        translation = self._coalescer.translate(self.source_lang, self.target_lang, line,
+                                                context=context_vector, nbest=nbest, verbose=True,
+                                                priority=ClusterNode.Api.PRIORITY_BACKGROUND)
 
         if 'nbest' not in translation or len(translation['nbest']) == 0:
             return {'translation': ''}
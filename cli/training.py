@@ -103,10 +103,11 @@ class Training(EngineBuilder.Listener):
 
 class Tuning(ClusterNode.TuneListener):
     @staticmethod
-    def neural(max_lines=None, lr_delta=0.1, max_epochs=10, gpus=None):
+    def neural(max_lines=None, lr_delta=0.1, max_epochs=10, gpus=None, tuning_modes=None, workers=None):
         return Tuning(lambda node, corpora, listener, debug:
                       node.nmt_tune(corpora=corpora, debug=debug, listener=listener,
-                                    max_lines=max_lines, lr_delta=lr_delta, max_epochs=max_epochs, gpus=gpus), False)
+                                    max_lines=max_lines, lr_delta=lr_delta, max_epochs=max_epochs, gpus=gpus,
+                                    tuning_modes=tuning_modes, workers=workers), False)
 
     @staticmethod
     def phrase_based(context_enabled=True, random_seeds=True, max_iterations=25, accuracy='default'):
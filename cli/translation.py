@@ -93,6 +93,8 @@ class BatchTranslator(Translator):
     def __init__(self, node, context_string=None, context_file=None, context_vector=None,
                  print_nbest=False, nbest_file=None, pool_size=100):
         Translator.__init__(self, node, context_string, context_file, context_vector, print_nbest, nbest_file)
+        self._api.ensure_pool_size(pool_size)
+        self._coalescer = ClusterNode.TranslationCoalescer(self._api)
         self._pool = multithread.Pool(pool_size)
         self._jobs = Queue.Queue(pool_size)
         self._line_id = 0
@@ -104,6 +106,10 @@ class BatchTranslator(Translator):
         result = self._pool.apply_async(self._translate, (line, None))
         self._jobs.put(result, block=True)
 
+    def _translate(self, line, _=None):
+        return self._coalescer.translate(self.source_lang, self.target_lang, line, context=self._context,
+                                         nbest=self._print_nbest, priority=self._priority)
+
     def flush(self):
         self._jobs.put(None, block=True)
 
@@ -138,6 +144,7 @@ class XLIFFTranslator(Translator):
     def __init__(self, node, context_string=None, context_file=None, context_vector=None):
         Translator.__init__(self, node, context_string, context_file, context_vector)
         self._content = []
+        self._api.ensure_pool_size(100)
         self._pool = multithread.Pool(100)
 
         ElementTree.register_namespace('', self.DEFAULT_NAMESPACE)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+import argparse
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(__file__, os.pardir, os.pardir,
+                                                'src', 'decoder-neural', 'src', 'main', 'python')))
+
+from nmmt import MMapDataset
+
+
+def _build(path, sentences, max_length, ram_limit_mb, queue):
+    rand = random.Random(3435)
+
+    begin = time.time()
+
+    builder = MMapDataset.Builder(path, ram_limit_mb=ram_limit_mb)
+    for _ in xrange(sentences):
+        source = [rand.randint(4, 32000) for _ in xrange(rand.randint(1, max_length))]
+        target = [rand.randint(4, 32000) for _ in xrange(rand.randint(1, max_length))]
+        builder.add([source], [target])
+    add_time = time.time() - begin
+
+    begin = time.time()
+    dataset = builder.build()
+    build_time = time.time() - begin
+
+    # ru_maxrss is expressed in kilobytes on Linux
+    peak_ram_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+    queue.put((len(dataset), add_time, build_time, peak_ram_mb))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the MMapDataset builder: wall time and peak RAM '
+                                                 'for different values of ram_limit_mb')
+    parser.add_argument('-n', '--sentences', dest='sentences', type=int, default=1000000,
+                        help='number of random sentence pairs to add (default is 1M)')
+    parser.add_argument('-l', '--max-length', dest='max_length', type=int, default=80,
+                        help='maximum length of the random sentences (default is 80)')
+    parser.add_argument('-r', '--ram-limits', dest='ram_limits', type=int, nargs='+', default=[16, 64, 256, 1024],
+                        help='values of ram_limit_mb to test (default is 16 64 256 1024)')
+    parser.add_argument('-w', '--working-dir', dest='working_dir', default=None,
+                        help='the folder where datasets are built (default is a temporary folder)')
+
+    args = parser.parse_args()
+
+    working_dir = tempfile.mkdtemp(dir=args.working_dir)
+
+    try:
+        print 'RAM_LIMIT (MB)\tSENTENCES\tADD (s)\tBUILD (s)\tPEAK RAM (MB)'
+
+        for ram_limit_mb in args.ram_limits:
+            # every run is executed in a new process, so that its peak RAM is not affected by the previous ones
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=_build, args=(os.path.join(working_dir, str(ram_limit_mb)),
+                                                                   args.sentences, args.max_length,
+                                                                   ram_limit_mb, queue))
+            process.start()
+            size, add_time, build_time, peak_ram_mb = queue.get()
+            process.join()
+
+            print '%d\t%d\t%.2f\t%.2f\t%.1f' % (ram_limit_mb, size, add_time, build_time, peak_ram_mb)
+            sys.stdout.flush()
+
+            shutil.rmtree(os.path.join(working_dir, str(ram_limit_mb)), ignore_errors=True)
+    finally:
+        shutil.rmtree(working_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
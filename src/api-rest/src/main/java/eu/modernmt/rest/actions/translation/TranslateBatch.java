@@ -0,0 +1,130 @@
+package eu.modernmt.rest.actions.translation;
+
+import com.google.gson.JsonArray;
+import com.google.gson.JsonObject;
+import com.google.gson.JsonParseException;
+import eu.modernmt.context.ContextAnalyzerException;
+import eu.modernmt.facade.ModernMT;
+import eu.modernmt.facade.TranslationFacade;
+import eu.modernmt.facade.exceptions.TranslationException;
+import eu.modernmt.lang.LanguagePair;
+import eu.modernmt.model.ContextVector;
+import eu.modernmt.model.Translation;
+import eu.modernmt.persistence.PersistenceException;
+import eu.modernmt.rest.actions.util.ContextUtils;
+import eu.modernmt.rest.framework.HttpMethod;
+import eu.modernmt.rest.framework.Parameters;
+import eu.modernmt.rest.framework.RESTRequest;
+import eu.modernmt.rest.framework.actions.CollectionAction;
+import eu.modernmt.rest.framework.routing.Route;
+import eu.modernmt.rest.model.TranslationResponse;
+
+import java.util.ArrayList;
+import java.util.Collection;
+
+/**
+ * Translates a list of sentences sharing the same language pair and context: the sentences are sent as the JSON
+ * body {"q": [...]}, every other parameter is the same of the "translate" action.
+ * The result is the list of the translations, in the same order of the sentences.
+ */
+@Route(aliases = "translate/batch", method = HttpMethod.POST)
+public class TranslateBatch extends CollectionAction<TranslationResponse> {
+
+    public static final int MAX_BATCH_SIZE = 256;
+
+    @Override
+    protected Collection<TranslationResponse> execute(RESTRequest req, Parameters _params) throws ContextAnalyzerException, PersistenceException, TranslationException {
+        Params params = (Params) _params;
+
+        ContextVector context = params.context;
+        ContextVector resolvedContext = null;
+
+        if (context == null && params.contextString != null) {
+            context = ModernMT.translation.getContextVector(params.direction, params.contextString, params.contextLimit);
+            resolvedContext = context;
+        }
+
+        Translation[] translations = ModernMT.translation.get(params.direction, params.queries, context, params.nbest, params.priority);
+
+        if (resolvedContext != null)
+            ContextUtils.resolve(resolvedContext);
+
+        ArrayList<TranslationResponse> result = new ArrayList<>(translations.length);
+        for (Translation translation : translations) {
+            TranslationResponse response = new TranslationResponse();
+            response.verbose = params.verbose;
+            response.translation = translation;
+            response.context = resolvedContext;
+
+            result.add(response);
+        }
+
+        return result;
+    }
+
+    @Override
+    protected Parameters getParameters(RESTRequest req) throws Parameters.ParameterParsingException {
+        return new Params(req);
+    }
+
+    public static class Params extends Parameters {
+
+        public final LanguagePair direction;
+        public final String[] queries;
+        public final ContextVector context;
+        public final String contextString;
+        public final int contextLimit;
+        public final int nbest;
+        public final TranslationFacade.Priority priority;
+        public final boolean verbose;
+
+        public Params(RESTRequest req) throws ParameterParsingException {
+            super(req);
+
+            JsonObject json = req.getJSONObject();
+            if (json == null || !json.has("q"))
+                throw new ParameterParsingException("q");
+
+            try {
+                JsonArray array = json.getAsJsonArray("q");
+                if (array.size() > MAX_BATCH_SIZE)
+                    throw new ParameterParsingException("q", array.size() + " sentences",
+                            "max batch size of " + MAX_BATCH_SIZE + " exceeded");
+
+                queries = new String[array.size()];
+                for (int i = 0; i < queries.length; i++) {
+                    String query = array.get(i).getAsString();
+                    if (query.length() > Translate.MAX_QUERY_LENGTH)
+                        throw new ParameterParsingException("q", query.substring(0, 10) + "...",
+                                "max query length of " + Translate.MAX_QUERY_LENGTH + " exceeded");
+
+                    queries[i] = query;
+                }
+            } catch (JsonParseException | ClassCastException | IllegalStateException e) {
+                throw new ParameterParsingException("q", e);
+            }
+
+            LanguagePair engineDirection = ModernMT.getNode().getEngine().getLanguages().asSingleLanguagePair();
+            direction = engineDirection != null ?
+                    getLanguagePair("source", "target", engineDirection) :
+                    getLanguagePair("source", "target");
+
+            contextLimit = getInt("context_limit", 10);
+            nbest = getInt("nbest", 0);
+
+            priority = getEnum("priority", TranslationFacade.Priority.class, TranslationFacade.Priority.NORMAL);
+
+            verbose = getBoolean("verbose", false);
+
+            String weights = getString("context_vector", false, null);
+
+            if (weights != null) {
+                context = ContextUtils.parseParameter("context_vector", weights);
+                contextString = null;
+            } else {
+                context = null;
+                contextString = getString("context", false, null);
+            }
+        }
+    }
+}
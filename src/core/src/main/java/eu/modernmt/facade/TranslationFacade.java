@@ -91,6 +91,39 @@ public class TranslationFacade {
         return get(new TranslationTaskImpl(direction, sentence, translationContext, nbest, priority));
     }
 
+    public Translation[] get(LanguagePair direction, String[] sentences, ContextVector translationContext, int nbest, Priority priority) throws TranslationException {
+        ensureLanguagePairIsSupported(direction);
+
+        if (nbest > 0)
+            ensureDecoderSupportsNBest();
+
+        try {
+            ClusterNode node = ModernMT.getNode();
+
+            // all the tasks are submitted before waiting for the first one, so they are decoded in parallel
+            ArrayList<Future<Translation>> futures = new ArrayList<>(sentences.length);
+            for (String sentence : sentences) {
+                TranslationTaskImpl task = new TranslationTaskImpl(direction, sentence, translationContext, nbest, priority);
+
+                Future<Translation> future = node.submit(task, task.direction);
+                if (future == null)
+                    future = node.submit(task);
+
+                futures.add(future);
+            }
+
+            Translation[] translations = new Translation[futures.size()];
+            for (int i = 0; i < translations.length; i++)
+                translations[i] = futures.get(i).get();
+
+            return translations;
+        } catch (InterruptedException e) {
+            throw new SystemShutdownException(e);
+        } catch (ExecutionException e) {
+            throw unwrapException(e);
+        }
+    }
+
     private Translation get(TranslationTaskImpl task) throws TranslationException {
         ensureLanguagePairIsSupported(task.direction);
 
@@ -1,7 +1,10 @@
+import Queue
 import argparse
 import json
 import logging
 import sys
+import threading
+import time
 
 import os
 
@@ -12,12 +15,18 @@ from nmmt import Suggestion, NMTDecoder
 # ======================================================================================================================
 
 class TranslationRequest:
-    def __init__(self, source_lang, target_lang, source, suggestions=None, n_best=None):
+    def __init__(self, source_lang, target_lang, source, suggestions=None, n_best=None, request_id=None):
         self.source_lang = source_lang
         self.target_lang = target_lang
         self.source = source
         self.suggestions = suggestions if suggestions is not None else []
         self.n_best = n_best if n_best > 1 else 1
+        self.request_id = request_id
+
+    @property
+    def batch_key(self):
+        # requests can be decoded together only if they share the same engine and n-best size
+        return self.source_lang, self.target_lang, self.n_best
 
     @staticmethod
     def from_json_string(json_string):
@@ -27,6 +36,7 @@ class TranslationRequest:
         source_language = obj['source_language']
         target_language = obj['target_language']
         n_best = obj['n_best'] if 'n_best' in obj else None
+        request_id = obj['id'] if 'id' in obj else None
 
         suggestions = []
 
@@ -40,18 +50,22 @@ class TranslationRequest:
                 suggestions.append(Suggestion(suggestion_source, suggestion_target, suggestion_score))
                 i += 1
 
-        return TranslationRequest(source_language, target_language, source, suggestions, n_best)
+        return TranslationRequest(source_language, target_language, source, suggestions, n_best, request_id)
 
 
 class TranslationResponse:
-    def __init__(self, translations=None, exception=None):
+    def __init__(self, translations=None, exception=None, request_id=None):
         self.translations = translations
         self.error_type = type(exception).__name__ if exception is not None else None
         self.error_message = str(exception) if exception is not None and str(exception) else None
+        self.request_id = request_id
 
     def to_json_string(self):
         json_root = {}
 
+        if self.request_id is not None:
+            json_root['id'] = self.request_id
+
         if self.translations is not None:
             json_array = []
 
@@ -66,6 +80,9 @@ class TranslationResponse:
                 })
 
             json_root['result'] = json_array
+
+            if len(self.translations) > 0:
+                json_root['origin'] = self.translations[0].origin
         else:
             error = {'type': self.error_type}
             if self.error_message is not None:
@@ -76,37 +93,144 @@ class TranslationResponse:
 
 
 class MainController:
-    def __init__(self, decoder, stdout):
+    def __init__(self, decoder, stdout, batch_size=1, batch_wait=0.):
         self._decoder = decoder
         self._stdin = sys.stdin
         self._stdout = stdout
+        self._batch_size = max(batch_size, 1)
+        self._batch_wait = max(batch_wait, 0.)
 
         self._logger = logging.getLogger('mainloop')
 
     def serve_forever(self):
         try:
+            if self._batch_size > 1:
+                self._serve_batches_forever()
+            else:
+                while True:
+                    line = self._stdin.readline()
+                    if not line:
+                        break
+
+                    response = self.process(line)
+                    self._write(response)
+        except KeyboardInterrupt:
+            pass
+
+    def _write(self, response):
+        self._stdout.write(response.to_json_string())
+        self._stdout.write('\n')
+        self._stdout.flush()
+
+    def _serve_batches_forever(self):
+        # A dedicated thread reads the input stream, so that the main thread can wait
+        # for new requests with a timeout while it is collecting a batch
+        lines = Queue.Queue()
+
+        def _read_forever():
             while True:
-                line = self._stdin.readline()
-                if not line:
+                _line = self._stdin.readline()
+                if not _line:
                     break
+                lines.put(_line)
+            lines.put(None)
 
-                response = self.process(line)
+        reader = threading.Thread(target=_read_forever)
+        reader.daemon = True
+        reader.start()
 
-                self._stdout.write(response.to_json_string())
-                self._stdout.write('\n')
-                self._stdout.flush()
-        except KeyboardInterrupt:
-            pass
+        pending = None
+
+        while True:
+            line = pending if pending is not None else lines.get()
+            pending = None
+
+            if line is None:
+                break
+
+            request = self._parse(line)
+
+            if request is None:
+                continue
+
+            if len(request.suggestions) > 0:
+                self._write(self._process_request(request, line))
+                continue
+
+            # Collect requests compatible with the first one until either the batch is full or the wait window expires
+            batch = [(request, line)]
+            deadline = time.time() + self._batch_wait
+
+            while len(batch) < self._batch_size:
+                try:
+                    line = lines.get(timeout=max(deadline - time.time(), 0.))
+                except Queue.Empty:
+                    break
+
+                if line is None:  # end of stream, serve the current batch before exiting
+                    lines.put(None)
+                    break
+
+                try:
+                    request = TranslationRequest.from_json_string(line)
+                except BaseException:
+                    request = None  # the error response will be sent by the next iteration, preserving the order
+
+                if request is None or len(request.suggestions) > 0 or request.batch_key != batch[0][0].batch_key:
+                    if request is not None:
+                        # the engine of the next request is loaded while the current batch is translated
+                        self._decoder.preload(request.source_lang, request.target_lang)
+
+                    pending = line
+                    break
+
+                batch.append((request, line))
+
+            for response in self._process_batch(batch):
+                self._write(response)
+
+    def _parse(self, line):
+        try:
+            return TranslationRequest.from_json_string(line)
+        except BaseException as e:
+            self._logger.exception('Failed to process request "' + line + '"')
+            self._write(TranslationResponse(exception=e))
+            return None
 
     def process(self, line):
         try:
             request = TranslationRequest.from_json_string(line)
+        except BaseException as e:
+            self._logger.exception('Failed to process request "' + line + '"')
+            return TranslationResponse(exception=e)
+
+        return self._process_request(request, line)
+
+    def _process_request(self, request, line):
+        try:
             translations = self._decoder.translate(request.source_lang, request.target_lang, request.source,
                                                    suggestions=request.suggestions, n_best=request.n_best)
-            return TranslationResponse(translations=translations)
+            return TranslationResponse(translations=translations, request_id=request.request_id)
         except BaseException as e:
             self._logger.exception('Failed to process request "' + line + '"')
-            return TranslationResponse(exception=e)
+            return TranslationResponse(exception=e, request_id=request.request_id)
+
+    def _process_batch(self, batch):
+        if len(batch) == 1:
+            request, line = batch[0]
+            return [self._process_request(request, line)]
+
+        request = batch[0][0]
+
+        try:
+            translations = self._decoder.translate_batch(request.source_lang, request.target_lang,
+                                                         [r.source for r, _ in batch], n_best=request.n_best)
+        except BaseException:
+            # a single faulty request must not fail the whole batch: fallback to one-by-one translation
+            self._logger.exception('Failed to process batch of %d requests, retrying one by one' % len(batch))
+            return [self._process_request(r, l) for r, l in batch]
+
+        return [TranslationResponse(translations=t, request_id=r.request_id) for t, (r, _) in zip(translations, batch)]
 
 
 class JSONLogFormatter(logging.Formatter):
@@ -122,14 +246,6 @@ class JSONLogFormatter(logging.Formatter):
         }).replace('\n', ' ')
 
 
-# TM Decoder
-# ======================================================================================================================
-class _TMDecoder(object):
-    def translate(self, source_lang, target_lang, text, suggestions=None, n_best=1,
-                  tuning_epochs=None, tuning_learning_rate=None):
-        return suggestions[0].target if len(suggestions) > 0 else ''
-
-
 # Main function
 # ======================================================================================================================
 
@@ -142,6 +258,10 @@ def run_main():
                         choices=['critical', 'error', 'warning', 'info', 'debug'], default='info')
     parser.add_argument('-g', '--gpu', type=int, dest='gpu', metavar='GPU', help='the index of the GPU to use',
                         default=None)
+    parser.add_argument('--batch-size', type=int, dest='batch_size', metavar='SIZE', default=1,
+                        help='the maximum number of requests translated together (default is 1, no batching)')
+    parser.add_argument('--batch-wait', type=float, dest='batch_wait', metavar='MILLIS', default=10.,
+                        help='the maximum time in milliseconds spent waiting for a batch to be filled')
 
     args = parser.parse_args()
 
@@ -169,7 +289,7 @@ def run_main():
     # ------------------------------------------------------------------------------------------------------------------
     try:
         decoder = NMTDecoder(args.model, gpu_id=args.gpu, random_seed=3435)
-        controller = MainController(decoder, stdout)
+        controller = MainController(decoder, stdout, batch_size=args.batch_size, batch_wait=args.batch_wait / 1000.)
         stdout.write("ok\n")
         stdout.flush()
         controller.serve_forever()
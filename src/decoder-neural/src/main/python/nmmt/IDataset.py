@@ -1,3 +1,11 @@
+import Queue
+import threading
+
+import torch
+
+from torch_utils import torch_is_using_cuda
+
+
 class IDataset(object):
     class Iterator(object):
         def __iter__(self):
@@ -9,18 +17,108 @@ class IDataset(object):
         def position(self):
             raise NotImplementedError
 
+        def close(self):
+            pass
+
     def __len__(self):
         raise NotImplementedError
 
-    def iterator(self, batch_size, shuffle=True, volatile=False, start_position=0, loop=False, random_seed=1):
+    def iterator(self, batch_size, shuffle=True, volatile=False, start_position=0, loop=False, random_seed=1,
+                 prefetch=0, max_tokens=None):
+        # if 'max_tokens' is set, batches are packed up to that number of padded source+target tokens
+        # instead of 'batch_size' sentences (datasets that are already split into batches ignore it)
         raise NotImplementedError
 
 
+class PrefetchIterator(IDataset.Iterator):
+    """
+    Wraps an IDataset.Iterator and builds its next 'size' batches in a background thread,
+    so that reading and uploading a batch overlaps with the training step of the previous one.
+
+    position() refers to the batches actually returned by next(), not to the ones already
+    prefetched: it can be saved as a checkpoint step and used as 'start_position' to resume.
+    """
+
+    _END = object()
+
+    def __init__(self, iterator, size):
+        self._iterator = iterator
+        self._position = iterator.position()
+        self._queue = Queue.Queue(maxsize=max(size, 1))
+        self._closed = threading.Event()
+        self._exhausted = False
+
+        # CUDA current device is a per-thread setting
+        self._device = torch.cuda.current_device() if torch_is_using_cuda() else None
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._closed.is_set():
+            try:
+                self._queue.put(item, timeout=.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _run(self):
+        if self._device is not None:
+            torch.cuda.set_device(self._device)
+
+        try:
+            while not self._closed.is_set():
+                try:
+                    item = self._iterator.next()
+                except StopIteration:
+                    self._put((self._END, None))
+                    break
+
+                if not self._put((item, None)):
+                    break
+        except BaseException as e:
+            self._put((None, e))
+
+    def __iter__(self):
+        return self
+
+    def __len__(self):
+        return len(self._iterator)
+
+    def next(self):
+        if self._exhausted:
+            raise StopIteration
+
+        item, error = self._queue.get()
+
+        if error is not None:
+            self._exhausted = True
+            raise error
+
+        if item is self._END:
+            self._exhausted = True
+            raise StopIteration
+
+        self._position = item[0] + 1
+        return item
+
+    def position(self):
+        return self._position
+
+    def close(self):
+        self._closed.set()
+        self._thread.join()
+        self._iterator.close()
+
+
 class DatasetWrapper(IDataset):
     def __init__(self, dataset):
         self._dataset = dataset
 
-    def iterator(self, batch_size, shuffle=True, volatile=False, start_position=0, loop=False, random_seed=1):
+    def iterator(self, batch_size, shuffle=True, volatile=False, start_position=0, loop=False, random_seed=1,
+                 prefetch=0, max_tokens=None):
         class _Iterator(IDataset.Iterator):
             def __init__(self, dataset):
                 self._dataset = dataset
@@ -55,7 +153,8 @@ class DatasetWrapper(IDataset):
             def position(self):
                 return self._current_position
 
-        return _Iterator(self._dataset)
+        iterator = _Iterator(self._dataset)
+        return PrefetchIterator(iterator, prefetch) if prefetch > 0 else iterator
 
     def __len__(self):
         return len(self._dataset)
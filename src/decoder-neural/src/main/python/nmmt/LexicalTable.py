@@ -0,0 +1,110 @@
+import numpy
+
+from onmt import Constants
+from MMapTables import TablesFile
+
+
+class LexicalTable(object):
+    """
+    The best translations of every source token (by Dice coefficient) and the most frequent target tokens of a model.
+    """
+
+    _SPECIAL_TOKENS = numpy.array([Constants.PAD, Constants.UNK, Constants.BOS, Constants.EOS], dtype=numpy.int64)
+
+    @staticmethod
+    def build(dataset, src_size, trg_size, candidates=100, frequent=5000, sample_size=200000, min_count=2):
+        """
+        :param dataset: the MMapDataset of the training set
+        :param src_size: the size of the source dictionary
+        :param trg_size: the size of the target dictionary
+        :param candidates: the maximum number of translations kept for every source token
+        :param frequent: the number of most frequent target tokens kept
+        :param sample_size: the number of sentence pairs used to count the co-occurrences
+        :param min_count: the minimum number of co-occurrences of a source and a target token to be kept
+        """
+        src_counts = numpy.zeros(src_size, dtype=numpy.int64)
+        trg_counts = numpy.zeros(trg_size, dtype=numpy.int64)
+        pair_keys, pair_counts = numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+        pending_keys, pending_counts = [], []
+
+        for source, source_lengths, target, target_lengths in dataset.sample(sample_size):
+            chunk_keys = []
+
+            for src, src_length, trg, trg_length in zip(source, source_lengths, target, target_lengths):
+                src = numpy.setdiff1d(src[:src_length], LexicalTable._SPECIAL_TOKENS)
+                trg = numpy.setdiff1d(trg[:trg_length], LexicalTable._SPECIAL_TOKENS)
+
+                src_counts[src] += 1
+                trg_counts[trg] += 1
+                chunk_keys.append((src[:, None] * trg_size + trg[None, :]).reshape(-1))
+
+            keys, counts = numpy.unique(numpy.concatenate(chunk_keys), return_counts=True)
+            pending_keys.append(keys)
+            pending_counts.append(counts)
+
+            # the counts of the chunks are merged when they are as many as the merged ones: the memory taken by the
+            # keys stays bounded, and every count is merged a logarithmic number of times
+            if sum([len(k) for k in pending_keys]) >= len(pair_keys):
+                pair_keys, pair_counts = LexicalTable._merge([pair_keys] + pending_keys, [pair_counts] + pending_counts)
+                pending_keys, pending_counts = [], []
+
+        pair_keys, pair_counts = LexicalTable._merge([pair_keys] + pending_keys, [pair_counts] + pending_counts)
+
+        kept = pair_counts >= min_count
+        pair_keys, pair_counts = pair_keys[kept], pair_counts[kept]
+
+        src_tokens, trg_tokens = pair_keys // trg_size, pair_keys % trg_size
+        scores = 2. * pair_counts / (src_counts[src_tokens] + trg_counts[trg_tokens])
+
+        # the pairs are sorted by source token and decreasing score: the first ones of every source token are kept
+        order = numpy.lexsort((-scores, src_tokens))
+        src_tokens, trg_tokens = src_tokens[order], trg_tokens[order]
+
+        ranks = numpy.arange(len(src_tokens)) - numpy.searchsorted(src_tokens, src_tokens)
+        src_tokens, trg_tokens = src_tokens[ranks < candidates], trg_tokens[ranks < candidates]
+
+        offsets = numpy.zeros(src_size + 1, dtype=numpy.int64)
+        offsets[1:] = numpy.cumsum(numpy.bincount(src_tokens, minlength=src_size))
+
+        frequent_tokens = numpy.argsort(-trg_counts, kind='mergesort')
+        frequent_tokens = frequent_tokens[trg_counts[frequent_tokens] > 0][:frequent]
+
+        return LexicalTable(offsets, trg_tokens.astype(numpy.int64), frequent_tokens.astype(numpy.int64))
+
+    @staticmethod
+    def _merge(keys, counts):
+        # the sum of the counts of every key
+        keys, inverse = numpy.unique(numpy.concatenate(keys), return_inverse=True)
+        return keys, numpy.bincount(inverse, weights=numpy.concatenate(counts)).astype(numpy.int64)
+
+    @staticmethod
+    def load_from_file(path):
+        tables = TablesFile(path)
+        return LexicalTable(tables.array('offsets'), tables.array('candidates'), tables.array('frequent'))
+
+    def __init__(self, offsets, candidates, frequent):
+        self._offsets = offsets  # the candidates of source token i are candidates[offsets[i]:offsets[i + 1]]
+        self._candidates = candidates
+        self._frequent = frequent
+
+    def save_to_file(self, path):
+        TablesFile.save_to_file(path, [
+            ('offsets', self._offsets), ('candidates', self._candidates), ('frequent', self._frequent)
+        ])
+
+    def translations(self, token, limit=None):
+        if token < 0 or token >= len(self._offsets) - 1:
+            return self._candidates[:0]
+
+        start, end = self._offsets[token], self._offsets[token + 1]
+        return self._candidates[start:end if limit is None else min(end, start + limit)]
+
+    def shortlist(self, tokens, candidates, frequent):
+        """
+        :return: the sorted target tokens to score for 'tokens': the special ones, the 'frequent' most frequent ones
+                 and the best 'candidates' translations of every source token
+        """
+        shortlist = [self._SPECIAL_TOKENS, self._frequent[:frequent]]
+        shortlist += [self.translations(token, candidates) for token in set(tokens)]
+
+        return numpy.unique(numpy.concatenate(shortlist))
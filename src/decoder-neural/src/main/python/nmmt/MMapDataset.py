@@ -1,34 +1,35 @@
-import math
+import heapq
 import mmap
 import os
 import random
 import shutil
 import struct
+from collections import defaultdict
 
+import numpy
 import torch
+from torch.autograd import Variable
 
-from onmt import Dataset
-from IDataset import IDataset
+from onmt import Constants
+from IDataset import IDataset, PrefetchIterator
 from torch_utils import torch_is_using_cuda
 
 
 class _HeapIndex:
-    _ENTRY_SIZE = 14
+    _ENTRY = struct.Struct('=HQI')  # word_count, pointer, data_size
+    _ENTRY_SIZE = _ENTRY.size
+    _ENTRY_DTYPE = numpy.dtype([('word_count', numpy.uint16), ('pointer', numpy.uint64), ('data_size', numpy.uint32)])
 
     @staticmethod
     def _serialize(word_count, pointer, data_size):
-        return struct.pack('H', word_count) + struct.pack('Q', pointer) + struct.pack('I', data_size)
+        return _HeapIndex._ENTRY.pack(word_count, pointer, data_size)
 
     @staticmethod
     def _deserialize(raw):
         if not raw:
             return None
 
-        word_count = struct.unpack('H', raw[0:2])[0]
-        pointer = struct.unpack('Q', raw[2:10])[0]
-        data_size = struct.unpack('I', raw[10:14])[0]
-
-        return word_count, pointer, data_size
+        return _HeapIndex._ENTRY.unpack(raw)
 
     def __init__(self, path):
         self._path = path
@@ -72,19 +73,11 @@ class _HeapIndex:
             pointer += self._ENTRY_SIZE
 
     def read(self, index, length):
+        # returns a read-only numpy view of the entries, without copying them from the file
         self._open_for_read()
 
-        pointer = index * self._ENTRY_SIZE
-        result = []
-        for i in xrange(length):
-            raw = self._mmap[pointer:pointer + self._ENTRY_SIZE]
-            pointer += self._ENTRY_SIZE
-
-            result.append(self._deserialize(raw))
-            if pointer >= len(self._mmap):
-                break
-
-        return result
+        length = max(min(length, self._entry_count - index), 0)
+        return numpy.frombuffer(self._mmap, dtype=self._ENTRY_DTYPE, count=length, offset=index * self._ENTRY_SIZE)
 
     def append(self, word_count, pointer, data_size):
         if self._output_stream is None:
@@ -92,79 +85,150 @@ class _HeapIndex:
         self._output_stream.write(self._serialize(word_count, pointer, data_size))
         self._entry_count += 1
 
-    def sort(self, max_ram_in_mb):
-        ram_limit = max_ram_in_mb * 1024 * 1024
-        line_limit = max(int((ram_limit / self._ENTRY_SIZE) * .9), 1)
+    def build_from_buckets(self, buckets, max_ram_in_mb):
+        self._open_for_write()
+        self.flush()
 
-        shard_count = 0
-        word_counts, pointers, data_sizes = [], [], []
+        with open(self._path, 'wb') as out:
+            self._entry_count = buckets.write_sorted(out, max_ram_in_mb)
 
-        for word_count, pointer, data_size in self.read_all():
-            word_counts.append(word_count)
-            pointers.append(pointer)
-            data_sizes.append(data_size)
+    def sort(self, max_ram_in_mb):
+        # Needed only by indexes not built from buckets: sort the index in shards that fit in memory,
+        # then k-way merge them with a heap
+        ram_limit = max_ram_in_mb * 1024 * 1024
+        shard_size = max(int((ram_limit / self._ENTRY_SIZE) * .9), 1) * self._ENTRY_SIZE
 
-            if len(word_counts) >= line_limit:
-                self._store_shard(shard_count, word_counts, pointers, data_sizes)
-                word_counts, pointers, data_sizes = [], [], []
-                shard_count += 1
+        self._open_for_read()
 
-        if len(word_counts) > 0:
-            self._store_shard(shard_count, word_counts, pointers, data_sizes)
-            word_counts, pointers, data_sizes = [], [], []
+        shard_count = 0
+        for offset in xrange(0, len(self._mmap), shard_size):
+            self._store_shard(shard_count, self._mmap[offset:offset + shard_size])
             shard_count += 1
 
         self._open_for_write()
+        self.flush()
+
+        def _read_shard(shard):
+            with open(self._path + ('.%u' % shard), 'rb') as stream:
+                i = 0
+                while True:
+                    raw = stream.read(self._ENTRY_SIZE)
+                    if not raw:
+                        break
 
-        shards = [open(self._path + ('.%u' % shard), 'r') for shard in range(shard_count)]
+                    # entries with the same word count are interleaved among the shards
+                    yield self._deserialize(raw)[0], i, shard, raw
+                    i += 1
 
         with open(self._path, 'wb') as out:
-            head = [self._deserialize(shard.read(self._ENTRY_SIZE)) for shard in shards]
-            head = [x for x in head if x is not None]
+            for _, _, _, raw in heapq.merge(*[_read_shard(shard) for shard in range(shard_count)]):
+                out.write(raw)
 
-            while len(head) > 0:
-                min_size = 0
-                idx_min_size = -1
+        for shard in range(shard_count):
+            os.remove(self._path + ('.%u' % shard))
 
-                for i in range(len(head)):
-                    size = head[i][0]
+    def _store_shard(self, shard, raw):
+        entries = [raw[i:i + self._ENTRY_SIZE] for i in xrange(0, len(raw), self._ENTRY_SIZE)]
+        random.shuffle(entries)
+        entries.sort(key=lambda e: self._ENTRY.unpack(e)[0])
 
-                    if size < min_size or idx_min_size < 0:
-                        idx_min_size = i
-                        min_size = size
+        with open(self._path + ('.%u' % shard), 'wb') as out:
+            out.write(''.join(entries))
 
-                word_count, pointer, data_size = head[idx_min_size]
-                out.write(self._serialize(word_count, pointer, data_size))
+    def flush(self):
+        if self._output_stream is not None:
+            self._output_stream.flush()
+            self._output_stream.close()
+            self._output_stream = None
 
-                head[idx_min_size] = self._deserialize(shards[idx_min_size].read(self._ENTRY_SIZE))
-                if head[idx_min_size] is None:
-                    del head[idx_min_size]
-                    shards[idx_min_size].close()
-                    del shards[idx_min_size]
 
-        for shard in shards:
-            shard.close()
-        for shard in range(shard_count):
-            os.remove(self._path + ('.%u' % shard))
+class _HeapIndexBuckets:
+    """
+    Index entries grouped by word count while they are written: every bucket is kept in memory and it is appended
+    to its own spill file whenever the buffered entries exceed the buffer size. Concatenating the buckets by
+    increasing word count produces the sorted index, without the need of a full sort.
+    """
 
-    def _store_shard(self, shard, word_counts, pointers, data_sizes):
-        perm = torch.randperm(len(word_counts))
+    _MIN_BUFFER_SIZE = 1024 * 1024
 
-        word_counts = [word_counts[idx] for idx in perm]
-        pointers = [pointers[idx] for idx in perm]
-        data_sizes = [data_sizes[idx] for idx in perm]
+    def __init__(self, path, max_ram_in_mb):
+        # a quarter of the memory limit: the rest is left to the chunks shuffled by write_sorted()
+        self._buffer_size = max(max_ram_in_mb * 1024 * 1024 // 4, self._MIN_BUFFER_SIZE)
+        self._path = path
+        self._buffers = defaultdict(bytearray)
+        self._buffered_bytes = 0
+        self._spilled = set()
+
+    def _bucket_path(self, word_count):
+        return self._path + ('.%u' % word_count)
+
+    def append(self, word_count, pointer, data_size):
+        self._buffers[word_count] += _HeapIndex._serialize(word_count, pointer, data_size)
+        self._buffered_bytes += _HeapIndex._ENTRY_SIZE
+
+        if self._buffered_bytes >= self._buffer_size:
+            self.flush()
 
-        _, perm = torch.sort(torch.Tensor(word_counts))
+    def append_entries(self, entries):
+        # bulk version of append(): entries is a numpy array of _HeapIndex._ENTRY_DTYPE
+        for word_count in numpy.unique(entries['word_count']).tolist():
+            self._buffers[word_count] += entries[entries['word_count'] == word_count].tobytes()
 
-        with open(self._path + ('.%u' % shard), 'w') as out:
-            for idx in perm:
-                out.write(self._serialize(word_counts[idx], pointers[idx], data_sizes[idx]))
+        self._buffered_bytes += len(entries) * _HeapIndex._ENTRY_SIZE
+
+        if self._buffered_bytes >= self._buffer_size:
+            self.flush()
 
     def flush(self):
-        if self._output_stream is not None:
-            self._output_stream.flush()
-            self._output_stream.close()
-            self._output_stream = None
+        for word_count, buf in self._buffers.iteritems():
+            with open(self._bucket_path(word_count), 'ab') as out:
+                out.write(buf)
+            self._spilled.add(word_count)
+
+        self._buffers.clear()
+        self._buffered_bytes = 0
+
+    def _read_bucket(self, word_count, chunk_size):
+        if word_count in self._spilled:
+            with open(self._bucket_path(word_count), 'rb') as stream:
+                while True:
+                    chunk = stream.read(chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+
+        if word_count in self._buffers:
+            buf = self._buffers[word_count]
+            for offset in xrange(0, len(buf), chunk_size):
+                yield str(buf[offset:offset + chunk_size])
+
+    def write_sorted(self, out, max_ram_in_mb, random_seed=1):
+        # entries with the same word count are shuffled in chunks that fit in memory, next to the buffered ones
+        ram_limit = max(max_ram_in_mb * 1024 * 1024 - self._buffered_bytes, 0)
+        chunk_size = max(int((ram_limit / _HeapIndex._ENTRY_SIZE) * .9), 1) * _HeapIndex._ENTRY_SIZE
+
+        rand = random.Random(random_seed)
+        entry_count = 0
+
+        for word_count in sorted(self._spilled.union(self._buffers.keys())):
+            for chunk in self._read_bucket(word_count, chunk_size):
+                entries = [chunk[i:i + _HeapIndex._ENTRY_SIZE] for i in xrange(0, len(chunk), _HeapIndex._ENTRY_SIZE)]
+                rand.shuffle(entries)
+
+                out.write(''.join(entries))
+                entry_count += len(entries)
+
+        self.clear()
+
+        return entry_count
+
+    def clear(self):
+        for word_count in self._spilled:
+            os.remove(self._bucket_path(word_count))
+
+        self._spilled.clear()
+        self._buffers.clear()
+        self._buffered_bytes = 0
 
 
 class _HeapData:
@@ -198,7 +262,7 @@ class _HeapData:
         self._mmap = None
 
         if self._output_stream is None:
-            self._output_stream = open(self._path, 'wb')
+            self._output_stream = open(self._path, 'ab')
 
     def _open_for_read(self):
         if self._output_stream is not None:
@@ -225,21 +289,55 @@ class _HeapData:
 
         return word_count, pointer, data_size
 
+    def append_file(self, path):
+        # appends the content of another data file, returns the pointer of its first byte
+        self._open_for_write()
+
+        pointer = self._tail_pointer
+
+        with open(path, 'rb') as stream:
+            shutil.copyfileobj(stream, self._output_stream, 16 * 1024 * 1024)
+        self._tail_pointer += os.path.getsize(path)
+
+        return pointer
+
     def read(self, pointer, data_size):
         self._open_for_read()
 
         raw = self._mmap[pointer:(pointer + data_size)]
         return self._deserialize(raw)
 
-    def read_batch(self, indexes):
+    def read_batch(self, pointers):
+        """
+        Read the entries at the given pointers straight from the memory-mapped file.
+
+        :param pointers: numpy array with the byte offset of every entry
+        :return: source and target padded matrices (batch x max length) and their lengths, as int64 numpy arrays
+        """
         self._open_for_read()
 
-        result = []
-        for _, pointer, data_size in indexes:
-            raw = self._mmap[pointer:(pointer + data_size)]
-            result.append(self._deserialize(raw))
+        # every entry is a sequence of uint32 values, so pointers are always aligned to 4 bytes
+        data = numpy.frombuffer(self._mmap, dtype=numpy.uint32)
 
-        return result
+        source_starts = (pointers // 4).astype(numpy.int64)
+        source_lengths = data[source_starts].astype(numpy.int64)
+        target_starts = source_starts + source_lengths + 1
+        target_lengths = data[target_starts].astype(numpy.int64)
+
+        source = self._gather(data, source_starts + 1, source_lengths)
+        target = self._gather(data, target_starts + 1, target_lengths)
+
+        return source, source_lengths, target, target_lengths
+
+    @staticmethod
+    def _gather(data, starts, lengths):
+        positions = numpy.arange(lengths.max() if len(lengths) > 0 else 0)
+        mask = positions[None, :] < lengths[:, None]
+
+        batch = data[numpy.where(mask, starts[:, None] + positions[None, :], 0)].astype(numpy.int64)
+        batch[~mask] = Constants.PAD
+
+        return batch
 
     def flush(self):
         if self._output_stream is not None:
@@ -249,28 +347,53 @@ class _HeapData:
 
 
 class _Heap:
-    def __init__(self, path):
-        self._idx = _HeapIndex(os.path.join(path, 'heap.idx'))
+    def __init__(self, path, ram_limit_mb=1024):
+        self._path = path
+        self._ram_limit_mb = ram_limit_mb  # bounds the index entries buffered while writing
+        self._idx_path = os.path.join(path, 'heap.idx')
+        self._idx = _HeapIndex(self._idx_path)
         self._data = _HeapData(os.path.join(path, 'heap.dat'))
+        self._buckets = None
 
     def __len__(self):
         return len(self._idx)
 
     def writer(self):
         class _Writer:
-            def __init__(self, idx, data):
-                self._idx = idx
+            def __init__(self, buckets, data):
+                self._buckets = buckets
                 self._data = data
 
             def write(self, source, target):
                 word_count, pointer, data_size = self._data.append(source, target)
-                self._idx.append(word_count, pointer, data_size)
+                self._buckets.append(word_count, pointer, data_size)
 
             def close(self):
-                self._idx.flush()
                 self._data.flush()
 
-        return _Writer(self._idx, self._data)
+        if self._buckets is None:
+            self._buckets = _HeapIndexBuckets(self._idx_path, self._ram_limit_mb)
+
+        return _Writer(self._buckets, self._data)
+
+    def append_heap(self, heap):
+        # data of 'heap' is appended as is: only the pointers of its index entries have to be moved
+        if self._buckets is None:
+            self._buckets = _HeapIndexBuckets(self._idx_path, self._ram_limit_mb)
+
+        heap._data.flush()
+        base_pointer = self._data.append_file(heap._data._path)
+
+        chunk_size = 1024 * 1024
+        for offset in xrange(0, len(heap), chunk_size):
+            entries = heap._idx.read(offset, chunk_size).copy()
+            entries['pointer'] += base_pointer
+            self._buckets.append_entries(entries)
+
+    def build_index(self, ram_limit_mb):
+        if self._buckets is not None:
+            self._idx.build_from_buckets(self._buckets, ram_limit_mb)
+            self._buckets = None
 
     def sort(self, ram_limit_mb):
         self._idx.sort(ram_limit_mb)
@@ -280,16 +403,62 @@ class _Heap:
             yield self._data.read(pointer, data_size)
 
     def read(self, index, length):
-        return self._data.read_batch(self._idx.read(index, length))
+        return self._data.read_batch(self._idx.read(index, length)['pointer'])
+
+    def batch_boundaries(self, max_tokens):
+        """
+        Split the (length-sorted) heap into batches whose padded size, (max source length + max target length)
+        times the number of sentences, is at most 'max_tokens'. A sentence larger than the budget is a batch by itself.
+
+        Boundaries are computed once and stored in a side index next to the heap.
+
+        :return: int64 numpy array with the start of every batch, followed by the length of the heap
+        """
+        path = os.path.join(self._path, 'heap.batches.%d' % max_tokens)
+
+        if os.path.isfile(path):
+            return numpy.fromfile(path, dtype=numpy.int64)
+
+        entry_count = len(self._idx)
+        chunk_size = 1024 * 1024
+
+        boundaries = [0]
+        batch_length = max_source = max_target = 0
+
+        for offset in xrange(0, entry_count, chunk_size):
+            entries = self._idx.read(offset, chunk_size)
+
+            # data entries are [source_len, *source, target_len, *target] as uint32 values
+            sources = entries['word_count'].astype(numpy.int64)
+            targets = entries['data_size'].astype(numpy.int64) // 4 - 2 - sources
+
+            for i, (source, target) in enumerate(zip(sources.tolist(), targets.tolist())):
+                if batch_length > 0 and \
+                        (batch_length + 1) * (max(max_source, source) + max(max_target, target)) > max_tokens:
+                    boundaries.append(offset + i)
+                    batch_length = max_source = max_target = 0
+
+                batch_length += 1
+                max_source, max_target = max(max_source, source), max(max_target, target)
+
+        if entry_count > 0:
+            boundaries.append(entry_count)
+
+        boundaries = numpy.array(boundaries, dtype=numpy.int64)
+        boundaries.tofile(path + '.tmp')
+        os.rename(path + '.tmp', path)
+
+        return boundaries
 
 
 class MMapDataset(IDataset):
     class Builder(object):
-        def __init__(self, path):
+        def __init__(self, path, ram_limit_mb=1024):
             shutil.rmtree(path, ignore_errors=True)
             os.makedirs(path)
 
-            self._heap = _Heap(path)
+            self._ram_limit_mb = ram_limit_mb
+            self._heap = _Heap(path, ram_limit_mb)
             self._heap_writer = None
 
         def add(self, sources, targets):
@@ -299,9 +468,20 @@ class MMapDataset(IDataset):
             for source, target in zip(sources, targets):
                 self._heap_writer.write(source, target)
 
-        def build(self, ram_limit_mb=1024):
-            self._heap_writer.close()
-            self._heap.sort(ram_limit_mb)
+        def add_dataset(self, dataset):
+            """
+            Append all the entries of another dataset, for example a shard built in parallel by a different process.
+            The data file is copied as a whole, without decoding its entries.
+            """
+            if self._heap_writer is None:
+                self._heap_writer = self._heap.writer()
+
+            self._heap.append_heap(dataset._heap)
+
+        def build(self, ram_limit_mb=None):
+            if self._heap_writer is not None:
+                self._heap_writer.close()
+            self._heap.build_index(ram_limit_mb if ram_limit_mb is not None else self._ram_limit_mb)
 
             return MMapDataset(self._heap)
 
@@ -315,23 +495,49 @@ class MMapDataset(IDataset):
     def __len__(self):
         return len(self._heap)
 
-    def iterator(self, batch_size, shuffle=True, volatile=False, start_position=0, loop=False, random_seed=1):
-        return _Iterator(self._heap, batch_size,
-                         shuffle=shuffle, volatile=volatile, start_position=start_position, loop=loop,
-                         random_seed=random_seed)
+    def iterator(self, batch_size, shuffle=True, volatile=False, start_position=0, loop=False, random_seed=1,
+                 prefetch=0, max_tokens=None):
+        if max_tokens is None:
+            boundaries = numpy.append(numpy.arange(0, len(self._heap), batch_size, dtype=numpy.int64), len(self._heap))
+            boundaries = boundaries if len(self._heap) > 0 else boundaries[:1]
+        else:
+            boundaries = self._heap.batch_boundaries(max_tokens)
+
+        iterator = _Iterator(self._heap, boundaries,
+                             shuffle=shuffle, volatile=volatile, start_position=start_position, loop=loop,
+                             random_seed=random_seed, pin_memory=(prefetch > 0))
+        return PrefetchIterator(iterator, prefetch) if prefetch > 0 else iterator
+
+    def sample(self, size, chunk_size=1000):
+        """
+        :return: an iterator of (source, source_lengths, target, target_lengths) numpy arrays of about 'size' entries,
+                 read in chunks of 'chunk_size' contiguous entries spread over the whole (length-sorted) dataset
+        """
+        count = len(self._heap)
+
+        if size >= count:
+            starts = range(0, count, chunk_size)
+        else:
+            chunks = max(size // chunk_size, 1)
+            starts = numpy.linspace(0, max(count - chunk_size, 0), chunks).astype(numpy.int64)
+
+        for start in starts:
+            yield self._heap.read(int(start), chunk_size)
 
 
 class _Iterator(IDataset.Iterator):
-    def __init__(self, heap, batch_size, shuffle=True, volatile=False, start_position=0, loop=False, random_seed=1):
+    def __init__(self, heap, boundaries, shuffle=True, volatile=False, start_position=0, loop=False, random_seed=1,
+                 pin_memory=False):
         self._heap = heap
-        self._batch_size = batch_size
-        self._batch_count = int(math.ceil(float(len(heap)) / batch_size))
+        self._boundaries = boundaries
+        self._batch_count = len(boundaries) - 1
         self._shuffle = shuffle
         self._random_seed = random_seed
         self._loop = loop
-
-        self._dataset = Dataset([], [], batch_size, torch_is_using_cuda(), volatile=volatile, data_type="text")
-        self._dataset.numBatches = 1
+        self._volatile = volatile
+        self._cuda = torch_is_using_cuda()
+        # page-locked host buffers let the upload run asynchronously with respect to the GPU
+        self._pin_memory = pin_memory and self._cuda
 
         self._current_batch_order = None
         self._current_position = None
@@ -350,16 +556,29 @@ class _Iterator(IDataset.Iterator):
     def __len__(self):
         return self._batch_count
 
+    def _wrap(self, batch):
+        batch = torch.from_numpy(numpy.ascontiguousarray(batch.T))
+        if self._pin_memory:
+            batch = batch.pin_memory().cuda(async=True)
+        elif self._cuda:
+            batch = batch.cuda()
+        return Variable(batch, volatile=self._volatile)
+
     def __getitem__(self, index):
         if index < 0 or index >= self._batch_count:
             raise IndexError('dataset index out of bound')
 
-        batch = self._heap.read(index * self._batch_size, self._batch_size)
+        start, end = self._boundaries[index], self._boundaries[index + 1]
+        source, source_lengths, target, _ = self._heap.read(int(start), int(end - start))
+
+        # within batch sorting by decreasing length for variable length rnns
+        indices = numpy.argsort(-source_lengths, kind='mergesort')
+        source, source_lengths, target = source[indices], source_lengths[indices], target[indices]
 
-        self._dataset.src = [torch.LongTensor(x[0]) for x in batch]
-        self._dataset.tgt = [torch.LongTensor(x[1]) for x in batch]
+        # wrap lengths in a Variable to properly split it in DataParallel
+        lengths = Variable(torch.from_numpy(source_lengths).view(1, -1), volatile=self._volatile)
 
-        return self._dataset.__getitem__(0)
+        return (self._wrap(source), lengths), self._wrap(target), tuple(indices.tolist())
 
     def __iter__(self):
         return self
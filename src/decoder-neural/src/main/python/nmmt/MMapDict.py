@@ -0,0 +1,81 @@
+import numpy
+
+from onmt import Dict
+from MMapTables import TablesFile
+
+
+class MMapDict(Dict):
+    """
+    Read-only replacement of onmt.Dict backed by a TablesFile: labels are in a StringTable, together with the
+    index of every label and the position in the table of every index. Once pickled (e.g. by torch.save)
+    it becomes a regular onmt.Dict.
+    """
+
+    @staticmethod
+    def save_to_file(path, dictionaries):
+        """
+        :param path: the output file
+        :param dictionaries: map from name to onmt.Dict, as for the 'vcb' files
+        """
+        tables = []
+
+        for name, dictionary in dictionaries.iteritems():
+            labels = [dictionary.getLabel(i) for i in xrange(dictionary.size())]
+            strings, sorted_labels = TablesFile.strings_tables(name + '.labels', labels)
+
+            positions = dict([(label, i) for i, label in enumerate(sorted_labels)])
+            positions = numpy.array([positions[l.decode('utf-8') if isinstance(l, str) else l] for l in labels],
+                                    dtype=numpy.int64)
+
+            tables += strings
+            tables.append((name + '.indexes', numpy.argsort(positions).astype(numpy.int64)))
+            tables.append((name + '.positions', positions))
+            tables.append((name + '.lower', numpy.array([1 if dictionary.lower else 0], dtype=numpy.uint8)))
+
+        TablesFile.save_to_file(path, tables)
+
+    @staticmethod
+    def load_from_file(path):
+        tables = TablesFile(path)
+        names = set([name[:-len('.indexes')] for name in tables.names() if name.endswith('.indexes')])
+
+        return dict([(name, MMapDict(tables, name)) for name in names])
+
+    def __init__(self, tables, name):
+        # onmt.Dict constructor is not called: its maps are replaced by the tables
+        self.lower = bool(tables.array(name + '.lower')[0])
+        self.special = []
+
+        self._labels = tables.strings(name + '.labels')
+        self._indexes = tables.array(name + '.indexes')
+        self._positions = tables.array(name + '.positions')
+
+    def __reduce__(self):
+        labels = [self.getLabel(i) for i in xrange(self.size())]
+
+        state = {
+            'idxToLabel': dict(enumerate(labels)),
+            'labelToIdx': dict([(label, i) for i, label in enumerate(labels)]),
+            'frequencies': {},
+            'lower': self.lower,
+            'special': []
+        }
+
+        return Dict, (), state
+
+    def size(self):
+        return len(self._labels)
+
+    def lookup(self, key, default=None):
+        key = key.lower() if self.lower else key
+        position = self._labels.index(key)
+        return int(self._indexes[position]) if position >= 0 else default
+
+    def getLabel(self, idx, default=None):
+        idx = int(idx)
+        if idx < 0 or idx >= len(self._labels):
+            return default
+        return self._labels[int(self._positions[idx])]
+
+    def add(self, label, idx=None):
+        raise NotImplementedError('MMapDict is read-only')
@@ -0,0 +1,165 @@
+import mmap
+import os
+import struct
+
+import numpy
+
+
+class TablesFile:
+    """
+    A binary file with a collection of named numpy arrays, read-only and memory-mapped: the arrays are views on the
+    file itself, so nothing is loaded at opening time and processes reading the same file share its pages.
+
+    If opened copy-on-write, the arrays can be written too: the pages that are changed become private to the
+    process, the file and the other processes are not affected.
+    """
+
+    _MAGIC = 'MMTTBL02'
+    _HEADER = struct.Struct('=8sIQ')  # magic, table count, size of the names
+    _TABLE = struct.Struct('=QI8sQQ')  # name offset, name length, dtype, offset, length
+    _ALIGNMENT = 64  # tables start on a cache line
+
+    @staticmethod
+    def save_to_file(path, tables):
+        """
+        :param path: the output file
+        :param tables: list of (name, numpy array) pairs
+        """
+        # names have any length: they are concatenated after the tables entries
+        names = [name.encode('utf-8') if isinstance(name, unicode) else name for name, _ in tables]
+        names_size = sum([len(name) for name in names])
+
+        offset = TablesFile._HEADER.size + TablesFile._TABLE.size * len(tables) + names_size
+
+        entries = []
+        for name, (_, array) in zip(names, tables):
+            offset += -offset % TablesFile._ALIGNMENT
+            entries.append((name, array, offset))
+            offset += array.nbytes
+
+        try:
+            with open(path + '.tmp', 'wb') as out:
+                out.write(TablesFile._HEADER.pack(TablesFile._MAGIC, len(tables), names_size))
+
+                name_offset = 0
+                for name, array, offset in entries:
+                    out.write(TablesFile._TABLE.pack(name_offset, len(name), array.dtype.str, offset, len(array)))
+                    name_offset += len(name)
+
+                out.write(''.join(names))
+
+                for name, array, offset in entries:
+                    out.write('\0' * (offset - out.tell()))
+                    out.write(numpy.ascontiguousarray(array).tostring())
+        except BaseException:
+            if os.path.isfile(path + '.tmp'):
+                os.remove(path + '.tmp')
+            raise
+
+        os.rename(path + '.tmp', path)
+
+    @staticmethod
+    def strings_tables(name, strings):
+        """
+        Serialize a collection of strings as a sorted string table: the utf-8 bytes of all the strings, sorted and
+        concatenated, and the offset of each one of them.
+
+        :return: the list of tables and the sorted list of strings, whose indexes are the ones of the table
+        """
+        encoded = sorted(set([s.encode('utf-8') if isinstance(s, unicode) else s for s in strings]))
+
+        offsets = numpy.zeros(len(encoded) + 1, dtype=numpy.uint64)
+        offsets[1:] = numpy.cumsum([len(s) for s in encoded], dtype=numpy.uint64)
+        data = numpy.frombuffer(''.join(encoded), dtype=numpy.uint8) if len(encoded) > 0 else \
+            numpy.zeros(0, dtype=numpy.uint8)
+
+        return [(name + '.data', data), (name + '.offsets', offsets)], [s.decode('utf-8') for s in encoded]
+
+    def __init__(self, path, copy_on_write=False):
+        self._path = path
+        self._stream = open(path, 'rb')
+        access = mmap.ACCESS_COPY if copy_on_write else mmap.ACCESS_READ
+        self._mmap = mmap.mmap(self._stream.fileno(), 0, access=access)
+
+        if self._mmap[:8] != self._MAGIC:
+            raise IOError('invalid tables file: %s' % path)
+
+        self._tables = self._read_entries()
+
+    def _read_entries(self):
+        _, count, _ = self._HEADER.unpack(self._mmap[:self._HEADER.size])
+        names_start = self._HEADER.size + count * self._TABLE.size
+
+        tables = {}
+        for i in xrange(count):
+            start = self._HEADER.size + i * self._TABLE.size
+            name_offset, name_length, dtype, offset, length = \
+                self._TABLE.unpack(self._mmap[start:start + self._TABLE.size])
+
+            name = self._mmap[names_start + name_offset:names_start + name_offset + name_length]
+            tables[name] = (numpy.dtype(dtype.rstrip('\0')), offset, length)
+
+        return tables
+
+    def __contains__(self, name):
+        return name in self._tables
+
+    def names(self):
+        return self._tables.keys()
+
+    def array(self, name):
+        dtype, offset, length = self._tables[name]
+        return numpy.frombuffer(self._mmap, dtype=dtype, count=length, offset=offset)
+
+    def strings(self, name):
+        _, data_offset, _ = self._tables[name + '.data']
+        _, offsets_offset, length = self._tables[name + '.offsets']
+        return StringTable(self._mmap, data_offset, offsets_offset, length - 1)
+
+
+class StringTable(object):
+    """
+    A sorted collection of strings in a memory-mapped buffer; the index of a string is its position in the table.
+    Lookups are binary searches on the buffer, strings are decoded only when they are returned.
+    """
+
+    _OFFSETS = struct.Struct('=QQ')  # start and end of a string, read together from the array of uint64 offsets
+
+    def __init__(self, buf, data_offset, offsets_offset, size):
+        self._buffer = buf
+        self._data_offset = data_offset
+        self._offsets_offset = offsets_offset
+        self._size = size
+
+    def __len__(self):
+        return self._size
+
+    def _bytes(self, i):
+        start, end = self._OFFSETS.unpack_from(self._buffer, self._offsets_offset + 8 * i)
+        return self._buffer[self._data_offset + start:self._data_offset + end]
+
+    def __getitem__(self, i):
+        if i < 0 or i >= self._size:
+            raise IndexError('string table index out of range')
+        return self._bytes(i).decode('utf-8')
+
+    def __iter__(self):
+        for i in xrange(self._size):
+            yield self._bytes(i).decode('utf-8')
+
+    def __contains__(self, string):
+        return self.index(string) >= 0
+
+    def index(self, string, default=-1):
+        if isinstance(string, unicode):
+            string = string.encode('utf-8')
+
+        low, high = 0, self._size
+        while low < high:
+            middle = (low + high) // 2
+            if self._bytes(middle) < string:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low if low < self._size and self._bytes(low) == string else default
@@ -0,0 +1,194 @@
+import fcntl
+import glob
+import hashlib
+import os
+import tempfile
+import threading
+
+import numpy
+import torch
+
+from MMapTables import TablesFile
+
+
+class MMapWeights(object):
+    """
+    The weights of a model in a TablesFile: every tensor is stored as a table with its values and one with its shape.
+
+    Tensors are mapped copy-on-write, hence the processes mapping the same file share a single copy of the weights
+    in memory: a process gets a private copy only of the pages it changes (e.g. the rows updated by tuning).
+    """
+
+    # segments published by this process: path -> [lock file, tables, number of MMapWeights using them]
+    _published = {}
+    _published_lock = threading.Lock()
+
+    @staticmethod
+    def save_to_file(path, state_dicts):
+        """
+        :param path: the output file
+        :param state_dicts: map from name to state dict, as for the 'dat' files
+        """
+        tables = []
+
+        for prefix, state_dict in sorted(state_dicts.iteritems()):
+            for name, tensor in sorted(state_dict.iteritems()):
+                array = tensor.cpu().numpy()
+                array = numpy.ascontiguousarray(array, dtype=array.dtype.newbyteorder('<'))
+
+                tables.append((prefix + '.' + name, array.reshape(-1)))
+                tables.append((prefix + '.' + name + '.shape', numpy.array(array.shape, dtype=numpy.int64)))
+
+        TablesFile.save_to_file(path, tables)
+
+    @staticmethod
+    def load_from_file(path):
+        return MMapWeights(TablesFile(path, copy_on_write=True))
+
+    @staticmethod
+    def publish(data_file, directory=None):
+        """
+        Publish the weights of a checkpoint in a shared memory segment, unless it has already been done by another
+        process, and map them: processes loading the same checkpoint share a single copy of its weights.
+
+        Every process mapping a segment holds a shared lock on its '.lock' file: the segment is removed by the last
+        one releasing it (see release()), or later by publish() if that process did not (e.g. it was killed).
+        Within a process, the segment is mapped once and shared by all the MMapWeights publishing it.
+
+        :param data_file: the 'dat' file of the checkpoint
+        :param directory: where the segment is created, by default '/dev/shm' if available
+        :return: the MMapWeights of the checkpoint
+        """
+        if directory is None:
+            directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+        # the segment is identified by the checkpoint file and its version
+        stat = os.stat(data_file)
+        digest = hashlib.md5('%s:%d:%d' % (os.path.abspath(data_file), stat.st_size, stat.st_mtime)).hexdigest()
+        path = os.path.join(directory, 'nmmt-weights-' + digest)
+
+        with MMapWeights._published_lock:
+            # the segments mapped by this process are locked, hence they are not removed
+            MMapWeights._remove_unused_segments(directory)
+
+            segment = MMapWeights._published.get(path, None)
+
+            if segment is None:
+                lock, tables = MMapWeights._map_segment(data_file, path)
+                segment = MMapWeights._published[path] = [lock, tables, 0]
+
+            segment[2] += 1
+
+        return MMapWeights(segment[1], path=path)
+
+    @staticmethod
+    def _map_segment(data_file, path):
+        while True:
+            lock = open(path + '.lock', 'ab')
+
+            try:
+                # processes starting together wait for the first one to publish the weights
+                fcntl.flock(lock, fcntl.LOCK_EX)
+
+                if not MMapWeights._is_linked(lock, path + '.lock'):
+                    lock.close()
+                    continue  # the segment has been removed by its last user while waiting for the lock
+
+                if not os.path.isfile(path):
+                    checkpoint = torch.load(data_file, map_location=lambda storage, loc: storage)
+                    MMapWeights.save_to_file(path, checkpoint)
+
+                tables = TablesFile(path, copy_on_write=True)
+
+                # the conversion to a shared lock is not atomic: the segment could have been removed in the meantime
+                fcntl.flock(lock, fcntl.LOCK_SH)
+
+                if not MMapWeights._is_linked(lock, path + '.lock') or not os.path.isfile(path):
+                    lock.close()
+                    continue
+
+                return lock, tables
+            except BaseException:
+                lock.close()
+                raise
+
+    @staticmethod
+    def _is_linked(lock, lock_path):
+        # False if the locked file is not the one at lock_path anymore, i.e. it has been removed
+        try:
+            return os.fstat(lock.fileno()).st_ino == os.stat(lock_path).st_ino
+        except OSError:
+            return False
+
+    @staticmethod
+    def _remove_if_unused(lock, path):
+        # the exclusive lock is granted only if no other process holds a shared one, i.e. maps the segment
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            return
+
+        if MMapWeights._is_linked(lock, path + '.lock'):
+            for f in (path, path + '.tmp', path + '.lock'):
+                if os.path.exists(f):
+                    os.remove(f)
+
+    @staticmethod
+    def _remove_unused_segments(directory):
+        for lock_path in glob.glob(os.path.join(directory, 'nmmt-weights-*.lock')):
+            try:
+                with open(lock_path, 'ab') as lock:
+                    MMapWeights._remove_if_unused(lock, lock_path[:-len('.lock')])
+            except (IOError, OSError):
+                pass  # e.g. removed by another process in the meantime
+
+    def __init__(self, tables, path=None):
+        self._tables = tables
+        self._path = path  # the shared memory segment, if published
+
+    def release(self):
+        """
+        Release the weights: if published in a shared memory segment and no other process maps it, the segment is
+        removed. Its memory is freed as soon as the tensors still mapping it are garbage collected.
+        """
+        self._tables = None
+
+        if self._path is not None:
+            path, self._path = self._path, None
+
+            with MMapWeights._published_lock:
+                segment = MMapWeights._published[path]
+                segment[2] -= 1
+
+                if segment[2] == 0:
+                    del MMapWeights._published[path]
+
+                    try:
+                        self._remove_if_unused(segment[0], path)
+                    finally:
+                        segment[0].close()
+
+    def tensor(self, name):
+        shape = tuple(int(x) for x in self._tables.array(name + '.shape'))
+        return torch.from_numpy(self._tables.array(name).reshape(shape))
+
+    def _bind_module(self, module, prefix):
+        parameters = dict(module.named_parameters())
+
+        for name, value in module.state_dict().iteritems():
+            if prefix == 'model' and 'generator' in name:
+                continue  # the generator is bound on its own, as it is stored separately
+
+            tensor = self.tensor(prefix + '.' + name)
+
+            if name in parameters:
+                parameters[name].data = tensor
+            else:
+                value.copy_(tensor)  # buffers are not shared
+
+    def bind(self, model, generator):
+        """
+        Replace the parameters of model and generator with the mapped tensors: no weights are copied.
+        """
+        self._bind_module(model, 'model')
+        self._bind_module(generator, 'generator')
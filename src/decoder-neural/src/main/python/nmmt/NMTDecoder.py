@@ -1,9 +1,16 @@
+import Queue
 import logging
+import threading
+from collections import OrderedDict
+
 import os
+import torch
 
 from nmmt.NMTEngine import NMTEngine
+from nmmt.TranslationCache import TranslationCache
+from nmmt.models import Translation
 from nmmt.internal_utils import log_timed_action
-from nmmt.torch_utils import torch_setup
+from nmmt.torch_utils import torch_setup, torch_is_using_cuda
 
 import ConfigParser
 
@@ -13,6 +20,257 @@ class UnsupportedLanguageException(BaseException):
         self.message = "No engine and text processors found for %s -> %s." % (source_language, target_language)
 
 
+class _ResidencyManager:
+    """
+    It moves the engines among running states (HOT: on GPU, WARM: in host memory, COLD: not loaded),
+    keeping the number of engines and the memory they take within the given limits (None means unbounded).
+    When an engine needs room, the least recently used engines are demoted first.
+
+    The memory of an engine is measured from count_parameters() the first time it is loaded;
+    until then, the largest size seen so far is used as an estimate.
+
+    COLD engines can be loaded in host memory by a background thread (see preload()),
+    so that reading a checkpoint from disk does not block translations with the other engines.
+
+    At startup, engines are registered in order of importance and loaded concurrently (see load()): the running
+    states are still assigned in order of importance, each engine getting the best one that fits.
+    """
+
+    _BYTES_PER_PARAMETER = 4  # weights are float32
+
+    def __init__(self, engines, hot_size=None, warm_size=None, gpu_memory=None, host_memory=None):
+        self._logger = logging.getLogger('nmmt.NMTDecoder')
+        self._engines = engines
+        self._hot_size = hot_size
+        self._warm_size = warm_size
+        self._gpu_memory = gpu_memory
+        self._host_memory = host_memory
+
+        self._last_used = {}
+        self._clock = 0
+        self._sizes = {}
+        self._loading = {}  # engines being loaded in background, with their completion event
+        self._reserved = {}  # target state of the engines being loaded at startup
+        self._order = {}  # position of the engines in the configuration
+        self._placed = 0  # number of engines whose state has been assigned at startup
+        self._errors = {}  # engines that failed to load, with their exception
+
+        self._lock = threading.RLock()
+        self._turns = threading.Condition(self._lock)
+        self._queue = Queue.Queue()
+        self._worker = None
+
+    def _size(self, key):
+        if key in self._sizes:
+            return self._sizes[key]
+        return max(self._sizes.values()) if len(self._sizes) > 0 else 0
+
+    def _measure(self, key):
+        self._sizes[key] = self._engines[key].count_parameters() * self._BYTES_PER_PARAMETER
+
+    def _state(self, key):
+        return self._reserved[key] if key in self._reserved else self._engines[key].running_state
+
+    def _residents(self, state, exclude):
+        return [key for key in self._last_used if key != exclude and key in self._engines and self._state(key) == state]
+
+    def _gpu_exceeded(self, key):
+        hot = self._residents(NMTEngine.HOT, key)
+
+        if self._hot_size is not None and len(hot) >= self._hot_size:
+            return True
+        if self._gpu_memory is not None and sum([self._size(k) for k in hot]) + self._size(key) > self._gpu_memory:
+            return True
+        return False
+
+    def _host_exceeded(self, key):
+        warm = self._residents(NMTEngine.WARM, key)
+
+        if self._warm_size is not None and len(warm) >= self._warm_size:
+            return True
+        if self._host_memory is not None and sum([self._size(k) for k in warm]) + self._size(key) > self._host_memory:
+            return True
+        return False
+
+    def _exceeded(self, key, state):
+        if state == NMTEngine.HOT:
+            return self._gpu_exceeded(key)
+        return self._host_exceeded(key)
+
+    def _victim(self, state, key, older_than=None):
+        candidates = [k for k in self._residents(state, key) if k not in self._loading and
+                      (older_than is None or self._last_used[k] < older_than)]
+        return min(candidates, key=lambda k: self._last_used[k]) if len(candidates) > 0 else None
+
+    def _make_room(self, key, state, older_than=None):
+        # demote the least recently used engines until 'key' fits in 'state': if 'older_than' is given, only the
+        # engines less important than that are demoted, and the result tells whether 'key' fits in 'state'
+        if state == NMTEngine.HOT:
+            while self._gpu_exceeded(key):
+                victim = self._victim(NMTEngine.HOT, key, older_than)
+                if victim is None:
+                    break
+
+                # make room for the demoted engine among the WARM ones
+                if older_than is None:
+                    self._make_room(victim, NMTEngine.WARM)
+                    self._engines[victim].running_state = NMTEngine.WARM
+                elif self._make_room(victim, NMTEngine.WARM, self._last_used[victim]):
+                    self._engines[victim].running_state = NMTEngine.WARM
+                else:
+                    self._engines[victim].running_state = NMTEngine.COLD
+        else:
+            while self._host_exceeded(key):
+                victim = self._victim(NMTEngine.WARM, key, older_than)
+                if victim is None:
+                    break
+                self._engines[victim].running_state = NMTEngine.COLD
+
+        exceeded = self._exceeded(key, state)
+        if exceeded and older_than is None:
+            self._logger.warning('Model limits exceeded by "%s" model' % key)
+
+        return not exceeded
+
+    def _best_state(self, key, states):
+        for state in states:
+            if self._make_room(key, state, older_than=self._last_used[key]):
+                return state
+        return NMTEngine.COLD
+
+    def log_states(self):
+        states = {NMTEngine.HOT: [], NMTEngine.WARM: [], NMTEngine.COLD: []}
+        for key in sorted(self._last_used, key=lambda k: self._last_used[k], reverse=True):
+            if key in self._engines:
+                states[self._engines[key].running_state].append(key)
+
+        self._logger.debug("Running states of the models: hot:%s, warm:%s, cold:%s" %
+                           (states[NMTEngine.HOT], states[NMTEngine.WARM], states[NMTEngine.COLD]))
+
+    def register(self, key):
+        # engines must be registered from the most to the least important one, before being loaded:
+        # until load() is completed, acquire() waits for the engine
+        with self._lock:
+            self._order[key] = len(self._order)
+            self._last_used[key] = -len(self._last_used)
+            self._loading[key] = threading.Event()
+
+    def load(self, key, loader, size=None):
+        """
+        Create a registered engine with 'loader' and bring it to the best running state that fits, demoting only
+        the engines less important than this one. Can be called concurrently for different engines.
+
+        The 'size' in bytes of the engine, if known in advance, makes the choice of its state more accurate.
+        """
+        try:
+            engine, state = None, NMTEngine.COLD
+
+            try:
+                engine = loader()
+            finally:
+                # states are assigned in order of importance, even if the engines are created in a different order
+                with self._turns:
+                    while self._placed < self._order[key]:
+                        self._turns.wait()
+
+                    if engine is not None:
+                        if size is not None:
+                            self._sizes[key] = size
+                        self._engines[key] = engine
+                        state = self._reserved[key] = self._best_state(key, [NMTEngine.HOT, NMTEngine.WARM])
+
+                    self._placed += 1
+                    self._turns.notify_all()
+
+            # the lock is not held while loading: the reserved state is accounted in place of the actual one
+            engine.running_state = state
+
+            with self._lock:
+                del self._reserved[key]
+
+                if state != NMTEngine.COLD:
+                    # the actual size of the engine can be different from the estimated one
+                    self._measure(key)
+
+                    if not self._make_room(key, state, older_than=self._last_used[key]):
+                        engine.running_state = self._best_state(key, [NMTEngine.WARM] if state == NMTEngine.HOT else [])
+        except BaseException as e:
+            self._logger.exception('Failed to load "%s" model' % key)
+            with self._lock:
+                self._errors[key] = e
+        finally:
+            with self._lock:
+                self._reserved.pop(key, None)
+                self._loading.pop(key).set()
+                self.log_states()
+
+    def acquire(self, key):
+        with self._lock:
+            event = self._loading.get(key, None)
+
+        if event is not None:
+            with log_timed_action(self._logger, 'Waiting for "%s" model to be loaded' % key, log_start=False):
+                event.wait()
+
+        with self._lock:
+            if key in self._errors:
+                raise self._errors[key]
+
+            self._clock += 1
+            self._last_used[key] = self._clock
+
+            engine = self._engines[key]
+
+            if engine.running_state != NMTEngine.HOT:
+                with log_timed_action(self._logger, 'Upgrading "%s" model' % key):
+                    self._make_room(key, NMTEngine.HOT)
+                    engine.running_state = NMTEngine.HOT
+
+                    # the actual size of the engine can be different from the estimated one
+                    self._measure(key)
+                    self._make_room(key, NMTEngine.HOT)
+
+            self.log_states()
+
+        return engine
+
+    def preload(self, key):
+        with self._lock:
+            if key in self._loading or key not in self._engines or self._engines[key].running_state != NMTEngine.COLD:
+                return
+
+            self._loading[key] = threading.Event()
+
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._preload_forever)
+                self._worker.daemon = True
+                self._worker.start()
+
+        self._queue.put(key)
+
+    def _preload_forever(self):
+        while True:
+            key = self._queue.get()
+
+            try:
+                with self._lock:
+                    self._make_room(key, NMTEngine.WARM)
+
+                # the lock is not held while loading: until its event is set,
+                # the engine can be neither acquired nor demoted by other threads
+                with log_timed_action(self._logger, 'Preloading "%s" model' % key):
+                    self._engines[key].running_state = NMTEngine.WARM
+
+                with self._lock:
+                    self._measure(key)
+                    self._make_room(key, NMTEngine.WARM)
+            except BaseException:
+                self._logger.exception('Failed to preload "%s" model' % key)
+            finally:
+                with self._lock:
+                    self._loading.pop(key).set()
+
+
 class NMTDecoder:
     @staticmethod
     def _get_int(settings, section, option, default):
@@ -23,100 +281,224 @@ class NMTDecoder:
         except ConfigParser.NoOptionError:
             return default
 
+    @staticmethod
+    def _get_float(settings, section, option, default):
+        try:
+            return settings.getfloat(section, option)
+        except ConfigParser.NoSectionError:
+            return default
+        except ConfigParser.NoOptionError:
+            return default
+
+    @staticmethod
+    def _key(source_lang, target_lang, variant=None):
+        key = source_lang + '__' + target_lang
+        if variant is not None:
+            key += "__" + variant
+        return key
+
     def __init__(self, model_path, gpu_id=None, random_seed=None):
         torch_setup(gpus=[gpu_id] if gpu_id is not None else None, random_seed=random_seed)
 
         self._logger = logging.getLogger('nmmt.NMTDecoder')
-        self._engines, self._engines_checkpoint = {}, {}
-        self._cold_engines, self._warm_engines, self._hot_engines = [], [], []
+        self._engines, self._models = {}, []
 
         # create and put in its map a TextProcessor and a NMTEngine for each line in model.conf
         settings = ConfigParser.ConfigParser()
         settings.read(os.path.join(model_path, 'model.conf'))
 
+        # memory limits are expressed in MB: if set, the corresponding count limit is unbounded by default
+        gpu_memory = self._get_int(settings, 'settings', 'hot_memory_mb', None)
+        host_memory = self._get_int(settings, 'settings', 'warm_memory_mb', None)
+
         self._cold_size = self._get_int(settings, 'settings', 'cold_size', 1000)
-        self._warm_size = self._get_int(settings, 'settings', 'warm_size', 5)
-        self._hot_size = self._get_int(settings, 'settings', 'hot_size', 2)
+        self._warm_size = self._get_int(settings, 'settings', 'warm_size', 5 if host_memory is None else None)
+        self._hot_size = self._get_int(settings, 'settings', 'hot_size', 2 if gpu_memory is None else None)
+        loading_threads = self._get_int(settings, 'settings', 'loading_threads', 4)
+        # publishing weights in shared memory is opt-in: it is useful only for models without a mapped '.mdat' file
+        shared_weights = self._get_int(settings, 'settings', 'shared_weights', 0) > 0
+        cache_memory = self._get_int(settings, 'settings', 'translation_cache_mb', 0)
 
         if self._cold_size < 1:
             raise ValueError("Cold size must be larger than 0!")
 
-        if self._warm_size < 1:
+        if self._warm_size is not None and self._warm_size < 1:
             raise ValueError("Warm size must be larger than 0!")
 
-        if self._hot_size < 1:
+        if self._hot_size is not None and self._hot_size < 1:
             raise ValueError("Hot size must be larger than 0!")
 
-        self._logger.debug("Model sizes: hot:%d warm:%d cold:%d" % (self._hot_size, self._warm_size, self._cold_size))
+        self._logger.debug("Model limits: hot:%s (%s MB) warm:%s (%s MB) cold:%d" %
+                           (self._hot_size, gpu_memory, self._warm_size, host_memory, self._cold_size))
 
         if not settings.has_section('models'):
             raise Exception('no model specified in %s' % os.path.join(model_path, 'model.conf'))
 
-        for key, model_name in settings.items('models'):
-            model_file = os.path.join(model_path, model_name)
+        self._residency = _ResidencyManager(self._engines, hot_size=self._hot_size, warm_size=self._warm_size,
+                                            gpu_memory=gpu_memory * 1024 * 1024 if gpu_memory is not None else None,
+                                            host_memory=host_memory * 1024 * 1024 if host_memory is not None else None)
 
+        # the cache of the translations is disabled by default
+        self._cache = TranslationCache(cache_memory * 1024 * 1024) if cache_memory > 0 else None
+        self._cache_versions = {}  # version of the models whose translations are in the cache
+
+        # models are loaded in background by a pool of threads: the decoder is ready as soon as the configuration
+        # is parsed, and the requests for a model wait until it is loaded
+        models = Queue.Queue()
+
+        for key, model_name in settings.items('models'):
             # the running state of the engines depend on their position in the configration file:
             # the higher in the list the better its state
-            with log_timed_action(self._logger, 'Loading "%s" model from checkpoint' % key):
-                self._engines[key] = NMTEngine.load_from_checkpoint(model_file)
-
-                if len(self._hot_engines) < self._hot_size:
-                    # the engine is automatically created in COLD state
-                    # and now it is upgraded to HOT
-                    self._engines[key].running_state = NMTEngine.HOT
-                    self._hot_engines.append(key)
-                elif len(self._warm_engines) < self._warm_size:
-                    # the engine is automatically created in WARM state
-                    self._engines[key].running_state = NMTEngine.WARM
-                    self._warm_engines.append(key)
-                else:
-                    self._cold_engines.append(key)
+            self._residency.register(key)
+            self._models.append(key)
+            models.put((key, os.path.join(model_path, model_name)))
+
+        device = torch.cuda.current_device() if torch_is_using_cuda() else None
+
+        for _ in range(max(min(loading_threads, len(self._models)), 1)):
+            loader = threading.Thread(target=self._load_models, args=(models, device, shared_weights))
+            loader.daemon = True
+            loader.start()
 
-        self._logger.debug("Running states of the models: hot:%s, warm:%s, cold:%s" %
-                           (self._hot_engines, self._warm_engines, self._cold_engines))
         # Public-editable options
         self.beam_size = 5
         self.max_sent_length = 160
+        self.batch_bucket_size = 32  # sentences decoded together by translate_batch()
+
+        # if enabled, a suggestion whose source is the text to translate is returned as it is, without tuning and
+        # decoding; if the threshold is set, also the best suggestion with at least that score is returned.
+        # The fast path is disabled by default, and never used for n-best requests
+        self.tm_exact_match = self._get_int(settings, 'settings', 'tm_exact_match', 0) > 0
+        self.tm_score_threshold = self._get_float(settings, 'settings', 'tm_score_threshold', None)
+
+        # if set, the generator scores only a shortlist of the target vocabulary: the best 'shortlist_candidates'
+        # translations of the source tokens in the lexical table of the model, and its most frequent target tokens
+        self.shortlist_candidates = self._get_int(settings, 'settings', 'shortlist_candidates', 0)
+        self.shortlist_frequent = self._get_int(settings, 'settings', 'shortlist_frequent', 2000)
+
+    def _load_models(self, models, device, shared_weights):
+        if device is not None:
+            torch.cuda.set_device(device)  # the current device is set per thread
+
+        while True:
+            try:
+                key, model_file = models.get_nowait()
+            except Queue.Empty:
+                break
+
+            # the size of the weights file is a good estimate of the memory taken by the engine
+            weights_file = model_file + ('.mdat' if os.path.isfile(model_file + '.mdat') else '.dat')
+            size = os.path.getsize(weights_file) if os.path.isfile(weights_file) else None
+
+            def _loader():
+                return NMTEngine.load_from_checkpoint(model_file, shared_weights=shared_weights)
+
+            with log_timed_action(self._logger, 'Loading "%s" model from checkpoint' % key):
+                self._residency.load(key, _loader, size=size)
 
     def get_engine(self, source_lang, target_lang, variant=None):
-        key = source_lang + '__' + target_lang
-        if variant is not None:
-            key += "__" + variant
-        if key not in self._engines:
+        key = self._key(source_lang, target_lang, variant)
+        if key not in self._models:
             return None
 
-        engine = self._engines[key]
+        # if needed, the engine is upgraded to HOT, demoting the least recently used ones
+        return self._residency.acquire(key)
 
-        if engine.running_state != NMTEngine.HOT:  # the running state of the required engine is COLD; upgrade to HOT
-            with log_timed_action(self._logger, 'Upgrading "%s" model' % key):
-                if engine.running_state == NMTEngine.WARM:  # the running state of the required engine is WARM
-                    self._warm_engines.remove(key)
-                else:  # the running state of the required engine is COLD
-                    self._cold_engines.remove(key)
+    def preload(self, source_lang, target_lang, variant=None):
+        # start loading the engine in background if it is COLD,
+        # in order to anticipate the upgrade of an engine that will be requested soon
+        key = self._key(source_lang, target_lang, variant)
+        if key in self._models:
+            self._residency.preload(key)
 
-                if len(self._hot_engines) >= self._hot_size:  # no more space among the hot engines
-                    if len(self._warm_engines) >= self._warm_size:  # no more space among the warm engines
-                        # move the last warm engine to cold
-                        tmp_key = self._warm_engines.pop()
-                        self._engines[tmp_key].running_state = NMTEngine.COLD
-                        self._cold_engines.insert(0, tmp_key)
+    def _validate_cache(self, key):
+        # the translations of a model are removed from the cache when the model is reloaded
+        engine = self._engines.get(key, None)
 
-                    # move the last hot engine to warm, which has at least one space
-                    tmp_key = self._hot_engines.pop()
-                    self._engines[tmp_key].running_state = NMTEngine.WARM
-                    self._warm_engines.insert(0, tmp_key)
+        if engine is not None and self._cache_versions.get(key, None) != engine.model_version:
+            self._cache.invalidate(key)
+            self._cache_versions[key] = engine.model_version
 
-                # insert the required engine in the first position  of the hot models
-                engine.running_state = NMTEngine.HOT
-                self._hot_engines.insert(0, key)
+    def _shortlist_settings(self):
+        # the shortlist changes the translations: they are cached by its settings too
+        return (self.shortlist_candidates, self.shortlist_frequent) if self.shortlist_candidates > 0 else None
 
-        self._logger.debug("Running states of the models: hot:%s, warm:%s, cold:%s" %
-                           (self._hot_engines, self._warm_engines, self._cold_engines))
+    def _tm_match(self, text, suggestions):
+        if self.tm_exact_match:
+            normalized_text = TranslationCache.normalize(text)
+            for suggestion in suggestions:
+                if TranslationCache.normalize(suggestion.source) == normalized_text:
+                    return suggestion
 
-        return engine
+        if self.tm_score_threshold is not None:
+            best = max(suggestions, key=lambda s: s.score)
+            if best.score >= self.tm_score_threshold:
+                return best
+
+        return None
+
+    @staticmethod
+    def _project_alignment(source, target):
+        # words occurring once in both source and target are aligned together (if in the same order), the others
+        # are aligned by linear interpolation between the closest of those anchors: every word ends up aligned
+        if len(source) == 0 or len(target) == 0:
+            return []
+
+        source_counts, target_positions = {}, {}
+        for word in source:
+            source_counts[word] = source_counts.get(word, 0) + 1
+        for j, word in enumerate(target):
+            target_positions.setdefault(word, []).append(j)
+
+        anchors = [(-1, -1)]
+        for i, word in enumerate(source):
+            positions = target_positions.get(word, [])
+            if source_counts[word] == 1 and len(positions) == 1 and positions[0] > anchors[-1][1]:
+                anchors.append((i, positions[0]))
+        anchors.append((len(source), len(target)))
+
+        def _interpolate(x, x0, x1, y0, y1, size):
+            y = int(round(y0 + (x - x0) * float(y1 - y0) / (x1 - x0)))
+            return min(max(y, 0), size - 1)
+
+        alignment = set(anchors[1:-1])
+        for (i0, j0), (i1, j1) in zip(anchors[:-1], anchors[1:]):
+            for i in xrange(i0 + 1, i1):
+                alignment.add((i, _interpolate(i, i0, i1, j0, j1, len(target))))
+            for j in xrange(j0 + 1, j1):
+                alignment.add((_interpolate(j, j0, j1, i0, i1, len(source)), j))
+
+        return sorted(alignment)
 
     def translate(self, source_lang, target_lang, text, suggestions=None, n_best=1,
                   tuning_epochs=None, tuning_learning_rate=None, variant=None):
+        key = self._key(source_lang, target_lang, variant)
+
+        # Translation memory fast path: a perfect suggestion is the translation
+        if suggestions is not None and len(suggestions) > 0 and n_best == 1 and key in self._models:
+            match = self._tm_match(text, suggestions)
+
+            if match is not None:
+                self._logger.debug('Translation served by translation memory')
+                alignment = self._project_alignment(text.split(), match.target.split())
+                return [Translation(match.target, alignment, origin=Translation.TRANSLATION_MEMORY)]
+
+        cache_key = None
+
+        if self._cache is not None:
+            self._validate_cache(key)
+
+            engine = self._engines.get(key, None)
+            tuning_mode = engine.metadata.tuning_mode if engine is not None else None
+
+            cache_key = TranslationCache.key(key, text, n_best, self.beam_size, self.max_sent_length,
+                                             suggestions, tuning_epochs, tuning_learning_rate, tuning_mode,
+                                             shortlist=self._shortlist_settings())
+            result = self._cache.get(cache_key)
+
+            if result is not None:
+                return [Translation(t.text, t.alignment, origin=Translation.CACHE) for t in result]
+
         # (0) Get NMTEngine for current key (direction and variant if specified);
         #     and if needed it upgrades the engine to running state HOT
         #     if it does not exist, raise an exception
@@ -131,10 +513,58 @@ class NMTDecoder:
             reset_model = True
 
         # (2) Translate and compute word alignment
-        result = engine.translate(text, n_best=n_best, beam_size=self.beam_size, max_sent_length=self.max_sent_length)
+        result = engine.translate(text, n_best=n_best, beam_size=self.beam_size, max_sent_length=self.max_sent_length,
+                                  shortlist_candidates=self.shortlist_candidates,
+                                  shortlist_frequent=self.shortlist_frequent)
 
         # (3) Reset model if needed
         if reset_model:
             engine.reset_model()
 
+        if cache_key is not None:
+            self._validate_cache(key)  # the model could have been reloaded while acquiring it
+            self._cache.put(cache_key, result)
+
+        return result
+
+    def translate_batch(self, source_lang, target_lang, texts, n_best=1, variant=None):
+        # Suggestions are not supported in batch mode: tuning is request-specific,
+        # hence the engine cannot be shared among the sentences of the batch
+        key = self._key(source_lang, target_lang, variant)
+        if self._cache is not None:
+            self._validate_cache(key)
+
+        # sentences found in the cache are not translated, and duplicated ones are translated only once
+        result = [None] * len(texts)
+        missing = OrderedDict()  # cache key -> indexes of the texts
+
+        for i, text in enumerate(texts):
+            cache_key = TranslationCache.key(key, text, n_best, self.beam_size, self.max_sent_length,
+                                             shortlist=self._shortlist_settings())
+            cached = self._cache.get(cache_key) if self._cache is not None else None
+
+            if cached is not None:
+                result[i] = [Translation(t.text, t.alignment, origin=Translation.CACHE) for t in cached]
+            else:
+                missing.setdefault(cache_key, []).append(i)
+
+        if len(missing) > 0:
+            engine = self.get_engine(source_lang, target_lang, variant)
+            translations = engine.translate_batch([texts[indexes[0]] for indexes in missing.itervalues()],
+                                                  n_best=n_best, beam_size=self.beam_size,
+                                                  max_sent_length=self.max_sent_length,
+                                                  bucket_size=self.batch_bucket_size,
+                                                  shortlist_candidates=self.shortlist_candidates,
+                                                  shortlist_frequent=self.shortlist_frequent)
+
+            if self._cache is not None:
+                self._validate_cache(key)
+
+            for (cache_key, indexes), translation in zip(missing.iteritems(), translations):
+                for i in indexes:
+                    result[i] = list(translation)
+
+                if self._cache is not None:
+                    self._cache.put(cache_key, translation)
+
         return result
@@ -1,4 +1,3 @@
-import copy
 import logging
 import math
 import os
@@ -8,10 +7,14 @@ import torch.nn as nn
 
 from nmmt.models import Translation
 from nmmt.IDataset import DatasetWrapper
+from nmmt.LexicalTable import LexicalTable
+from nmmt.MMapDict import MMapDict
+from nmmt.MMapWeights import MMapWeights
 from nmmt.SubwordTextProcessor import SubwordTextProcessor
 from nmmt.internal_utils import opts_object, log_timed_action
 from nmmt.torch_utils import torch_is_multi_gpu, torch_is_using_cuda, torch_get_gpus
 from onmt import Models, Translator, Constants, Dataset, Optim
+from onmt.modules import LowRankAdapter
 
 
 class _Translator(Translator):
@@ -30,6 +33,61 @@ class _Translator(Translator):
         self.model = model
 
 
+class _TuningOptim(Optim):
+    """
+    Optimizer used by the tuning process: before every update it saves the original values of the
+    parameters that are going to change, so that restore() can undo the tuning in place.
+
+    Only the rows that receive a non-zero gradient are saved: none of the supported methods moves a parameter
+    whose gradient has always been zero, hence rows of the embeddings that are not used by the suggestions
+    are never copied.
+    """
+
+    def __init__(self, method, lr, max_grad_norm, lr_decay=1, lr_start_decay_at=None):
+        super(_TuningOptim, self).__init__(method, lr, max_grad_norm, lr_decay, lr_start_decay_at)
+        self._saved = {}  # parameter -> (saved rows mask, list of (rows, values))
+
+    def _save(self, param):
+        grad, data = param.grad.data, param.data
+
+        if data.dim() < 2:
+            if param not in self._saved:
+                self._saved[param] = (None, [(None, data.clone())])
+            return
+
+        touched = grad.ne(0).view(grad.size(0), -1).max(1)[0].view(-1)
+
+        if param not in self._saved:
+            self._saved[param] = (touched.clone().zero_(), [])
+
+        mask, values = self._saved[param]
+        new_rows = touched * mask.eq(0)
+
+        if new_rows.max() == 0:
+            return
+
+        rows = new_rows.nonzero().view(-1)
+        values.append((rows, data.index_select(0, rows)))
+        mask.masked_fill_(new_rows, 1)
+
+    def step(self):
+        for param in self.params:
+            if param.grad is not None:
+                self._save(param)
+
+        super(_TuningOptim, self).step()
+
+    def restore(self):
+        for param, (_, values) in self._saved.iteritems():
+            for rows, value in values:
+                if rows is None:
+                    param.data.copy_(value)
+                else:
+                    param.data.index_copy_(0, rows, value)
+
+        self._saved = {}
+
+
 class ModelFileNotFoundException(BaseException):
     def __init__(self, path):
         self.message = "Model file not found: %s" % path
@@ -59,6 +117,8 @@ class NMTEngine(object):
             self.tuning_max_grad_norm = 5  # If norm(gradient vector) > max_grad_norm, re-normalize
             self.tuning_max_learning_rate = 0.2
             self.tuning_max_epochs = 10
+            self.tuning_mode = 'full'  # Parameters updated by tuning. [full|bias|adapter]
+            self.tuning_adapter_rank = 8  # Rank of the adapter trained on the decoder output in 'adapter' mode
 
         def __str__(self):
             return str(self.__dict__)
@@ -105,15 +165,23 @@ class NMTEngine(object):
         return NMTEngine(src_dict, trg_dict, _new_instance_initializer, processor, metadata=metadata)
 
     @staticmethod
-    def load_from_checkpoint(checkpoint_path):
+    def load_from_checkpoint(checkpoint_path, shared_weights=False):
+        # with 'shared_weights', the weights are published in shared memory and mapped copy-on-write:
+        # the processes loading the same checkpoint share a single copy of them
         metadata_file = checkpoint_path + '.meta'
         processor_file = checkpoint_path + '.bpe'
         data_file = checkpoint_path + '.dat'
         dict_file = checkpoint_path + '.vcb'
+        lexicon_file = checkpoint_path + '.mlex'
+
+        # memory-mappable versions of processor, dictionaries and weights, preferred if available
+        mmap_processor_file = checkpoint_path + '.mbpe'
+        mmap_dict_file = checkpoint_path + '.mvcb'
+        mmap_data_file = checkpoint_path + '.mdat'
 
         if not os.path.isfile(processor_file):
             raise ModelFileNotFoundException(processor_file)
-        if not os.path.isfile(data_file):
+        if not os.path.isfile(data_file) and not os.path.isfile(mmap_data_file):
             raise ModelFileNotFoundException(data_file)
         if not os.path.isfile(dict_file):
             raise ModelFileNotFoundException(dict_file)
@@ -125,37 +193,76 @@ class NMTEngine(object):
             metadata.load_from_file(metadata_file)
 
         # Processor
-        processor = SubwordTextProcessor.load_from_file(processor_file)
+        if os.path.isfile(mmap_processor_file):
+            processor = SubwordTextProcessor.load_from_binary_file(mmap_processor_file)
+        else:
+            processor = SubwordTextProcessor.load_from_file(processor_file)
 
-        dictionary = torch.load(dict_file, map_location=lambda storage, loc: storage)
+        if os.path.isfile(mmap_dict_file):
+            dictionary = MMapDict.load_from_file(mmap_dict_file)
+        else:
+            dictionary = torch.load(dict_file, map_location=lambda storage, loc: storage)
         src_dict = dictionary['src']
         trg_dict = dictionary['tgt']
 
+        # the lexical table is optional: without it, the vocabulary is never shortlisted
+        lexicon = LexicalTable.load_from_file(lexicon_file) if os.path.isfile(lexicon_file) else None
+
         def _checkpoint_initializer(model, generator):
             checkpoint = torch.load(data_file, map_location=lambda storage, loc: storage)
 
             model.load_state_dict(checkpoint['model'])
             generator.load_state_dict(checkpoint['generator'])
 
-        return NMTEngine(src_dict, trg_dict, _checkpoint_initializer, processor, metadata=metadata)
+        def _mmap_initializer(model, generator):
+            weights = MMapWeights.load_from_file(mmap_data_file)
+            weights.bind(model, generator)
+
+            return weights
+
+        def _shared_weights_initializer(model, generator):
+            try:
+                weights = MMapWeights.publish(data_file)
+            except (IOError, OSError) as e:
+                # e.g. the shared memory is full: the weights are loaded in private memory
+                logging.getLogger('nmmt.NMTEngine').warning('Unable to share weights of %s: %s' % (data_file, e))
+                return _checkpoint_initializer(model, generator)
+
+            weights.bind(model, generator)
+            return weights
+
+        # a mapped weights file is shared by the processes using it, as it is mapped copy-on-write
+        if os.path.isfile(mmap_data_file):
+            initializer = _mmap_initializer
+        elif shared_weights:
+            initializer = _shared_weights_initializer
+        else:
+            initializer = _checkpoint_initializer
+
+        return NMTEngine(src_dict, trg_dict, initializer, processor, metadata=metadata, lexicon=lexicon)
 
-    def __init__(self, src_dict, trg_dict, initializer, processor, metadata=None):
+    def __init__(self, src_dict, trg_dict, initializer, processor, metadata=None, lexicon=None):
         self._logger = logging.getLogger('nmmt.NMTEngine')
         self._log_level = logging.INFO
         self._model_loaded = False
         self._running_state = self.COLD
+        self.model_version = 0  # incremented every time the model is loaded
 
         self.src_dict = src_dict
         self.trg_dict = trg_dict
         self.model = None
-        self._model_init_state = None
         self.processor = processor
         self.metadata = metadata if metadata is not None else NMTEngine.Metadata()
+        self.lexicon = lexicon  # LexicalTable of the model, used to shortlist the target vocabulary
 
         self._translator = None  # lazy load
         self._tuner = None  # lazy load
+        self._generator = None  # the original generator, while an adapter is in front of it
 
+        # initializer(model, generator) sets the weights of a new model: if it maps them from a file,
+        # it returns the MMapWeights, used to map them again instead of copying them back from the GPU
         self._initializer = initializer
+        self._weights = None
 
     def __load(self):
         encoder = Models.Encoder(self.metadata, self.src_dict)
@@ -167,28 +274,27 @@ class NMTEngine(object):
         model.cpu()
         generator.cpu()
 
-        self._initializer(model, generator)
+        self._weights = self._initializer(model, generator)
 
         model.generator = generator
         model.eval()
 
         self.model = model
-
-        # Compute initial state
-        model_state_dict, generator_state_dict = self._get_state_dicts()
-
-        self._model_init_state = {k: v for k, v in sorted(model_state_dict.items()) if 'generator' not in k}
-        self._model_init_state.update({"generator." + k: v for k, v in sorted(generator_state_dict.items())})
+        self.model_version += 1
 
         self._model_loaded = False
 
     def __unload(self):
         del self.model
-        del self._model_init_state
         del self._translator
+        del self._tuner
         self.model = None
-        self._model_init_state = None
         self._translator = None
+        self._tuner = None
+
+        if self._weights is not None:
+            self._weights.release()  # a shared segment is removed by its last user
+        self._weights = None
 
         self._model_loaded = False
 
@@ -208,6 +314,10 @@ class NMTEngine(object):
             self.model.generator = generator
 
     def __cpu(self):
+        if self._weights is not None and not self._is_data_parallel():
+            # tuning has been undone, the weights on the GPU are the mapped ones
+            self._weights.bind(self.model, self.model.generator)
+
         self.model.cpu()
         self.model.generator.cpu()
 
@@ -216,7 +326,16 @@ class NMTEngine(object):
 
     def reset_model(self):
         with log_timed_action(self._logger, 'Restoring model initial state', log_start=False):
-            self.model.load_state_dict(self._model_init_state)
+            # the tuning optimizer saved the original values of the parameters it updated
+            if self._tuner is not None:
+                self._tuner.optimizer.restore()
+
+            if self._generator is not None:
+                self.model.generator = self._generator
+                self._generator = None
+
+            for param in self.model.parameters():
+                param.requires_grad = True
 
             self.model.encoder.rnn.dropout = 0.
             self.model.decoder.dropout = nn.Dropout(0.)
@@ -231,6 +350,36 @@ class NMTEngine(object):
     def count_parameters(self):
         return sum([p.nelement() for p in self.model.parameters()])
 
+    def _setup_tuning_parameters(self):
+        # freeze the parameters that must not be updated by the current tuning mode:
+        # only trainable ones are passed to the tuning optimizer
+        mode = self.metadata.tuning_mode
+
+        if mode == 'full':
+            trainable = None
+        elif mode == 'bias':
+            # the decoder and generator are visited directly: with multiple GPUs the model is wrapped
+            # in a nn.DataParallel and all its parameter names have an additional 'module.' prefix
+            model = self.model.module if isinstance(self.model, nn.DataParallel) else self.model
+            trainable = set([id(param) for module in (model.decoder, self.model.generator)
+                             for name, param in module.named_parameters()
+                             if name.split('.')[-1].startswith('bias')])
+        elif mode == 'adapter':
+            adapter = LowRankAdapter(self.metadata.rnn_size, self.metadata.tuning_adapter_rank)
+            if torch_is_using_cuda():
+                adapter.cuda()
+
+            if self._generator is None:
+                self._generator = self.model.generator
+            self.model.generator = nn.Sequential(adapter, self._generator)
+
+            trainable = set([id(param) for param in adapter.parameters()])
+        else:
+            raise ValueError('Invalid tuning mode: %s' % mode)
+
+        for param in self.model.parameters():
+            param.requires_grad = trainable is None or id(param) in trainable
+
     def tune(self, suggestions, epochs=None, learning_rate=None):
         # Set tuning parameters
         if epochs is None or learning_rate is None:
@@ -243,13 +392,17 @@ class NMTEngine(object):
             if self._tuner is None:
                 from nmmt.NMTEngineTrainer import NMTEngineTrainer
 
-                optimizer = Optim(self.metadata.tuning_optimizer, 1., max_grad_norm=self.metadata.tuning_max_grad_norm)
+                optimizer = _TuningOptim(self.metadata.tuning_optimizer, 1.,
+                                         max_grad_norm=self.metadata.tuning_max_grad_norm)
 
                 tuner_opts = NMTEngineTrainer.Options()
                 tuner_opts.log_level = logging.NOTSET
+                tuner_opts.prefetch_batches = 0  # tuning sets are tiny and already on device
 
                 self._tuner = NMTEngineTrainer(self, options=tuner_opts, optimizer=optimizer)
 
+            self._setup_tuning_parameters()
+
             self._tuner.opts.step_limit = epochs
             self._tuner.reset_learning_rate(learning_rate)
 
@@ -299,7 +452,20 @@ class NMTEngine(object):
 
         return tuning_epochs, tuning_learning_rate
 
-    def translate(self, text, beam_size=5, max_sent_length=160, replace_unk=False, n_best=1):
+    def translate(self, text, beam_size=5, max_sent_length=160, replace_unk=False, n_best=1,
+                  shortlist_candidates=0, shortlist_frequent=0):
+        return self.translate_batch([text], beam_size=beam_size, max_sent_length=max_sent_length,
+                                    replace_unk=replace_unk, n_best=n_best, shortlist_candidates=shortlist_candidates,
+                                    shortlist_frequent=shortlist_frequent)[0]
+
+    def translate_batch(self, texts, beam_size=5, max_sent_length=160, replace_unk=False, n_best=1, bucket_size=32,
+                        shortlist_candidates=0, shortlist_frequent=0):
+        # Sentences are sorted by length and decoded in buckets of at most 'bucket_size' sentences, each one with
+        # a single beam search, in order to limit the padding; the result is a list (one element per input text,
+        # in the original order) of n-best translations lists.
+        # If 'shortlist_candidates' > 0 and the engine has a lexical table, the generator of every bucket scores only
+        # the 'shortlist_candidates' best translations of its source tokens and the 'shortlist_frequent' most
+        # frequent target tokens
         self._ensure_model_loaded()
 
         self.model.eval()
@@ -312,20 +478,51 @@ class NMTEngine(object):
         self._translator.opt.max_sent_length = max_sent_length
         self._translator.opt.n_best = n_best
 
-        src_bpe_tokens = self.processor.encode_line(text, is_source=True)
-        pred_batch, _, _, align_batch = self._translator.translate([src_bpe_tokens], None)
+        src_bpe_batch = [self.processor.encode_line(text, is_source=True) for text in texts]
+        order = sorted(range(len(src_bpe_batch)), key=lambda i: len(src_bpe_batch[i]))
 
-        translations = []
-        for trg_bpe_tokens, bpe_alignment in zip(pred_batch[0], align_batch[0]):
-            src_indexes = self.processor.get_words_indexes(src_bpe_tokens)
-            trg_indexes = self.processor.get_words_indexes(trg_bpe_tokens)
+        result = [None] * len(src_bpe_batch)
 
-            translation = Translation(text=self.processor.decode_tokens(trg_bpe_tokens),
-                                      alignment=self._make_alignment(src_indexes, trg_indexes, bpe_alignment))
+        for start in xrange(0, len(order), bucket_size):
+            bucket = order[start:start + bucket_size]
 
-            translations.append(translation)
+            shortlist = None
+            if shortlist_candidates > 0 and self.lexicon is not None:
+                shortlist = self._shortlist([src_bpe_batch[i] for i in bucket], shortlist_candidates,
+                                            shortlist_frequent, self._translator.opt.beam_size)
 
-        return translations
+            self._translator.opt.batch_size = len(bucket)
+            pred_batch, _, _, align_batch = self._translator.translate([src_bpe_batch[i] for i in bucket], None,
+                                                                       shortlist=shortlist)
+
+            for i, trg_nbest, align_nbest in zip(bucket, pred_batch, align_batch):
+                src_indexes = self.processor.get_words_indexes(src_bpe_batch[i])
+
+                translations = []
+                for trg_bpe_tokens, bpe_alignment in zip(trg_nbest, align_nbest):
+                    trg_indexes = self.processor.get_words_indexes(trg_bpe_tokens)
+
+                    translation = Translation(text=self.processor.decode_tokens(trg_bpe_tokens),
+                                              alignment=self._make_alignment(src_indexes, trg_indexes, bpe_alignment))
+
+                    translations.append(translation)
+
+                result[i] = translations
+
+        return result
+
+    def _shortlist(self, src_bpe_batch, candidates, frequent, beam_size):
+        tokens = []
+        for src_bpe_tokens in src_bpe_batch:
+            tokens += self.src_dict.convertToIdxList(src_bpe_tokens, Constants.UNK_WORD)
+
+        shortlist = self.lexicon.shortlist(tokens, candidates, frequent)
+
+        # the beam search needs at least 'beam_size' words, and a shortlist as large as the vocabulary is useless
+        if len(shortlist) < beam_size or len(shortlist) >= self.trg_dict.size():
+            return None
+
+        return torch.from_numpy(shortlist)
 
     @staticmethod
     def _make_alignment(src_indexes, trg_indexes, bpe_alignment):
@@ -340,6 +537,7 @@ class NMTEngine(object):
 
         if store_processor:
             self.processor.save_to_file(path + '.bpe')
+            self.processor.save_to_binary_file(path + '.mbpe')
 
         if store_data:
             model_state_dict, generator_state_dict = self._get_state_dicts()
@@ -349,11 +547,16 @@ class NMTEngine(object):
                 'generator': generator_state_dict,
             }
             torch.save(checkpoint, path + '.dat')
+            MMapWeights.save_to_file(path + '.mdat', checkpoint)
 
             dictionary = {
                 'src': self.src_dict, 'tgt': self.trg_dict,
             }
             torch.save(dictionary, path + '.vcb')
+            MMapDict.save_to_file(path + '.mvcb', dictionary)
+
+            if self.lexicon is not None:
+                self.lexicon.save_to_file(path + '.mlex')
 
     def _get_state_dicts(self):
         if self._is_data_parallel():
@@ -366,7 +569,8 @@ class NMTEngine(object):
         model_state_dict = {k: v for k, v in model.state_dict().items() if 'generator' not in k}
         generator_state_dict = generator.state_dict()
 
-        return copy.deepcopy(model_state_dict), copy.deepcopy(generator_state_dict)
+        # no copy is needed: the tensors are serialized before the model can be changed
+        return model_state_dict, generator_state_dict
 
     @property
     def running_state(self):
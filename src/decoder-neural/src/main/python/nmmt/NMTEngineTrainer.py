@@ -8,6 +8,7 @@ import os
 from torch import nn, torch
 from torch.autograd import Variable
 
+from nmmt.MMapWeights import MMapWeights
 from nmmt.torch_utils import torch_is_multi_gpu, torch_is_using_cuda
 from onmt import Constants, Optim
 
@@ -58,7 +59,9 @@ class NMTEngineTrainer:
             self.vocab_pruning_threshold = None  # Skip pruning
 
             self.batch_size = 64
+            self.batch_max_tokens = None  # If set, batches are packed by tokens instead of 'batch_size' sentences
             self.max_generator_batches = 32  # Maximum batches of words in a seq to run the generator on in parallel.
+            self.prefetch_batches = 4  # Batches prepared in background while training (0 disables prefetching)
 
             self.report_steps = 100  # Log status every 'report_steps' steps
             self.validation_steps = 10000  # compute the validation score every 'validation_steps' steps
@@ -155,7 +158,8 @@ class NMTEngineTrainer:
 
     def reset_learning_rate(self, value):
         self.optimizer.lr = value
-        self.optimizer.set_parameters(self._engine.model.parameters())
+        # frozen parameters are not optimized
+        self.optimizer.set_parameters([p for p in self._engine.model.parameters() if p.requires_grad])
 
     def _log(self, message):
         if self.opts.log_level > logging.NOTSET:
@@ -233,7 +237,8 @@ class NMTEngineTrainer:
         targets = batch[1][1:]  # exclude <s> from targets
         loss, grad_output, num_correct = self._compute_memory_efficient_loss(outputs, targets,
                                                                              self._engine.model.generator, criterion)
-        outputs.backward(grad_output)
+        if outputs.requires_grad:  # false if all the parameters of the model, but the generator, are frozen
+            outputs.backward(grad_output)
 
         # update the parameters
         self.optimizer.step()
@@ -264,11 +269,15 @@ class NMTEngineTrainer:
         valid_ppl_best = None
         valid_ppl_stalled = 0  # keep track of how many consecutive validations do not improve the best perplexity
 
+        iterator = None
+
         try:
             checkpoint_stats = _Stats()
             report_stats = _Stats()
 
-            iterator = train_dataset.iterator(self.opts.batch_size, loop=True, start_position=step)
+            iterator = train_dataset.iterator(self.opts.batch_size, loop=True, start_position=step,
+                                              prefetch=self.opts.prefetch_batches,
+                                              max_tokens=self.opts.batch_max_tokens)
 
             number_of_batches_per_epoch = len(iterator)
             self._log('Number of steps per epoch: %d' % number_of_batches_per_epoch)
@@ -374,6 +383,9 @@ class NMTEngineTrainer:
                             break
         except KeyboardInterrupt:
             pass
+        finally:
+            if iterator is not None:
+                iterator.close()
 
         return self.state
 
@@ -413,3 +425,7 @@ class NMTEngineTrainer:
         output_checkpoint = __divide(output_checkpoint, len(checkpoint_paths))
 
         torch.save(output_checkpoint, output_path)
+
+        # the memory-mappable version of the weights, if any, must be the merged one too
+        mmap_output_path = os.path.splitext(output_path)[0] + '.mdat'
+        MMapWeights.save_to_file(mmap_output_path, output_checkpoint)
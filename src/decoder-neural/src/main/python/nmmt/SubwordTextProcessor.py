@@ -1,15 +1,19 @@
 import codecs
+import heapq
+import Queue
+import multiprocessing
 import os
-from collections import Counter
+from collections import Counter, OrderedDict
 from collections import defaultdict
 
+import numpy
 from math import sqrt
 
-import re
+import sys
 
-import copy
+import traceback
 
-import sys
+from MMapTables import TablesFile
 
 
 def _cosine_similarity(a, b):
@@ -33,126 +37,182 @@ def _cosine_similarity(a, b):
     return dot_product / (a_magnitude * b_magnitude)
 
 
-class _BPE:
-    def __init__(self, codes, separator):
-        self.separator = separator
-        self.bpe_codes = codes
+class _LRUCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
 
-        self._cache = {}
-        self._bpe_codes_reverse = dict([(pair[0] + pair[1], pair) for pair, _ in self.bpe_codes.iteritems()])
+        self._entries = OrderedDict()
 
-    # Learning
-    # ------------------------------------------------------------------------------------------------------------------
+    def __len__(self):
+        return len(self._entries)
 
-    @staticmethod
-    def learn_from_terms(terms, symbols, min_frequency, separator):
-        codes = []
+    def get(self, key):
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+
+        self._entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._entries.pop(key, None)
+        self._entries[key] = value
+
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / requests if requests > 0 else 0.
+        }
+
+
+class _PairHeap:
+    """
+    Indexed max-heap of symbol pairs, sorted like max(stats, key=lambda x: (stats[x], x)): by frequency and then
+    by the strings of the symbols. The position of each pair is tracked, so that its frequency can be changed.
+    """
+
+    def __init__(self, names, stats):
+        self._names = names
+        self._heap = []
+        self._positions = {}
+
+        self.reset(stats)
+
+    def reset(self, stats):
+        names = self._names
+
+        # a list sorted in descending order is a valid max-heap
+        self._heap = [[freq, names[left], names[right], (left, right)] for (left, right), freq in stats.iteritems()]
+        self._heap.sort(reverse=True)
+        self._positions = dict([(entry[3], i) for i, entry in enumerate(self._heap)])
+
+    def top(self):
+        return self._heap[0][3]
+
+    def update(self, pair, freq):
+        position = self._positions.get(pair, None)
+
+        if position is None:
+            position = len(self._heap)
+            self._heap.append([freq, self._names[pair[0]], self._names[pair[1]], pair])
+            self._positions[pair] = position
+            self._sift_up(position)
+        else:
+            entry = self._heap[position]
+            previous, entry[0] = entry[0], freq
+
+            if freq > previous:
+                self._sift_up(position)
+            elif freq < previous:
+                self._sift_down(position)
+
+    def _swap(self, i, j):
+        heap = self._heap
+        heap[i], heap[j] = heap[j], heap[i]
+        self._positions[heap[i][3]] = i
+        self._positions[heap[j][3]] = j
+
+    def _sift_up(self, i):
+        heap = self._heap
+        while i > 0:
+            parent = (i - 1) >> 1
+            if heap[i] <= heap[parent]:
+                break
+            self._swap(i, parent)
+            i = parent
 
-        vocab = dict([(tuple(a[:-1]) + (a[-1] + '</w>',), b) for (a, b) in terms.items()])
-        sorted_vocab = sorted(vocab.items(), key=lambda x: x[1], reverse=True)
+    def _sift_down(self, i):
+        heap = self._heap
+        size = len(heap)
 
-        stats, indices = _BPE._get_pair_statistics(sorted_vocab)
-        big_stats = copy.deepcopy(stats)
-        # threshold is inspired by Zipfian assumption, but should only affect speed
-        threshold = max(stats.values()) / 10
-        for i in xrange(symbols):
-            if stats:
-                most_frequent = max(stats, key=lambda x: (stats[x], x))
-
-            # we probably missed the best pair because of pruning; go back to full statistics
-            if not stats or (i and stats[most_frequent] < threshold):
-                _BPE._prune_stats(stats, big_stats, threshold)
-                stats = copy.deepcopy(big_stats)
-                most_frequent = max(stats, key=lambda x: (stats[x], x))
-                # threshold is inspired by Zipfian assumption, but should only affect speed
-                threshold = stats[most_frequent] * i / (i + 10000.0)
-                _BPE._prune_stats(stats, big_stats, threshold)
-
-            if stats[most_frequent] < min_frequency:
-                # No pair has frequency >= min_frequency. Stopping
-                break
+        while True:
+            largest = i
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < size and heap[child] > heap[largest]:
+                    largest = child
 
-            codes.append(most_frequent)
-            changes = _BPE._replace_pair(most_frequent, sorted_vocab, indices)
-            _BPE._update_pair_statistics(most_frequent, changes, stats, indices)
-            stats[most_frequent] = 0
+            if largest == i:
+                break
+            self._swap(i, largest)
+            i = largest
 
-            if not i % 100:
-                _BPE._prune_stats(stats, big_stats, threshold)
 
-        # some hacking to deal with duplicates (only consider first instance)
-        codes = dict([(code, i) for (i, code) in reversed(list(enumerate(codes)))])
+class _VocabularyShard:
+    """
+    A subset of the words of the vocabulary, stored as tuples of symbol ids, with the index from pairs to words.
+    Merging a pair returns the changes of the pair frequencies, so that the statistics of the shards can be summed.
+    """
 
-        return _BPE(codes, separator=separator)
+    def __init__(self, words):
+        self._words = words
+        self._indices = defaultdict(lambda: defaultdict(int))
 
-    @staticmethod
-    def _get_pair_statistics(vocab):
+    def pair_statistics(self):
         """Count frequency of all symbol pairs, and create index"""
-
-        # data structure of pair frequencies
         stats = defaultdict(int)
 
-        # index from pairs to words
-        indices = defaultdict(lambda: defaultdict(int))
-
-        for i, (word, freq) in enumerate(vocab):
+        for i, (word, freq) in enumerate(self._words):
             prev_char = word[0]
             for char in word[1:]:
                 stats[prev_char, char] += freq
-                indices[prev_char, char][i] += 1
+                self._indices[prev_char, char][i] += 1
                 prev_char = char
 
-        return stats, indices
-
-    @staticmethod
-    def _prune_stats(stats, big_stats, threshold):
-        """Prune statistics dict for efficiency of max()
+        return dict(stats)
 
-        The frequency of a symbol pair never increases, so pruning is generally safe
-        (until we the most frequent pair is less frequent than a pair we previously pruned)
-        big_stats keeps full statistics for when we need to access pruned items
-        """
-        for item, freq in stats.items():
-            if freq < threshold:
-                del stats[item]
-                if freq < 0:
-                    big_stats[item] += freq
-                else:
-                    big_stats[item] = freq
+    def merge(self, pair, merged):
+        changes = self._replace_pair(pair, merged)
+        return self._update_pair_statistics(pair, merged, changes)
 
-    @staticmethod
-    def _replace_pair(pair, vocab, indices):
+    def _replace_pair(self, pair, merged):
         """Replace all occurrences of a symbol pair ('A', 'B') with a new symbol 'AB'"""
         first, second = pair
-        pair_str = ''.join(pair)
-        pair_str = pair_str.replace('\\', '\\\\')
         changes = []
-        pattern = re.compile(r'(?<!\S)' + re.escape(first + ' ' + second) + r'(?!\S)')
 
-        for j, freq in indices[pair].iteritems():
+        for j, freq in self._indices[pair].iteritems():
             if freq < 1:
                 continue
-            word, freq = vocab[j]
-            new_word = ' '.join(word)
-            new_word = pattern.sub(pair_str, new_word)
-            new_word = tuple(new_word.split())
+            word, freq = self._words[j]
 
-            vocab[j] = (new_word, freq)
+            new_word = []
+            i, length = 0, len(word)
+            while i < length:
+                if i < length - 1 and word[i] == first and word[i + 1] == second:
+                    new_word.append(merged)
+                    i += 2
+                else:
+                    new_word.append(word[i])
+                    i += 1
+            new_word = tuple(new_word)
+
+            self._words[j] = (new_word, freq)
             changes.append((j, new_word, word, freq))
 
         return changes
 
-    @staticmethod
-    def _update_pair_statistics(pair, changed, stats, indices):
+    def _update_pair_statistics(self, pair, merged, changed):
         """Minimally update the indices and frequency of symbol pairs
 
         if we merge a pair of symbols, only pairs that overlap with occurrences
         of this pair are affected, and need to be updated.
         """
-        stats[pair] = 0
+        deltas = defaultdict(int)
+        indices = self._indices
+
         indices[pair] = defaultdict(int)
         first, second = pair
-        new_pair = first + second
         for j, word, old_word, freq in changed:
 
             # find all instances of pair, and update frequency/indices around it
@@ -168,7 +228,7 @@ class _BPE:
                     # assuming a symbol sequence "A B C", if "B C" is merged, reduce the frequency of "A B"
                     if i:
                         prev = old_word[i - 1:i + 1]
-                        stats[prev] -= freq
+                        deltas[prev] -= freq
                         indices[prev][j] -= 1
                     if i < len(old_word) - 2:
                         # assuming a symbol sequence "A B C B", if "B C" is merged, reduce the frequency of "C B".
@@ -176,7 +236,7 @@ class _BPE:
                         # reduced by the previous code block
                         if old_word[i + 2] != first or i >= len(old_word) - 3 or old_word[i + 3] != second:
                             nex = old_word[i + 1:i + 3]
-                            stats[nex] -= freq
+                            deltas[nex] -= freq
                             indices[nex][j] -= 1
                     i += 2
                 else:
@@ -187,23 +247,337 @@ class _BPE:
             while True:
                 try:
                     # find new pair
-                    i = word.index(new_pair, i)
+                    i = word.index(merged, i)
                 except ValueError:
                     break
                 # assuming a symbol sequence "A BC D", if "B C" is merged, increase the frequency of "A BC"
                 if i:
                     prev = word[i - 1:i + 1]
-                    stats[prev] += freq
+                    deltas[prev] += freq
                     indices[prev][j] += 1
                 # assuming a symbol sequence "A BC B", if "B C" is merged, increase the frequency of "BC B"
                 # however, if the sequence is A BC BC, skip this step because the count of "BC BC" will be
                 # incremented by the previous code block
-                if i < len(word) - 1 and word[i + 1] != new_pair:
+                if i < len(word) - 1 and word[i + 1] != merged:
                     nex = word[i:i + 2]
-                    stats[nex] += freq
+                    deltas[nex] += freq
                     indices[nex][j] += 1
                 i += 1
 
+        return dict(deltas)
+
+
+def _serve_shard(shard, connection):
+    while True:
+        request = connection.recv()
+        if request is None:
+            break
+
+        method, args = request
+        connection.send(getattr(shard, method)(*args))
+
+    connection.close()
+
+
+class _ShardedVocabulary:
+    """
+    It splits the words among a number of worker processes (one shard each), and sums their results.
+    Small vocabularies are kept in the current process, where the communication overhead is avoided.
+    """
+
+    _MIN_SHARD_SIZE = 20000  # words
+
+    def __init__(self, words, workers=1):
+        workers = max(min(workers, len(words) // self._MIN_SHARD_SIZE), 1)
+
+        self._local = None
+        self._processes = []
+        self._connections = []
+
+        if workers == 1:
+            self._local = _VocabularyShard(words)
+        else:
+            # words are sorted by frequency: interleaving them gives shards with similar amount of work
+            for i in xrange(workers):
+                connection, child_connection = multiprocessing.Pipe()
+                process = multiprocessing.Process(target=_serve_shard,
+                                                  args=(_VocabularyShard(words[i::workers]), child_connection))
+                process.daemon = True
+                process.start()
+                child_connection.close()
+
+                self._processes.append(process)
+                self._connections.append(connection)
+
+    def _call(self, method, *args):
+        if self._local is not None:
+            return [getattr(self._local, method)(*args)]
+
+        for connection in self._connections:
+            connection.send((method, args))
+        return [connection.recv() for connection in self._connections]
+
+    def pair_statistics(self):
+        stats = defaultdict(int)
+        for shard_stats in self._call('pair_statistics'):
+            for pair, freq in shard_stats.iteritems():
+                stats[pair] += freq
+        return stats
+
+    def merge(self, pair, merged):
+        results = self._call('merge', pair, merged)
+        if len(results) == 1:
+            return results[0]
+
+        deltas = defaultdict(int)
+        for shard_deltas in results:
+            for pair, delta in shard_deltas.iteritems():
+                deltas[pair] += delta
+        return deltas
+
+    def close(self):
+        for connection in self._connections:
+            connection.send(None)
+            connection.close()
+        for process in self._processes:
+            process.join()
+
+        self._processes = []
+        self._connections = []
+
+
+class _Lookup(object):
+    # read-only dict interface on top of a lookup function that returns None for missing keys
+    def __init__(self, function):
+        self._function = function
+
+    def get(self, key, default=None):
+        value = self._function(key)
+        return value if value is not None else default
+
+    def __getitem__(self, key):
+        value = self._function(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+
+class _MMapCodes(object):
+    """
+    BPE codes read from a TablesFile: symbols are a sorted StringTable, and merges are packed arrays sorted by
+    the (left id, right id) key. It provides the same lookups that _BPE builds from a dict of codes.
+    """
+
+    @staticmethod
+    def tables(prefix, codes):
+        symbols = set()
+        for left, right in codes:
+            symbols.update([left, right, left + right])
+
+        tables, symbols = TablesFile.strings_tables(prefix + '.symbols', symbols)
+        symbol_ids = dict([(symbol, i) for i, symbol in enumerate(symbols)])
+
+        merges = sorted([(symbol_ids[left] * len(symbols) + symbol_ids[right], rank, symbol_ids[left + right])
+                         for (left, right), rank in codes.iteritems()])
+
+        # for every symbol, the merge that produces it (the one with the lowest rank), or -1
+        reverse = numpy.full(len(symbols), -1, dtype=numpy.int64)
+        for i, (_, rank, merged) in enumerate(merges):
+            if reverse[merged] < 0 or merges[reverse[merged]][1] > rank:
+                reverse[merged] = i
+
+        tables.append((prefix + '.merge_keys', numpy.array([m[0] for m in merges], dtype=numpy.int64)))
+        tables.append((prefix + '.merge_ranks', numpy.array([m[1] for m in merges], dtype=numpy.int64)))
+        tables.append((prefix + '.merge_results', numpy.array([m[2] for m in merges], dtype=numpy.int64)))
+        tables.append((prefix + '.reverse', reverse))
+
+        return tables
+
+    _SYMBOL_IDS_CACHE_SIZE = 10000
+
+    def __init__(self, tables, prefix):
+        self._symbols = tables.strings(prefix + '.symbols')
+        self._symbol_ids_cache = {}
+        self._keys = tables.array(prefix + '.merge_keys')
+        self._ranks = tables.array(prefix + '.merge_ranks')
+        self._results = tables.array(prefix + '.merge_results')
+        self._reverse = tables.array(prefix + '.reverse')
+
+        self.symbol_ids = _Lookup(self._symbol_id)
+        self.merges = _Lookup(self._merge)
+        self.reverse = _Lookup(self._split)
+
+    def _symbol_id(self, symbol):
+        # words are split in characters before merging, hence the looked up symbols are few and worth caching
+        i = self._symbol_ids_cache.get(symbol, None)
+        if i is None:
+            i = self._symbols.index(symbol)
+            if len(self._symbol_ids_cache) < self._SYMBOL_IDS_CACHE_SIZE:
+                self._symbol_ids_cache[symbol] = i
+        return i if i >= 0 else None
+
+    def _merge(self, pair):
+        left, right = pair
+        if left < 0 or right < 0:
+            return None
+
+        key = left * len(self._symbols) + right
+        i = int(numpy.searchsorted(self._keys, key))
+        if i < len(self._keys) and self._keys[i] == key:
+            return int(self._ranks[i]), int(self._results[i])
+        return None
+
+    def _split(self, segment):
+        merged = self._symbols.index(segment)
+        if merged < 0 or self._reverse[merged] < 0:
+            return None
+
+        left, right = divmod(int(self._keys[self._reverse[merged]]), len(self._symbols))
+        return self._symbols[left], self._symbols[right]
+
+    def to_dict(self):
+        codes = {}
+        for key, rank in zip(self._keys.tolist(), self._ranks.tolist()):
+            left, right = divmod(key, len(self._symbols))
+            codes[self._symbols[left], self._symbols[right]] = rank
+        return codes
+
+
+class _BPE(object):
+    def __init__(self, codes, separator, cache_size=100000):
+        self.separator = separator
+
+        self._cache = _LRUCache(cache_size)
+
+        if isinstance(codes, _MMapCodes):
+            # lookups are served by the memory-mapped tables, the dict of codes is created only if requested
+            self._codes = None
+            self._mmap_codes = codes
+
+            self._bpe_codes_reverse = codes.reverse
+            self._symbol_ids = codes.symbol_ids
+            self._merges = codes.merges
+            return
+
+        self._codes = codes
+        self._mmap_codes = None
+        # if several merges produce the same symbol, the one with the lowest rank is reversed (as in _MMapCodes)
+        self._bpe_codes_reverse = {}
+        for pair, _ in sorted(codes.iteritems(), key=lambda code: code[1], reverse=True):
+            self._bpe_codes_reverse[pair[0] + pair[1]] = pair
+
+        # every symbol is mapped to an integer id, and each pair of ids to its merge rank and the id of the result
+        self._symbol_ids = {}
+        self._merges = {}
+
+        for (left, right), rank in codes.iteritems():
+            left_id = self._symbol_ids.setdefault(left, len(self._symbol_ids))
+            right_id = self._symbol_ids.setdefault(right, len(self._symbol_ids))
+            merged_id = self._symbol_ids.setdefault(left + right, len(self._symbol_ids))
+
+            self._merges[left_id, right_id] = (rank, merged_id)
+
+    @property
+    def bpe_codes(self):
+        if self._codes is None:
+            self._codes = self._mmap_codes.to_dict()
+        return self._codes
+
+    # Learning
+    # ------------------------------------------------------------------------------------------------------------------
+
+    @staticmethod
+    def learn_from_terms(terms, symbols, min_frequency, separator, workers=1):
+        """
+        Learn the merge operations from a dictionary of terms.
+
+        The statistics are kept exactly as in the original BPE implementation (including pruning), so that the
+        learned codes do not change; pairs are made of integer symbol ids, the most frequent pair is taken from
+        an indexed heap instead of a linear scan, and the words are split in shards updated by separate processes.
+        """
+        codes = []
+
+        vocab = dict([(tuple(a[:-1]) + (a[-1] + '</w>',), b) for (a, b) in terms.items()])
+        sorted_vocab = sorted(vocab.items(), key=lambda x: x[1], reverse=True)
+
+        symbol_ids = {}
+        names = []
+
+        def _id(symbol):
+            if symbol not in symbol_ids:
+                symbol_ids[symbol] = len(names)
+                names.append(symbol)
+            return symbol_ids[symbol]
+
+        words = [(tuple([_id(symbol) for symbol in word]), freq) for word, freq in sorted_vocab]
+        shards = _ShardedVocabulary(words, workers)
+
+        try:
+            stats = shards.pair_statistics()
+            big_stats = defaultdict(int, stats)
+            heap = _PairHeap(names, stats)
+            # threshold is inspired by Zipfian assumption, but should only affect speed
+            threshold = max(stats.values()) / 10
+            for i in xrange(symbols):
+                if stats:
+                    most_frequent = heap.top()
+
+                # we probably missed the best pair because of pruning; go back to full statistics
+                if not stats or (i and stats[most_frequent] < threshold):
+                    _BPE._prune_stats(stats, big_stats, threshold)
+                    stats = defaultdict(int, big_stats)
+                    heap.reset(stats)
+                    most_frequent = heap.top()
+                    # threshold is inspired by Zipfian assumption, but should only affect speed
+                    threshold = stats[most_frequent] * i / (i + 10000.0)
+                    _BPE._prune_stats(stats, big_stats, threshold)
+                    heap.reset(stats)
+
+                if stats[most_frequent] < min_frequency:
+                    # No pair has frequency >= min_frequency. Stopping
+                    break
+
+                codes.append(most_frequent)
+
+                left, right = most_frequent
+                deltas = shards.merge(most_frequent, _id(names[left] + names[right]))
+
+                # every pair touched by the update is created in stats, even if its overall change is zero
+                for pair, delta in deltas.iteritems():
+                    stats[pair] += delta
+                    heap.update(pair, stats[pair])
+                stats[most_frequent] = 0
+                heap.update(most_frequent, 0)
+
+                if not i % 100:
+                    _BPE._prune_stats(stats, big_stats, threshold)
+                    heap.reset(stats)
+        finally:
+            shards.close()
+
+        codes = [(names[left], names[right]) for left, right in codes]
+
+        # some hacking to deal with duplicates (only consider first instance)
+        codes = dict([(code, i) for (i, code) in reversed(list(enumerate(codes)))])
+
+        return _BPE(codes, separator=separator)
+
+    @staticmethod
+    def _prune_stats(stats, big_stats, threshold):
+        """Prune statistics dict for efficiency of max()
+
+        The frequency of a symbol pair never increases, so pruning is generally safe
+        (until we the most frequent pair is less frequent than a pair we previously pruned)
+        big_stats keeps full statistics for when we need to access pruned items
+        """
+        for item, freq in stats.items():
+            if freq < threshold:
+                del stats[item]
+                if freq < 0:
+                    big_stats[item] += freq
+                else:
+                    big_stats[item] = freq
+
     # Applying
     # ------------------------------------------------------------------------------------------------------------------
 
@@ -219,44 +593,18 @@ class _BPE:
         return output
 
     def _encode(self, _word, vocabulary=None):
-        if _word in self._cache:
-            return self._cache[_word]
-
-        word = tuple(_word[:-1]) + (_word[-1] + '</w>',)
-
-        pairs = self._get_pairs(word)
-
-        if not pairs:
+        if len(_word) < 2:
             return _word
 
-        while True:
-            bigram = min(pairs, key=lambda pair: self.bpe_codes.get(pair, float('inf')))
-            if bigram not in self.bpe_codes:
-                break
-            first, second = bigram
-            new_word = []
-            i = 0
-            while i < len(word):
-                try:
-                    j = word.index(first, i)
-                    new_word.extend(word[i:j])
-                    i = j
-                except:
-                    new_word.extend(word[i:])
-                    break
+        # the vocabulary changes the result, hence it is part of the key: vocabularies are long-lived sets
+        # owned by the processor, so their identity is enough to tell them apart
+        key = (_word, id(vocabulary) if vocabulary is not None else None)
 
-                if word[i] == first and i < len(word) - 1 and word[i + 1] == second:
-                    new_word.append(first + second)
-                    i += 2
-                else:
-                    new_word.append(word[i])
-                    i += 1
-            new_word = tuple(new_word)
-            word = new_word
-            if len(word) == 1:
-                break
-            else:
-                pairs = self._get_pairs(word)
+        word = self._cache.get(key)
+        if word is not None:
+            return word
+
+        word = self._merge(tuple(_word[:-1]) + (_word[-1] + '</w>',))
 
         # don't print end-of-word symbols
         if word[-1] == '</w>':
@@ -267,21 +615,77 @@ class _BPE:
         if vocabulary is not None:
             word = self._check_vocab_and_split(word, vocabulary)
 
-        self._cache[_word] = word
+        self._cache.put(key, word)
         return word
 
-    @staticmethod
-    def _get_pairs(word):
-        """Return set of symbol pairs in a word.
+    def _merge(self, word):
+        """
+        Apply the merge operations to a word (tuple of symbols) in order of rank.
 
-        word is represented as tuple of symbols (symbols being variable-length strings)
+        Symbols are a linked list, and candidate pairs are kept in a heap of (rank, position). As in the
+        original BPE algorithm, all the occurrences of the best pair are merged from left to right before
+        any pair created by these merges is considered.
         """
-        pairs = set()
-        prev_char = word[0]
-        for char in word[1:]:
-            pairs.add((prev_char, char))
-            prev_char = char
-        return pairs
+        length = len(word)
+        symbols = list(word)
+        ids = [self._symbol_ids.get(symbol, -1) for symbol in word]
+        next_pos = range(1, length + 1)
+        prev_pos = range(-1, length - 1)
+
+        merges = self._merges
+
+        heap = []
+        for i in xrange(length - 1):
+            merge = merges.get((ids[i], ids[i + 1]))
+            if merge is not None:
+                heap.append((merge[0], i))
+        heapq.heapify(heap)
+
+        while heap:
+            rank = heap[0][0]
+
+            positions = []
+            while heap and heap[0][0] == rank:
+                positions.append(heapq.heappop(heap)[1])
+            positions.sort()
+
+            merged = []
+            for i in positions:
+                j = next_pos[i]
+
+                # a position is stale if its symbol, or the following one, has been merged in the meantime
+                if symbols[i] is None or j >= length:
+                    continue
+                merge = merges.get((ids[i], ids[j]))
+                if merge is None or merge[0] != rank:
+                    continue
+
+                symbols[i] += symbols[j]
+                ids[i] = merge[1]
+                symbols[j] = None
+
+                next_pos[i] = next_pos[j]
+                if next_pos[j] < length:
+                    prev_pos[next_pos[j]] = i
+
+                merged.append(i)
+
+            for i in merged:
+                p, j = prev_pos[i], next_pos[i]
+
+                if p >= 0:
+                    merge = merges.get((ids[p], ids[i]))
+                    if merge is not None:
+                        heapq.heappush(heap, (merge[0], p))
+                if j < length:
+                    merge = merges.get((ids[i], ids[j]))
+                    if merge is not None:
+                        heapq.heappush(heap, (merge[0], i))
+
+        return tuple(symbol for symbol in symbols if symbol is not None)
+
+    def cache_stats(self):
+        return self._cache.stats()
 
     def _check_vocab_and_split(self, orig, vocabulary):
         """Check for each segment in word if it is in-vocabulary,
@@ -360,6 +764,23 @@ class SubwordTextProcessor:
                                         target_codes=(target_codes if len(target_codes) > 0 else None),
                                         target_terms=target_terms, separator=separator)
 
+    @staticmethod
+    def load_from_binary_file(path):
+        """
+        Load a processor saved with save_to_binary_file(): codes and terms are not read in memory,
+        lookups are served by the memory-mapped file.
+        """
+        tables = TablesFile(path)
+
+        separator = tables.strings('separator')[0]
+        source_codes = _MMapCodes(tables, 'source')
+        source_terms = tables.strings('source.terms')
+        target_codes = _MMapCodes(tables, 'target') if 'target.merge_keys' in tables else None
+        target_terms = tables.strings('target.terms')
+
+        return SubwordTextProcessor(source_codes=source_codes, source_terms=source_terms,
+                                    target_codes=target_codes, target_terms=target_terms, separator=separator)
+
     def __init__(self, source_codes, source_terms, target_codes, target_terms, separator):
         self._separator = separator
         self._source_bpe = _BPE(source_codes, separator)
@@ -400,6 +821,20 @@ class SubwordTextProcessor:
             for term in self._target_terms:
                 out.write(u'%s\n' % term)
 
+    def save_to_binary_file(self, path):
+        parent_folder = os.path.abspath(os.path.join(path, os.pardir))
+        if not os.path.isdir(parent_folder):
+            os.makedirs(parent_folder)
+
+        tables = TablesFile.strings_tables('separator', [self._separator])[0]
+        tables += _MMapCodes.tables('source', self._source_bpe.bpe_codes)
+        tables += TablesFile.strings_tables('source.terms', self._source_terms)[0]
+        if self._target_bpe is not None:
+            tables += _MMapCodes.tables('target', self._target_bpe.bpe_codes)
+        tables += TablesFile.strings_tables('target.terms', self._target_terms)[0]
+
+        TablesFile.save_to_file(path, tables)
+
     def encode_line(self, line, is_source):
         if isinstance(line, str):
             line = line.decode('utf-8')
@@ -413,6 +848,12 @@ class SubwordTextProcessor:
     def decode_tokens(self, tokens):
         return u' '.join(tokens).replace(self._separator + u' ', u'')
 
+    def cache_stats(self):
+        stats = {'source': self._source_bpe.cache_stats()}
+        if self._target_bpe is not None:
+            stats['target'] = self._target_bpe.cache_stats()
+        return stats
+
     def get_words_indexes(self, bpe_tokens):
         indexes = []
         i = 0
@@ -426,13 +867,14 @@ class SubwordTextProcessor:
 
     class Builder:
         def __init__(self, symbols, max_vocabulary_size=None, vocab_pruning_threshold=None, min_frequency=2,
-                     similarity_threshold=.5, separator='@@'):
+                     similarity_threshold=.5, separator='@@', workers=None):
             self._symbols = symbols
             self._max_vocabulary_size = max_vocabulary_size
             self._vocab_pruning_threshold = vocab_pruning_threshold
             self._min_frequency = min_frequency
             self._similarity_threshold = similarity_threshold
             self._separator = separator
+            self._workers = workers if workers is not None else multiprocessing.cpu_count()
 
             self._dictionaries = (Counter(), Counter())
             self._alphabets = (Counter(), Counter())
@@ -456,14 +898,13 @@ class SubwordTextProcessor:
 
             # Learns BPE
             if _cosine_similarity(*self._alphabets) > self._similarity_threshold:
-                source_bpe = _BPE.learn_from_terms(self._dictionaries[0] + self._dictionaries[1], symbols=self._symbols,
-                                                   min_frequency=self._min_frequency, separator=self._separator)
+                source_bpe = self._learn(self._dictionaries[0] + self._dictionaries[1], self._workers)
                 target_bpe = None
+            elif self._workers > 1:
+                source_bpe, target_bpe = self._learn_concurrently(self._dictionaries[0], self._dictionaries[1])
             else:
-                source_bpe = _BPE.learn_from_terms(self._dictionaries[0], symbols=self._symbols,
-                                                   min_frequency=self._min_frequency, separator=self._separator)
-                target_bpe = _BPE.learn_from_terms(self._dictionaries[1], symbols=self._symbols,
-                                                   min_frequency=self._min_frequency, separator=self._separator)
+                source_bpe = self._learn(self._dictionaries[0], 1)
+                target_bpe = self._learn(self._dictionaries[1], 1)
 
             # Create vocabularies
             source_subwords = self._collect_subwords(self._dictionaries[0], source_bpe)
@@ -479,6 +920,57 @@ class SubwordTextProcessor:
 
             return SubwordTextProcessor(source_codes, source_subwords, target_codes, target_subwords, self._separator)
 
+        def _learn(self, terms, workers):
+            return _BPE.learn_from_terms(terms, symbols=self._symbols, min_frequency=self._min_frequency,
+                                         separator=self._separator, workers=workers)
+
+        def _learn_concurrently(self, source_terms, target_terms):
+            # target codes are learned by a child process while the current one learns the source codes;
+            # the child is not a daemon, so that it can start the worker processes of its own shards
+            target_workers = self._workers // 2
+            source_workers = self._workers - target_workers
+
+            results = multiprocessing.Queue()
+
+            def _learn_target():
+                try:
+                    results.put((self._learn(target_terms, target_workers).bpe_codes, None))
+                except BaseException:
+                    results.put((None, traceback.format_exc()))
+
+            process = multiprocessing.Process(target=_learn_target)
+            process.start()
+
+            try:
+                source_bpe = self._learn(source_terms, source_workers)
+                # the result is read before joining: the child cannot exit until its codes are flushed to the queue
+                target_codes, error = self._get_result(results, process)
+            except BaseException:
+                process.terminate()  # the target codes are not needed anymore
+                raise
+            finally:
+                process.join()
+
+            if error is not None:
+                raise Exception('Failed to learn target BPE codes: ' + error)
+
+            return source_bpe, _BPE(target_codes, separator=self._separator)
+
+        @staticmethod
+        def _get_result(results, process, poll_interval=1.):
+            while True:
+                try:
+                    return results.get(timeout=poll_interval)
+                except Queue.Empty:
+                    if process.is_alive():
+                        continue
+
+                # the process could have put its result right before exiting
+                try:
+                    return results.get(timeout=poll_interval)
+                except Queue.Empty:
+                    raise Exception('Target BPE learning process died unexpectedly (exit code %s)' % process.exitcode)
+
         def _add_line(self, line, is_source=True):
             if isinstance(line, str):
                 line = line.decode('utf-8')
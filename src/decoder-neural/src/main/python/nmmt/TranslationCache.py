@@ -0,0 +1,124 @@
+import hashlib
+import logging
+import sys
+import threading
+from collections import OrderedDict
+
+
+class TranslationCache(object):
+    """
+    LRU cache of the translations of a decoder, bounded by the (estimated) memory taken by its entries.
+
+    Keys are built by key(): the first element of a key is the model that produced the translation, so that all
+    the entries of a model can be invalidated when it is reloaded. Hits and misses are logged every 'log_interval'
+    lookups.
+    """
+
+    _ENTRY_OVERHEAD = 200  # bytes taken by the key tuple, the list of translations and the map entry
+    _TRANSLATION_OVERHEAD = sys.getsizeof(object()) + sys.getsizeof({})  # an object and its attributes
+    _ALIGNMENT_POINT_SIZE = sys.getsizeof((0, 0)) + 2 * sys.getsizeof(0)
+
+    @staticmethod
+    def normalize(text):
+        # the decoder splits the text on whitespaces: their number and kind do not change the translation
+        if isinstance(text, str):
+            text = text.decode('utf-8')
+        return u' '.join(text.split())
+
+    @staticmethod
+    def key(model, text, n_best=1, beam_size=None, max_sent_length=None, suggestions=None,
+            tuning_epochs=None, tuning_learning_rate=None, tuning_mode=None, shortlist=None):
+        if suggestions is not None and len(suggestions) > 0:
+            digest = hashlib.md5()
+            for suggestion in suggestions:
+                for value in (suggestion.source, suggestion.target, repr(suggestion.score)):
+                    digest.update(value.encode('utf-8') if isinstance(value, unicode) else value)
+                    digest.update('\0')
+            suggestions = (digest.hexdigest(), tuning_epochs, tuning_learning_rate, tuning_mode)
+        else:
+            suggestions = None
+
+        return model, TranslationCache.normalize(text), n_best, beam_size, max_sent_length, shortlist, suggestions
+
+    def __init__(self, max_bytes, log_interval=1000):
+        self._logger = logging.getLogger('nmmt.TranslationCache')
+        self._max_bytes = max_bytes
+        self._log_interval = log_interval
+
+        self._entries = OrderedDict()  # key -> (translations, size), from the least to the most recently used
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size(self):
+        return self._bytes
+
+    def _sizeof(self, key, translations):
+        size = self._ENTRY_OVERHEAD + sys.getsizeof(key[1])
+
+        for translation in translations:
+            size += self._TRANSLATION_OVERHEAD + sys.getsizeof(translation.text)
+            if translation.alignment:
+                size += sys.getsizeof(translation.alignment) + \
+                        len(translation.alignment) * self._ALIGNMENT_POINT_SIZE
+
+        return size
+
+    def get(self, key):
+        """
+        :return: the list of translations cached for the key, or None if missing
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries[key] = entry  # the entry becomes the most recently used
+
+            if (self.hits + self.misses) % self._log_interval == 0:
+                self.log_stats()
+
+        return list(entry[0]) if entry is not None else None
+
+    def put(self, key, translations):
+        size = self._sizeof(key, translations)
+        if size > self._max_bytes:
+            return
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+
+            self._entries[key] = (list(translations), size)
+            self._bytes += size
+
+            while self._bytes > self._max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+
+    def invalidate(self, model=None):
+        """
+        Remove the entries of the given model, or all the entries if model is None.
+        """
+        with self._lock:
+            if model is None:
+                self._entries.clear()
+                self._bytes = 0
+            else:
+                for key in [k for k in self._entries if k[0] == model]:
+                    self._bytes -= self._entries.pop(key)[1]
+
+    def log_stats(self):
+        lookups = self.hits + self.misses
+        self._logger.info('Translation cache: %d hits, %d misses (%.1f%% hit rate), %d entries, %.1f MB' %
+                          (self.hits, self.misses, 100. * self.hits / lookups if lookups > 0 else 0.,
+                           len(self._entries), self._bytes / (1024. * 1024.)))
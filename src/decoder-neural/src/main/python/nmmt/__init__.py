@@ -3,8 +3,12 @@ from models import Suggestion, Translation
 from NMTDecoder import NMTDecoder
 from NMTEngine import NMTEngine
 from NMTEngineTrainer import NMTEngineTrainer
-from IDataset import IDataset, DatasetWrapper
+from IDataset import IDataset, DatasetWrapper, PrefetchIterator
 from MMapDataset import MMapDataset
+from MMapDict import MMapDict
+from MMapWeights import MMapWeights
+from LexicalTable import LexicalTable
+from TranslationCache import TranslationCache
 from SubwordTextProcessor import SubwordTextProcessor
 
 from torch_utils import torch_setup, torch_get_gpus, torch_is_multi_gpu, torch_is_using_cuda
@@ -1,7 +1,12 @@
 class Translation(object):
-    def __init__(self, text, alignment=None):
+    DECODER = 'decoder'
+    CACHE = 'cache'
+    TRANSLATION_MEMORY = 'tm'
+
+    def __init__(self, text, alignment=None, origin=DECODER):
         self.text = text
         self.alignment = alignment
+        self.origin = origin  # what served the translation: decoder, cache or translation memory
 
 
 class Suggestion(object):
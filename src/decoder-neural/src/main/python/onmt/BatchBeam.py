@@ -0,0 +1,152 @@
+from __future__ import division
+import torch
+import onmt
+
+"""
+ Class for managing the beam search process of a whole batch of sentences.
+
+ Unlike `onmt.Beam`, which handles a single sentence, scores, back-pointers,
+ outputs and completion flags of every sentence in the batch are stored in
+ single tensors: at each time-step the beam is advanced with one top-k and
+ one gather, regardless of the batch size.
+
+ Sentences that completed (or that are not decoded anymore) are kept frozen:
+ their scores do not change and their back-pointers are the identity.
+
+ If the generator scores only a subset of the target vocabulary, `vocab` maps
+ its outputs to the words of the vocabulary: the beam stores the words.
+"""
+
+
+class BatchBeam(object):
+    def __init__(self, batchSize, size, cuda=False, vocab=None):
+
+        self.batchSize = batchSize
+        self.size = size
+        self.vocab = vocab
+
+        self.tt = torch.cuda if cuda else torch
+
+        # The score for each translation on the beam (batch x beam).
+        self.scores = self.tt.FloatTensor(batchSize, size).zero_()
+        self.allScores = []
+
+        # Completion flag and length (in steps) of each sentence.
+        self.done = self.tt.ByteTensor(batchSize).zero_()
+        self.lengths = self.tt.LongTensor(batchSize).zero_()
+
+        # The backpointers at each time-step (batch x beam).
+        self.prevKs = []
+
+        # The outputs at each time-step (batch x beam).
+        self.nextYs = [self.tt.LongTensor(batchSize, size).fill_(onmt.Constants.PAD)]
+        self.nextYs[0][:, 0] = onmt.Constants.BOS
+
+        # The attentions (batch x beam x sourceL) for each time.
+        self.attn = []
+
+        self._identity = self.tt.LongTensor(list(range(size))).unsqueeze(0).expand(batchSize, size)
+
+    def getCurrentState(self, activeIdx):
+        "Get the outputs for the current timestep of the sentences in `activeIdx`."
+        return self.nextYs[-1].index_select(0, activeIdx)
+
+    def getCurrentOrigin(self, activeIdx):
+        "Get the backpointers for the current timestep of the sentences in `activeIdx`."
+        return self.prevKs[-1].index_select(0, activeIdx)
+
+    def isDone(self):
+        return self.done.min() == 1
+
+    def advance(self, wordLk, attnOut, activeIdx):
+        """
+        Given prob over words for every last beam `wordLk` and attention
+        `attnOut`: Compute and update the beam search.
+
+        Parameters:
+
+        * `wordLk`- probs of advancing from the last step (active x K x words)
+        * `attnOut`- attention at the last step (active x K x sourceL)
+        * `activeIdx`- batch indexes of the sentences in `wordLk` and `attnOut`
+
+        Returns: True if beam search is complete for every sentence.
+        """
+        activeSents = wordLk.size(0)
+        numWords = wordLk.size(2)
+
+        # Sum the previous scores.
+        if len(self.prevKs) > 0:
+            scores = self.scores.index_select(0, activeIdx)
+            beamLk = wordLk + scores.unsqueeze(2).expand_as(wordLk)
+        else:
+            beamLk = wordLk[:, 0]
+
+        flatBeamLk = beamLk.contiguous().view(activeSents, -1)
+
+        bestScores, bestScoresId = flatBeamLk.topk(self.size, 1, True, True)
+
+        # bestScoresId is flattened beam x word array, so calculate which
+        # word and beam each score came from
+        prevK = bestScoresId / numWords
+        nextY = bestScoresId - prevK * numWords
+        if self.vocab is not None:
+            nextY = self.vocab.index_select(0, nextY.view(-1)).view_as(nextY)
+        attn = attnOut.gather(1, prevK.unsqueeze(2).expand_as(attnOut))
+
+        # Sentences not in activeIdx do not move
+        allPrevK = self._identity.clone()
+        allNextY = self.tt.LongTensor(self.batchSize, self.size).fill_(onmt.Constants.PAD)
+        allAttn = attnOut.new(self.batchSize, self.size, attnOut.size(2)).zero_()
+
+        allPrevK.index_copy_(0, activeIdx, prevK)
+        allNextY.index_copy_(0, activeIdx, nextY)
+        allAttn.index_copy_(0, activeIdx, attn)
+        self.scores.index_copy_(0, activeIdx, bestScores)
+
+        self.prevKs.append(allPrevK)
+        self.nextYs.append(allNextY)
+        self.attn.append(allAttn)
+        self.allScores.append(self.scores.clone())
+
+        # End condition is when top-of-beam is EOS.
+        finished = allNextY[:, 0].eq(onmt.Constants.EOS)
+        self.lengths.masked_fill_(finished, len(self.prevKs))
+        self.done.masked_fill_(finished, 1)
+
+        return self.isDone()
+
+    def sortBest(self):
+        return torch.sort(self.scores, 1, True)
+
+    def getLengths(self):
+        "Get the number of steps of every sentence."
+        steps = len(self.prevKs)
+        return [l if d else steps for l, d in zip(self.lengths.tolist(), self.done.tolist())]
+
+    def getHyps(self, ks):
+        """
+        Walk back to construct the full hypotheses of every sentence at once.
+
+        Parameters.
+
+             * `ks` - the positions in the beam to construct (batch x n).
+
+         Returns.
+
+            1. The tokens of every hypothesis (steps x batch x n).
+            2. The attention at each time step (steps x batch x n x sourceL).
+        """
+        steps = len(self.prevKs)
+        n = ks.size(1)
+        sourceL = self.attn[0].size(2)
+
+        hyps = self.tt.LongTensor(steps, self.batchSize, n)
+        attn = self.attn[0].new(steps, self.batchSize, n, sourceL)
+
+        k = ks.clone()
+        for j in range(steps - 1, -1, -1):
+            hyps[j] = self.nextYs[j + 1].gather(1, k)
+            attn[j] = self.attn[j].gather(1, k.unsqueeze(2).expand(self.batchSize, n, sourceL))
+            k = self.prevKs[j].gather(1, k)
+
+        return hyps, attn
@@ -2,6 +2,7 @@ import onmt
 import onmt.Models
 import onmt.modules
 import torch.nn as nn
+import torch.nn.functional as F
 import torch
 from torch.autograd import Variable
 
@@ -13,6 +14,19 @@ def loadImageLibs():
     from torchvision import transforms
 
 
+class _ShortlistLinear(nn.Module):
+    "Rows `shortlist` of a Linear layer, without a new (initialized) Linear."
+    def __init__(self, linear, shortlist):
+        super(_ShortlistLinear, self).__init__()
+        self.weight = Variable(linear.weight.data.index_select(0, shortlist))
+        self.bias = None
+        if linear.bias is not None:
+            self.bias = Variable(linear.bias.data.index_select(0, shortlist))
+
+    def forward(self, input):
+        return F.linear(input, self.weight, self.bias)
+
+
 class Translator(object):
     def __init__(self, opt):
         self.opt = opt
@@ -113,7 +127,27 @@ class Translator(object):
                 alignment.append((j, i))
         return alignment
 
-    def translateBatch(self, srcBatch, tgtBatch):
+    def shortlistGenerator(self, shortlist, generator=None):
+        "Copy of the generator scoring only the target words in `shortlist`."
+        if generator is None:
+            generator = self.model.generator
+        if isinstance(generator, nn.DataParallel):
+            generator = generator.module
+
+        layers = list(generator.children())
+        for i in range(len(layers) - 1, -1, -1):
+            if isinstance(layers[i], nn.Sequential):
+                # e.g. an adapter in front of the original generator
+                layers[i] = self.shortlistGenerator(shortlist, layers[i])
+                break
+
+            if isinstance(layers[i], nn.Linear):
+                layers[i] = _ShortlistLinear(layers[i], shortlist)
+                break
+
+        return nn.Sequential(*layers)
+
+    def translateBatch(self, srcBatch, tgtBatch, shortlist=None):
         # Batch size is in different location depending on data.
 
         beamSize = self.opt.beam_size
@@ -168,7 +202,14 @@ class Translator(object):
         decStates = (Variable(encStates[0].data.repeat(1, beamSize, 1)),
                      Variable(encStates[1].data.repeat(1, beamSize, 1)))
 
-        beam = [onmt.Beam(beamSize, self.opt.cuda) for k in range(batchSize)]
+        # with a shortlist, the generator is restricted to its words for the
+        # whole decoding, and the beam maps them back to the vocabulary
+        generator = self.model.generator
+        if shortlist is not None:
+            generator = self.shortlistGenerator(shortlist)
+
+        beam = onmt.BatchBeam(batchSize, beamSize, self.opt.cuda,
+                              vocab=shortlist)
 
         decOut = self.model.make_init_decoder_output(context)
 
@@ -178,18 +219,18 @@ class Translator(object):
                                    .unsqueeze(0) \
                                    .repeat(beamSize, 1, 1)
 
-        batchIdx = list(range(batchSize))
+        # batch indexes of the sentences still being decoded
+        activeIdx = self.tt.LongTensor(list(range(batchSize)))
         remainingSents = batchSize
         for i in range(self.opt.max_sent_length):
             mask(padMask)
             # Prepare decoder input.
-            input = torch.stack([b.getCurrentState() for b in beam
-                                 if not b.done]).t().contiguous().view(1, -1)
+            input = beam.getCurrentState(activeIdx).t().contiguous().view(1, -1)
             decOut, decStates, attn = self.model.decoder(
                 Variable(input, volatile=True), decStates, context, decOut)
             # decOut: 1 x (beam*batch) x numWords
             decOut = decOut.squeeze(0)
-            out = self.model.generator.forward(decOut)
+            out = generator.forward(decOut)
 
             # batch x beam x numWords
             wordLk = out.view(beamSize, remainingSents, -1) \
@@ -197,38 +238,37 @@ class Translator(object):
             attn = attn.view(beamSize, remainingSents, -1) \
                        .transpose(0, 1).contiguous()
 
-            active = []
-            for b in range(batchSize):
-                if beam[b].done:
-                    continue
-
-                idx = batchIdx[b]
-                if not beam[b].advance(wordLk.data[idx], attn.data[idx]):
-                    active += [b]
-
-                for decState in decStates:  # iterate over h, c
-                    # layers x beam*sent x dim
-                    sentStates = decState.view(-1, beamSize,
-                                               remainingSents,
-                                               decState.size(2))[:, :, idx]
-                    sentStates.data.copy_(
-                        sentStates.data.index_select(
-                            1, beam[b].getCurrentOrigin()))
-
-            if not active:
+            done = beam.advance(wordLk.data, attn.data, activeIdx)
+
+            # states are laid out as beam x sent: the state of beam k of the
+            # j-th active sentence is at position (k * remainingSents + j)
+            origin = beam.getCurrentOrigin(activeIdx).t() * remainingSents
+            origin += self.tt.LongTensor(list(range(remainingSents))) \
+                             .unsqueeze(0).expand_as(origin)
+            origin = origin.contiguous().view(-1)
+
+            decStates = tuple(Variable(decState.data.index_select(1, origin),
+                                       volatile=True)
+                              for decState in decStates)
+
+            if done:
                 break
 
             # in this section, the sentences that are still active are
             # compacted so that the decoder is not run on completed sentences
-            activeIdx = self.tt.LongTensor([batchIdx[k] for k in active])
-            batchIdx = {beam: idx for idx, beam in enumerate(active)}
+            active = beam.done.index_select(0, activeIdx).eq(0) \
+                                                        .nonzero().squeeze(1)
+            if active.size(0) == remainingSents:
+                continue
+
+            activeIdx = activeIdx.index_select(0, active)
 
             def updateActive(t):
                 # select only the remaining active sentences
                 view = t.data.view(-1, remainingSents, rnnSize)
                 newSize = list(t.size())
-                newSize[-2] = newSize[-2] * len(activeIdx) // remainingSents
-                return Variable(view.index_select(1, activeIdx)
+                newSize[-2] = newSize[-2] * len(active) // remainingSents
+                return Variable(view.index_select(1, active)
                                 .view(*newSize), volatile=True)
 
             decStates = (updateActive(decStates[0]),
@@ -236,7 +276,7 @@ class Translator(object):
             decOut = updateActive(decOut)
             context = updateActive(context)
             if useMasking:
-                padMask = padMask.index_select(1, activeIdx)
+                padMask = padMask.index_select(1, active)
 
             remainingSents = len(active)
 
@@ -244,12 +284,17 @@ class Translator(object):
         allHyp, allScores, allAttn = [], [], []
         n_best = self.opt.n_best
 
+        scores, ks = beam.sortBest()
+        hyps, attns = beam.getHyps(ks[:, :n_best].contiguous())
+        lengths = beam.getLengths()
+
         for b in range(batchSize):
-            scores, ks = beam[b].sortBest()
+            length = lengths[b]
 
-            allScores += [scores[:n_best]]
-            hyps, attn = zip(*[beam[b].getHyp(k) for k in ks[:n_best]])
-            allHyp += [hyps]
+            allScores += [scores[b][:n_best]]
+            hyps_b = [hyps[:length, b, n].tolist() for n in range(n_best)]
+            attn = [attns[:length, b, n] for n in range(n_best)]
+            allHyp += [hyps_b]
             if useMasking:
                 valid_attn = srcBatch.data[:, b].ne(onmt.Constants.PAD) \
                                                 .nonzero().squeeze(1)
@@ -258,26 +303,30 @@ class Translator(object):
 
             if self.beam_accum:
                 self.beam_accum["beam_parent_ids"].append(
-                    [t.tolist()
-                     for t in beam[b].prevKs])
+                    [t[b].tolist()
+                     for t in beam.prevKs[:length]])
                 self.beam_accum["scores"].append([
-                    ["%4f" % s for s in t.tolist()]
-                    for t in beam[b].allScores][1:])
+                    ["%4f" % s for s in t[b].tolist()]
+                    for t in beam.allScores[:length]])
                 self.beam_accum["predicted_ids"].append(
                     [[self.tgt_dict.getLabel(id)
-                      for id in t.tolist()]
-                     for t in beam[b].nextYs][1:])
+                      for id in t[b].tolist()]
+                     for t in beam.nextYs[1:length + 1]])
 
         return allHyp, allScores, allAttn, goldScores
 
-    def translate(self, srcBatch, goldBatch):
+    def translate(self, srcBatch, goldBatch, shortlist=None):
         #  (1) convert words to indexes
         dataset = self.buildData(srcBatch, goldBatch)
         src, tgt, indices = dataset[0]
         batchSize = self._getBatchSize(src[0])
 
+        if shortlist is not None and self.opt.cuda:
+            shortlist = shortlist.cuda()
+
         #  (2) translate
-        pred, predScore, attn, goldScore = self.translateBatch(src, tgt)
+        pred, predScore, attn, goldScore = self.translateBatch(src, tgt,
+                                                               shortlist)
         pred, predScore, attn, goldScore = list(zip(
             *sorted(zip(pred, predScore, attn, goldScore, indices),
                     key=lambda x: x[-1])))[:-1]
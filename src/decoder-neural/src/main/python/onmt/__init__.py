@@ -5,6 +5,7 @@ from Dataset import Dataset
 from Optim import Optim
 from Dict import Dict
 from Beam import Beam
+from BatchBeam import BatchBeam
 
 # For flake8 compatibility.
-__all__ = [Constants, Models, Translator, Dataset, Optim, Dict, Beam]
+__all__ = [Constants, Models, Translator, Dataset, Optim, Dict, Beam, BatchBeam]
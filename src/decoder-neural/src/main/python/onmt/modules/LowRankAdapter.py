@@ -0,0 +1,25 @@
+"""
+Residual low-rank projection of its input: x + up(down(x)).
+
+The up projection is initialized to zero, hence a newly created (or reset)
+adapter does not change the output of the module it is put in front of.
+Training only the adapter is a cheap way to specialize a frozen model.
+"""
+
+import torch.nn as nn
+
+
+class LowRankAdapter(nn.Module):
+    def __init__(self, dim, rank, init_value=0.1):
+        super(LowRankAdapter, self).__init__()
+        self.down = nn.Linear(dim, rank, bias=False)
+        self.up = nn.Linear(rank, dim, bias=False)
+        self.init_value = init_value
+        self.resetParameters()
+
+    def resetParameters(self):
+        self.down.weight.data.uniform_(-self.init_value, self.init_value)
+        self.up.weight.data.zero_()
+
+    def forward(self, input):
+        return input + self.up(self.down(input))
@@ -1,5 +1,6 @@
 from onmt.modules.GlobalAttention import GlobalAttention
 from onmt.modules.ImageEncoder import ImageEncoder
+from onmt.modules.LowRankAdapter import LowRankAdapter
 
 # For flake8 compatibility.
-__all__ = [GlobalAttention, ImageEncoder]
+__all__ = [GlobalAttention, ImageEncoder, LowRankAdapter]
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+from itertools import izip
+from optparse import OptionParser
+
+MMT_HOME = os.path.abspath(os.path.join(__file__, os.pardir, os.pardir, os.pardir, os.pardir))
+sys.path.insert(0, os.path.join(MMT_HOME, 'src', 'decoder-neural', 'src', 'main', 'python'))
+
+from nmmt import SubwordTextProcessor
+
+DATA_DIR = os.path.join(MMT_HOME, 'test', 'tests', 'tag_projection_precision_test', 'data')
+
+
+class _Corpus:
+    TAG_RE = re.compile(r'<[^>]+>')
+
+    def __init__(self, source_file, target_file):
+        self._source_file = source_file
+        self._target_file = target_file
+        self._streams = None
+
+    def __enter__(self):
+        self._streams = (open(self._source_file), open(self._target_file))
+        return self
+
+    def __exit__(self, *_):
+        for stream in self._streams:
+            stream.close()
+
+    def __iter__(self):
+        for source, target in izip(*self._streams):
+            yield self.TAG_RE.sub(' ', source.decode('utf-8')), target.decode('utf-8')
+
+
+class BPEFormatsTest:
+    def __init__(self, source_file, target_file, symbols, vocabulary_size, verbosity_level):
+        self.__source_file = source_file
+        self.__target_file = target_file
+        self.__symbols = int(symbols)
+        self.__vocabulary_size = int(vocabulary_size)
+        self.__verbosity_level = verbosity_level
+
+    def log(self, message):
+        if int(self.__verbosity_level) > 0:
+            print message
+
+    def start_test(self):
+        working_dir = tempfile.mkdtemp()
+
+        try:
+            results = self.launch(working_dir)
+            json_response = {"passed": results['different_lines'] == 0, "results": results}
+        except Exception as e:
+            json_response = {"passed": False, "error": str(e)}
+        finally:
+            shutil.rmtree(working_dir, ignore_errors=True)
+
+        print json.dumps(json_response)
+
+    @staticmethod
+    def with_alternative_merges(processor):
+        # learned codes rarely produce a symbol with more than one merge: for every merge (l1 + l2, r) of the
+        # learned codes, the alternative merge (l1, l2 + r) is added with a higher rank
+        def _augment(codes):
+            merges = dict([(left + right, (left, right)) for left, right in codes])
+            augmented = dict(codes)
+
+            for (left, right), rank in sorted(codes.iteritems(), key=lambda code: code[1]):
+                if left in merges and merges[left][1] + right in merges:
+                    alternative = (merges[left][0], merges[left][1] + right)
+                    if alternative not in augmented:
+                        augmented[alternative] = len(augmented)
+
+            return augmented
+
+        target_bpe = processor._target_bpe
+        return SubwordTextProcessor(source_codes=_augment(processor._source_bpe.bpe_codes),
+                                    source_terms=set(processor.get_source_terms()),
+                                    target_codes=_augment(target_bpe.bpe_codes) if target_bpe is not None else None,
+                                    target_terms=set(processor.get_target_terms()),
+                                    separator=processor._separator)
+
+    def launch(self, working_dir):
+        builder = SubwordTextProcessor.Builder(symbols=self.__symbols, max_vocabulary_size=self.__vocabulary_size,
+                                               workers=1)
+        processor = self.with_alternative_merges(builder.build([_Corpus(self.__source_file, self.__target_file)]))
+
+        processor.save_to_file(os.path.join(working_dir, 'model.bpe'))
+        processor.save_to_binary_file(os.path.join(working_dir, 'model.mbpe'))
+
+        text_processor = SubwordTextProcessor.load_from_file(os.path.join(working_dir, 'model.bpe'))
+        mmap_processor = SubwordTextProcessor.load_from_binary_file(os.path.join(working_dir, 'model.mbpe'))
+
+        lines, different_lines = 0, 0
+
+        with _Corpus(self.__source_file, self.__target_file) as corpus:
+            for source, target in corpus:
+                for line, is_source in ((source, True), (target, False)):
+                    expected = text_processor.encode_line(line, is_source=is_source)
+                    actual = mmap_processor.encode_line(line, is_source=is_source)
+
+                    lines += 1
+                    if expected != actual:
+                        self.log('Different encodings: "%s" vs "%s"' % (' '.join(expected), ' '.join(actual)))
+                        different_lines += 1
+
+        # symbols produced by more than one merge: their split depends on which merge is reversed
+        merged = [left + right for left, right in processor._source_bpe.bpe_codes]
+
+        return {
+            'lines': lines,
+            'different_lines': different_lines,
+            'symbols_with_several_merges': len(merged) - len(set(merged))
+        }
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-s", "--source_file", dest="source_file",
+                      default=os.path.join(DATA_DIR, 'TagBenchmark.src.en'),
+                      help="the source side of the corpus (default: the tag benchmark)")
+    parser.add_option("-t", "--target_file", dest="target_file",
+                      default=os.path.join(DATA_DIR, 'TagBenchmark.test.it'),
+                      help="the target side of the corpus (default: the tag benchmark)")
+    parser.add_option("-n", "--symbols", dest="symbols", default="4000",
+                      help="the number of BPE merges (default 4000)")
+    parser.add_option("-z", "--vocabulary-size", dest="vocabulary_size", default="1000",
+                      help="the maximum size of the vocabularies (default 1000)")
+    parser.add_option("-v", "--verbosity-level", dest="verbosity_level", default="0",
+                      help="the verbosity level: should be 0=default,1")
+    options, _ = parser.parse_args()
+
+    test = BPEFormatsTest(**vars(options))
+    test.start_test()
@@ -0,0 +1,6 @@
+#!/bin/sh
+#Launch your test here
+
+wdir=$(cd $(dirname $0) ; pwd)
+
+cd $wdir ; python ${wdir}/bpe_formats_test.py "$@"
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+import json
+import os
+import shutil
+import sys
+import tempfile
+from optparse import OptionParser
+
+MMT_HOME = os.path.abspath(os.path.join(__file__, os.pardir, os.pardir, os.pardir, os.pardir))
+sys.path.insert(0, os.path.join(MMT_HOME, 'src', 'decoder-neural', 'src', 'main', 'python'))
+
+import onmt
+from nmmt import NMTEngine, MMapWeights
+
+
+class MMapWeightsTest:
+    def __init__(self, context_gate, verbosity_level):
+        self.__context_gate = context_gate
+        self.__verbosity_level = verbosity_level
+
+    def log(self, message):
+        if int(self.__verbosity_level) > 0:
+            print message
+
+    def new_engine(self):
+        words = [onmt.Constants.PAD_WORD, onmt.Constants.UNK_WORD, onmt.Constants.BOS_WORD, onmt.Constants.EOS_WORD]
+        src_dict = onmt.Dict(words + ['a', 'b', 'c'], lower=False)
+        trg_dict = onmt.Dict(words + ['x', 'y', 'z', 'w'], lower=False)
+
+        metadata = NMTEngine.Metadata()
+        metadata.layers = 1
+        metadata.rnn_size = 8
+        metadata.word_vec_size = 8
+        metadata.context_gate = self.__context_gate
+
+        engine = NMTEngine.new_instance(src_dict, trg_dict, None, metadata=metadata)
+        engine.running_state = NMTEngine.WARM
+
+        return engine
+
+    def start_test(self):
+        working_dir = tempfile.mkdtemp()
+
+        try:
+            results = self.launch(os.path.join(working_dir, 'model'))
+            json_response = {"passed": results['mismatches'] == 0, "results": results}
+        except Exception as e:
+            json_response = {"passed": False, "error": str(e)}
+        finally:
+            shutil.rmtree(working_dir, ignore_errors=True)
+
+        print json.dumps(json_response)
+
+    def launch(self, path):
+        engine = self.new_engine()
+        engine.save(path, store_processor=False)
+
+        # the weights of the new engine are initialized at random, then replaced by the mapped ones
+        loaded = self.new_engine()
+        MMapWeights.load_from_file(path + '.mdat').bind(loaded.model, loaded.model.generator)
+
+        expected = engine.model.state_dict()
+        actual = loaded.model.state_dict()
+
+        mismatches = 0
+        for name, tensor in expected.iteritems():
+            if name not in actual or not tensor.equal(actual[name]):
+                self.log('Weights mismatch: %s' % name)
+                mismatches += 1
+
+        return {
+            'tensors': len(expected),
+            'longest_name': max([len(name) for name in expected]),
+            'mismatches': mismatches
+        }
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-g", "--context-gate", dest="context_gate", default="both",
+                      help="the context gate of the engine: source, target or both (default both)")
+    parser.add_option("-v", "--verbosity-level", dest="verbosity_level", default="0",
+                      help="the verbosity level: should be 0=default,1")
+    options, _ = parser.parse_args()
+
+    test = MMapWeightsTest(**vars(options))
+    test.start_test()
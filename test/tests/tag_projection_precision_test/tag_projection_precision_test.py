@@ -1,11 +1,19 @@
 #!/usr/bin/env python
-import json, re, requests, time
+import json, os, re, requests, sys, time
 from itertools import izip
 from optparse import OptionParser
 
+MMT_HOME = os.path.abspath(os.path.join(__file__, os.pardir, os.pardir, os.pardir, os.pardir))
+sys.path.insert(0, MMT_HOME)
+
+from cli.libs.scoring import post_editing_efforts
+
 
 class TagProjectionPricisionTest:
-    MIN_PEE = 0.05
+    # PEE is the word edit distance between the projected translation and the reference, normalized by length,
+    # where tags are words too (it replaces the Matecat match score, which is not comparable). On the benchmark,
+    # a projection dropping every tag scores 0.26, misplacing one tag in half of the sentences scores 0.10
+    MAX_PEE = 0.10
     TAG_RE = re.compile(r'<[^>]+>')
     TAG_POS_RE = re.compile(r'.*?<[^>]+>.*?')
 
@@ -77,7 +85,7 @@ class TagProjectionPricisionTest:
                             wrong_positions += 1
                 tot_query_time += time.time() - start_time
 
-                translations.append(translation)
+                translations.append(tagged_translation)
                 references.append(reference)
 
                 self.log("precision: " + str(precision)
@@ -105,6 +113,7 @@ class TagProjectionPricisionTest:
         avg_pee = self.get_avg_post_editing_effort(translations, references)
 
         return {'average PEE': round(100 * avg_pee) / 100,
+                'PEE metric': 'word edit distance',
                 'precision': round(100 * precision / (num_lines - err), 2),
                 'encoding_errors': round(100 * err / num_lines, 2),
                 'more_tags': round(100 * more_tags / (num_lines - err), 2),
@@ -133,23 +142,11 @@ class TagProjectionPricisionTest:
         return tagged_tags == reference_tags
 
     def check_results(self, results):
-        return results['average PEE'] <= TagProjectionPricisionTest.MIN_PEE
+        return results['average PEE'] <= TagProjectionPricisionTest.MAX_PEE
 
     def get_avg_post_editing_effort(self, translations, references):
-        url = 'http://api.mymemory.translated.net/computeMatch.php'
-
-        data = {
-            'sentences': translations,
-            'reference_sentences': references
-        }
-
-        r = requests.post(url, data=json.dumps(data), headers={'Content-type': 'application/json'})
-        body = r.json()
-
-        if r.status_code != requests.codes.ok:
-            raise Exception('Matecat Score service not available (' + str(r.status_code) + '): ' + body['error'])
-
-        return 1 - sum(body) / len(body)
+        efforts = post_editing_efforts(translations, references)
+        return sum(efforts) / len(efforts)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+import json
+import threading
+import time
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    """
+    A local stand-in of the MMT REST API implementing the "translate" and "translate/batch" actions: the translation
+    of a sentence is the sentence with its words in reverse order. The context vector of the request is echoed in
+    the 'contextVector' field of every translation. Every request takes 'latency' seconds.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.01):
+        HTTPServer.__init__(self, ('localhost', port), _Handler)
+        self.latency = latency
+
+        self.requests = 0
+        self.batch_requests = 0
+        self.sentences = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self._thread.join()
+        self.server_close()
+
+    @staticmethod
+    def translate(text):
+        return ' '.join(reversed(text.split()))
+
+    def on_request(self, sentences, batch):
+        with self._lock:
+            self.requests += 1
+            self.sentences += sentences
+            if batch:
+                self.batch_requests += 1
+
+        time.sleep(self.latency)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive connections, like the real API
+
+    def log_message(self, *_):
+        pass
+
+    def _params(self):
+        query = urlparse.urlparse(self.path).query
+        return dict((k, v[0].decode('utf-8')) for k, v in urlparse.parse_qs(query).iteritems())
+
+    def _reply(self, status, data):
+        body = json.dumps({'status': status, 'data': data} if status == 200 else
+                          {'status': status, 'error': {'type': 'StandInError', 'message': data}})
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    @staticmethod
+    def _translation(text, context_vector):
+        translation = StandInServer.translate(text)
+        return {
+            'decodingTime': 0,
+            'translation': translation,
+            'sourceWordCount': len(text.split()),
+            'targetWordCount': len(translation.split()),
+            'contextVector': context_vector
+        }
+
+    def do_GET(self):
+        path = urlparse.urlparse(self.path).path.strip('/')
+        params = self._params()
+
+        if path != 'translate' or 'q' not in params:
+            self._reply(404, 'unknown action: ' + path)
+            return
+
+        self.server.on_request(1, batch=False)
+        self._reply(200, self._translation(params['q'], params.get('context_vector', None)))
+
+    def do_POST(self):
+        path = urlparse.urlparse(self.path).path.strip('/')
+        params = self._params()
+        body = self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+
+        if path != 'translate/batch':
+            self._reply(404, 'unknown action: ' + path)
+            return
+
+        try:
+            queries = json.loads(body)['q']
+        except (ValueError, KeyError):
+            self._reply(400, 'missing parameter: q')
+            return
+
+        self.server.on_request(len(queries), batch=True)
+        self._reply(200, [self._translation(q, params.get('context_vector', None)) for q in queries])
+
+
+if __name__ == '__main__':
+    import sys
+
+    server = StandInServer(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8045)
+    print 'Stand-in MMT API listening on port %d' % server.port
+    server.serve_forever()
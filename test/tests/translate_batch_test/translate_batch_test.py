@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+import json
+import os
+import sys
+import threading
+from optparse import OptionParser
+
+MMT_HOME = os.path.abspath(os.path.join(__file__, os.pardir, os.pardir, os.pardir, os.pardir))
+sys.path.insert(0, MMT_HOME)
+
+from cli.mmt.cluster import ClusterNode
+from standin_server import StandInServer
+
+
+class TranslateBatchTest:
+    def __init__(self, threads, sentences, verbosity_level):
+        self.__threads = int(threads)
+        self.__sentences = int(sentences)
+        self.__verbosity_level = verbosity_level
+
+    def log(self, message):
+        if int(self.__verbosity_level) > 0:
+            print message
+
+    def start_test(self):
+        server = StandInServer()
+        server.start()
+
+        try:
+            results = self.launch(server)
+            passed = results['errors'] == 0 and results['requests'] < results['sentences']
+            json_response = {"passed": passed, "results": results}
+        except Exception as e:
+            json_response = {"passed": False, "error": str(e)}
+        finally:
+            server.stop()
+
+        print json.dumps(json_response)
+
+    def launch(self, server):
+        api = ClusterNode.Api(port=server.port, pool_size=self.__threads)
+        coalescer = ClusterNode.TranslationCoalescer(api)
+
+        # two contexts: sentences with a different context must never be grouped together
+        contexts = [None, [{'memory': 1, 'score': 0.5}]]
+        sentences = [(u'sentence %d of thread %d \u00e8' % (i, t), contexts[(t + i) % 2])
+                     for t in range(self.__threads) for i in range(self.__sentences)]
+        errors = [0]
+
+        lock = threading.Lock()
+
+        def error(message):
+            self.log(message)
+            with lock:
+                errors[0] += 1
+
+        def worker(t):
+            for i in range(self.__sentences):
+                text, context = sentences[t * self.__sentences + i]
+
+                try:
+                    result = coalescer.translate('en', 'it', text, context=context)
+                except Exception as e:
+                    error('Translation of "%s" failed: %s' % (text, e))
+                    continue
+
+                # the stand-in echoes the context of the request: sentences with different contexts are never grouped
+                expected_context = ClusterNode.Api._encode_context(context) if context is not None else None
+
+                if result['translation'] != StandInServer.translate(text):
+                    error('Wrong translation for "%s": "%s"' % (text, result['translation']))
+                elif result.get('contextVector', None) != expected_context:
+                    error('Wrong context for "%s": "%s"' % (text, result.get('contextVector', None)))
+
+        threads = [threading.Thread(target=worker, args=(t,)) for t in range(self.__threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.log('%d sentences translated with %d requests' % (server.sentences, server.requests))
+
+        return {
+            'sentences': len(sentences),
+            'requests': server.requests,
+            'batch_requests': server.batch_requests,
+            'errors': errors[0]
+        }
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-t", "--threads", dest="threads", default="32",
+                      help="the number of concurrent threads translating (default 32)")
+    parser.add_option("-n", "--sentences", dest="sentences", default="20",
+                      help="the number of sentences translated by every thread (default 20)")
+    parser.add_option("-v", "--verbosity-level", dest="verbosity_level", default="0",
+                      help="the verbosity level: should be 0=default,1")
+    options, _ = parser.parse_args()
+
+    test = TranslateBatchTest(**vars(options))
+    test.start_test()